@@ -0,0 +1,104 @@
+"""Сравнение задержки запросов бота к Node API через TCP и unix сокет.
+
+Запуск внутри контейнера бота (сокет смонтирован из volume api_socket):
+
+    python bench_transport.py \
+        --tcp http://server:5050/api \
+        --unix unix:///run/marketplace/server.sock/api \
+        --requests 500 --concurrency 10
+"""
+import argparse
+import asyncio
+import statistics
+import time
+
+import aiohttp
+
+from main2 import parse_api_url, create_api_connector
+
+CATALOG_ENDPOINTS = [
+    '/catalog/categories',
+    '/bot/cities-with-districts',
+    '/bot/categories-with-products',
+    '/review/stats',
+]
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+async def bench_endpoint(session, base_url, endpoint, requests, concurrency):
+    """Задержки (мс) requests запросов к endpoint при заданной конкурентности."""
+    latencies = []
+    errors = 0
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one():
+        nonlocal errors
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                async with session.get(f'{base_url}{endpoint}') as resp:
+                    await resp.read()
+                    if resp.status != 200:
+                        errors += 1
+            except aiohttp.ClientError:
+                errors += 1
+            latencies.append((time.perf_counter() - started) * 1000)
+
+    await asyncio.gather(*(one() for _ in range(requests)))
+    return latencies, errors
+
+
+async def bench_transport(api_url, requests, concurrency, warmup):
+    socket_path, base_url = parse_api_url(api_url)
+    results = {}
+    async with aiohttp.ClientSession(connector=create_api_connector(socket_path)) as session:
+        for endpoint in CATALOG_ENDPOINTS:
+            # Прогрев: открыть соединения пула, чтобы не мерить handshake
+            await bench_endpoint(session, base_url, endpoint, warmup, concurrency)
+            results[endpoint] = await bench_endpoint(session, base_url, endpoint, requests, concurrency)
+    return results
+
+
+def print_report(name, results):
+    print(f"\n== {name} ==")
+    print(f"{'endpoint':<34}{'mean':>9}{'p50':>9}{'p95':>9}{'p99':>9}{'errors':>8}")
+    for endpoint, (latencies, errors) in results.items():
+        print(
+            f"{endpoint:<34}"
+            f"{statistics.mean(latencies):>9.2f}"
+            f"{percentile(latencies, 50):>9.2f}"
+            f"{percentile(latencies, 95):>9.2f}"
+            f"{percentile(latencies, 99):>9.2f}"
+            f"{errors:>8}"
+        )
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--tcp', default='http://server:5050/api')
+    parser.add_argument('--unix', default='unix:///run/marketplace/server.sock/api')
+    parser.add_argument('--requests', type=int, default=500)
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--warmup', type=int, default=20)
+    args = parser.parse_args()
+
+    tcp = await bench_transport(args.tcp, args.requests, args.concurrency, args.warmup)
+    uds = await bench_transport(args.unix, args.requests, args.concurrency, args.warmup)
+
+    print_report(f"TCP {args.tcp}", tcp)
+    print_report(f"UDS {args.unix}", uds)
+
+    print("\n== p50 UDS vs TCP ==")
+    for endpoint in CATALOG_ENDPOINTS:
+        tcp_p50 = percentile(tcp[endpoint][0], 50)
+        uds_p50 = percentile(uds[endpoint][0], 50)
+        print(f"{endpoint:<34}{(uds_p50 - tcp_p50) / tcp_p50 * 100:>+8.1f}%")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -1,404 +1,3005 @@
+import time
+
+# Начало импорта модулей: первый этап отчета о запуске (StartupReport)
+STARTUP_STARTED = time.perf_counter()
+
 import os
+import copy
+import contextlib
+import cProfile
+import io
+import marshal
+import pstats
+import threading
+import tracemalloc
+import queue
+import random
+import re
+import signal
+import base64
+import hashlib
+import hmac
+import html
+import asyncio
+import bisect
+import heapq
+import zlib
+import sqlite3
+import sys
+import json
 import logging
-from collections import defaultdict
+import contextvars
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from collections import Counter, defaultdict, deque, OrderedDict
 from telegram import (
     Update,
     InlineKeyboardButton,
     InlineKeyboardMarkup,
     ReplyKeyboardMarkup,
-    KeyboardButton
+    KeyboardButton,
+    InlineQueryResultArticle,
+    InputTextMessageContent,
+    InputMediaPhoto
 )
+from telegram.error import BadRequest, Forbidden, RetryAfter
+from telegram.request import HTTPXRequest
 from telegram.ext import (
     Application, 
     CommandHandler, 
     CallbackQueryHandler, 
     ContextTypes,
     MessageHandler,
+    InlineQueryHandler,
+    TypeHandler,
     filters
 )
 import aiohttp
+from aiohttp import web
 from datetime import datetime
 
-NODE_API_URL = os.getenv('NODE_API_URL', 'http://server:5050/api')
-BOT_TOKEN = os.getenv('BOT_TOKEN')
-CRYPTO_BOT_TOKEN = os.getenv('CRYPTO_BOT_TOKEN')
-CRYPTO_PAYMENT_ASSET = os.getenv('CRYPTO_PAYMENT_ASSET', 'USDT')
-NGROK_API_URL = os.getenv('NGROK_API_URL', 'http://127.0.0.1:4040/api/tunnels')
-PUBLIC_BASE_URL = os.getenv('PUBLIC_BASE_URL')
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+NODE_API_URL = os.getenv('NODE_API_URL', 'http://server:5050/api')
+BOT_TOKEN = os.getenv('BOT_TOKEN')
+CRYPTO_BOT_TOKEN = os.getenv('CRYPTO_BOT_TOKEN')
+CRYPTO_PAYMENT_ASSET = os.getenv('CRYPTO_PAYMENT_ASSET', 'USDT')
+# Активы для пополнения; баланс ведется в CRYPTO_PAYMENT_ASSET, остальные конвертируются по курсу
+CRYPTO_PAYMENT_ASSETS = [
+    a.strip().upper() for a in os.getenv('CRYPTO_PAYMENT_ASSETS', CRYPTO_PAYMENT_ASSET).split(',') if a.strip()
+]
+RATES_REFRESH = int(os.getenv('RATES_REFRESH', '60'))
+# Старше этого курсы не используются (обновление не удается несколько раз подряд)
+RATES_MAX_AGE = int(os.getenv('RATES_MAX_AGE', str(RATES_REFRESH * 5)))
+RATES_FIAT = 'USD'
+NGROK_API_URL = os.getenv('NGROK_API_URL', 'http://127.0.0.1:4040/api/tunnels')
+PUBLIC_BASE_URL = os.getenv('PUBLIC_BASE_URL')
+SEARCH_INDEX_REFRESH = int(os.getenv('SEARCH_INDEX_REFRESH', '300'))
+INLINE_RESULTS_PER_PAGE = 20
+REVIEWS_FEED_SIZE = int(os.getenv('REVIEWS_FEED_SIZE', '50'))
+REVIEWS_REFRESH = int(os.getenv('REVIEWS_REFRESH', '60'))
+REVIEWS_RESYNC = int(os.getenv('REVIEWS_RESYNC', '3600'))
+REVIEWS_PAGE_SIZE = 10
+BALANCE_TTL = float(os.getenv('BALANCE_TTL', '30'))
+BOT_DATA_DIR = os.getenv('BOT_DATA_DIR', 'data')
+CLIENT_CACHE_SIZE = int(os.getenv('CLIENT_CACHE_SIZE', '10000'))
+CLIENT_BATCH_SIZE = int(os.getenv('CLIENT_BATCH_SIZE', '50'))
+CLIENT_BATCH_DELAY = float(os.getenv('CLIENT_BATCH_DELAY', '0.2'))
+API_TIMEOUT = float(os.getenv('API_TIMEOUT', '15'))
+API_POOL_SIZE = int(os.getenv('API_POOL_SIZE', '100'))
+# Как часто перепроверять публичный адрес (туннель ngrok) и файл для проверки доступности
+PUBLIC_URL_REFRESH = int(os.getenv('PUBLIC_URL_REFRESH', '30'))
+PUBLIC_URL_HEALTHCHECK_PATH = os.getenv('PUBLIC_URL_HEALTHCHECK_PATH', 'healthcheck.txt')
+API_CACHE_TTL = float(os.getenv('API_CACHE_TTL', '60'))
+# Лента изменений сервера (GET /bot/changes): пока она подключена, кэш живет CHANGE_FEED_CACHE_TTL
+CHANGE_FEED_ENABLED = os.getenv('CHANGE_FEED_ENABLED', '1') == '1'
+CHANGE_FEED_CACHE_TTL = float(os.getenv('CHANGE_FEED_CACHE_TTL', '3600'))
+CHANGE_FEED_READ_TIMEOUT = float(os.getenv('CHANGE_FEED_READ_TIMEOUT', '60'))
+CHANGE_FEED_RECONNECT_MAX = float(os.getenv('CHANGE_FEED_RECONNECT_MAX', '30'))
+# Ключ подписи deep link (/start <payload>); по умолчанию выводится из BOT_TOKEN
+DEEP_LINK_SECRET = os.getenv('DEEP_LINK_SECRET')
+# Уведомления о поступлении: сообщений в секунду (лимит Telegram на рассылку ~30/с)
+RESTOCK_SEND_RATE = float(os.getenv('RESTOCK_SEND_RATE', '20'))
+# События воронки: пачки по ANALYTICS_BATCH_SIZE или раз в ANALYTICS_FLUSH_INTERVAL секунд в JSONL,
+# при ANALYTICS_UPLOAD=1 еще и на сервер (POST /bot/analytics/events)
+ANALYTICS_ENABLED = os.getenv('ANALYTICS_ENABLED', '1') == '1'
+ANALYTICS_DIR = os.getenv('ANALYTICS_DIR', os.path.join(BOT_DATA_DIR, 'analytics'))
+ANALYTICS_BATCH_SIZE = int(os.getenv('ANALYTICS_BATCH_SIZE', '500'))
+ANALYTICS_FLUSH_INTERVAL = float(os.getenv('ANALYTICS_FLUSH_INTERVAL', '5'))
+ANALYTICS_UPLOAD = os.getenv('ANALYTICS_UPLOAD', '0') == '1'
+# Журнал денежных операций: окно группового fsync, ротация (размер файла и сколько
+# архивов хранить) и период повтора неподтвержденных записей
+JOURNAL_DIR = os.getenv('JOURNAL_DIR', os.path.join(BOT_DATA_DIR, 'journal'))
+JOURNAL_COMMIT_DELAY = float(os.getenv('JOURNAL_COMMIT_DELAY', '0.005'))
+JOURNAL_ROTATE_BYTES = int(os.getenv('JOURNAL_ROTATE_BYTES', str(16 * 1024 * 1024)))
+JOURNAL_ARCHIVES = int(os.getenv('JOURNAL_ARCHIVES', '10'))
+JOURNAL_REPLAY_INTERVAL = int(os.getenv('JOURNAL_REPLAY_INTERVAL', '60'))
+JSON_DECODER = os.getenv('JSON_DECODER', 'auto')
+SESSION_IDLE_TTL = int(os.getenv('SESSION_IDLE_TTL', '1800'))
+SESSION_SWEEP_INTERVAL = int(os.getenv('SESSION_SWEEP_INTERVAL', '60'))
+MAX_OPEN_INVOICES = int(os.getenv('MAX_OPEN_INVOICES', '5'))
+INVOICE_TTL = int(os.getenv('INVOICE_TTL', '3600'))
+INVOICE_SWEEP_INTERVAL = int(os.getenv('INVOICE_SWEEP_INTERVAL', '120'))
+# Резерв позиции при нажатии «Купить» (секунды). На время оплаты инвойса на доплату
+# резерв продлевается до истечения инвойса плюс запас на последнюю проверку оплаты
+RESERVATION_TTL = int(os.getenv('RESERVATION_TTL', '300'))
+INVOICE_RESERVATION_GRACE = int(os.getenv('INVOICE_RESERVATION_GRACE', '120'))
+# Как часто проверять оплату открытых инвойсов для автоматического зачисления
+PAYMENT_POLL_INTERVAL = int(os.getenv('PAYMENT_POLL_INTERVAL', '15'))
+# Допуск апдейтов: токены в секунду и запас на пользователя, окно и порог ошибок upstream
+ADMISSION_RATE = float(os.getenv('ADMISSION_RATE', '2'))
+ADMISSION_BURST = int(os.getenv('ADMISSION_BURST', '6'))
+ADMISSION_ERROR_WINDOW = int(os.getenv('ADMISSION_ERROR_WINDOW', '30'))
+ADMISSION_SHED_ERROR_RATE = float(os.getenv('ADMISSION_SHED_ERROR_RATE', '0.5'))
+UPDATE_CONCURRENCY = int(os.getenv('UPDATE_CONCURRENCY', '64'))
+# Сколько секунд при остановке ждать завершения обрабатываемых апдейтов (меньше stop_grace_period)
+SHUTDOWN_DRAIN_TIMEOUT = float(os.getenv('SHUTDOWN_DRAIN_TIMEOUT', '20'))
+# HTTP для оркестратора: /healthz, /readyz, /metrics (HEALTH_PORT=0 отключает)
+HEALTH_HOST = os.getenv('HEALTH_HOST', '0.0.0.0')
+HEALTH_PORT = int(os.getenv('HEALTH_PORT', '8080'))
+# Предел ожидания каждого шага прогрева кэшей при запуске
+WARMUP_TIMEOUT = float(os.getenv('WARMUP_TIMEOUT', '10'))
+# Сколько последних отрисованных сообщений помнить, чтобы не повторять одинаковые правки
+SCREEN_CACHE_SIZE = int(os.getenv('SCREEN_CACHE_SIZE', '10000'))
+# Telegram id администраторов (через запятую): команды профилирования
+ADMIN_TELEGRAM_IDS = {int(x) for x in os.getenv('ADMIN_TELEGRAM_IDS', '').split(',') if x.strip()}
+PROFILE_DEFAULT_SECONDS = 30
+PROFILE_MAX_SECONDS = int(os.getenv('PROFILE_MAX_SECONDS', '120'))
+PROFILE_SAMPLE_INTERVAL = float(os.getenv('PROFILE_SAMPLE_INTERVAL', '0.005'))
+MEMORY_TOP_N = int(os.getenv('MEMORY_TOP_N', '25'))
+METRICS_LOG_INTERVAL = int(os.getenv('METRICS_LOG_INTERVAL', '600'))
+
+# логи: LOG_FORMAT=json|text, одинаковые ошибки не чаще раза в LOG_REPEAT_INTERVAL секунд
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json')
+LOG_DIR = os.getenv('LOG_DIR', 'logs')
+LOG_MAX_BYTES = int(os.getenv('LOG_MAX_BYTES', str(10 * 1024 * 1024)))
+LOG_BACKUP_COUNT = int(os.getenv('LOG_BACKUP_COUNT', '5'))
+LOG_REPEAT_INTERVAL = float(os.getenv('LOG_REPEAT_INTERVAL', '10'))
+
+# Трассировка апдейтов: сохраняются медленные (>= TRACE_SLOW_MS), с ошибками
+# и доля TRACE_SAMPLE_RATE остальных; TRACE_EXPORT_URL - коллектор OTLP/HTTP (JSON).
+# Файл трасс ротируется так же, как логи (LOG_MAX_BYTES, LOG_BACKUP_COUNT)
+TRACE_EXPORT_PATH = os.getenv('TRACE_EXPORT_PATH', os.path.join(LOG_DIR, 'traces.jsonl'))
+TRACE_EXPORT_URL = os.getenv('TRACE_EXPORT_URL')
+TRACE_SLOW_MS = float(os.getenv('TRACE_SLOW_MS', '1000'))
+TRACE_SAMPLE_RATE = float(os.getenv('TRACE_SAMPLE_RATE', '0.01'))
+TRACE_EXPORT_INTERVAL = int(os.getenv('TRACE_EXPORT_INTERVAL', '5'))
+
+logger = logging.getLogger(__name__)
+
+# Контекст текущего апдейта (user_id, update_id, handler) для записей лога
+log_context = contextvars.ContextVar('log_context', default={})
+
+
+class ContextQueueHandler(QueueHandler):
+    """Передает записи в очередь, не блокируя event loop.
+
+    Сообщение форматируется здесь (только если запись прошла уровень и
+    фильтры), к записи добавляется контекст апдейта; сериализация и запись
+    на диск выполняются в потоке QueueListener.
+    """
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.__dict__.update(log_context.get())
+        record.message = record.getMessage()
+        record.msg, record.args = record.message, None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class RepeatFilter(logging.Filter):
+    """Предупреждения и ошибки из одного места кода - не чаще раза в interval секунд.
+
+    Число пропущенных записей попадает в поле suppressed следующей.
+    """
+
+    def __init__(self, interval):
+        super().__init__()
+        self.interval = interval
+        self.last = {}
+
+    def filter(self, record):
+        if record.levelno < logging.WARNING or self.interval <= 0:
+            return True
+        key = (record.pathname, record.lineno)
+        last, suppressed = self.last.get(key, (0.0, 0))
+        if record.created - last < self.interval:
+            self.last[key] = (last, suppressed + 1)
+            return False
+        self.last[key] = (record.created, 0)
+        if suppressed:
+            record.suppressed = suppressed
+        return True
+
+
+class JsonLogFormatter(logging.Formatter):
+    """Запись лога одной JSON строкой."""
+
+    EXTRA_FIELDS = ('trace_id', 'user_id', 'update_id', 'handler', 'suppressed')
+
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage()
+        }
+        for field in self.EXTRA_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def setup_logging():
+    """Логи через очередь: stderr и файлы с ротацией в LOG_DIR пишет отдельный поток."""
+    os.makedirs(LOG_DIR, exist_ok=True)
+    if LOG_FORMAT == 'json':
+        formatter = JsonLogFormatter()
+    else:
+        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    stream_handler = logging.StreamHandler()
+    file_handler = RotatingFileHandler(
+        os.path.join(LOG_DIR, 'bot.log'), maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding='utf-8'
+    )
+    stream_handler.setFormatter(formatter)
+    file_handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = ContextQueueHandler(log_queue)
+    queue_handler.addFilter(RepeatFilter(LOG_REPEAT_INTERVAL))
+
+    root = logging.getLogger()
+    root.handlers[:] = [queue_handler]
+    root.setLevel(LOG_LEVEL)
+    # httpx пишет INFO на каждый long polling запрос к Telegram
+    logging.getLogger('httpx').setLevel(logging.WARNING)
+
+    listener = QueueListener(log_queue, stream_handler, file_handler, respect_handler_level=True)
+    listener.start()
+    return listener
+
+
+class PublicUrlResolver:
+    """Публичный адрес сервера для медиа (PUBLIC_BASE_URL или туннель ngrok).
+
+    Адрес обновляется фоновой задачей: туннель может подняться позже бота
+    или смениться после перезапуска ngrok. Кроме адреса проверяется, что по
+    нему отдается статический файл PUBLIC_URL_HEALTHCHECK_PATH. Обработчики
+    читают готовое значение без сетевых запросов.
+    """
+
+    def __init__(self):
+        self.base_url = None
+        self.healthy = False
+
+    async def _tunnel_url(self, session):
+        async with session.get(NGROK_API_URL) as resp:
+            if resp.status != 200:
+                return None
+            data = await resp.json()
+        urls = [t.get('public_url') for t in data.get('tunnels', []) if t.get('public_url')]
+        # Telegram скачивает файлы только по https
+        urls.sort(key=lambda url: not url.startswith('https://'))
+        return urls[0].rstrip('/') if urls else None
+
+    async def _check(self, session, base_url):
+        url = f"{base_url}/{PUBLIC_URL_HEALTHCHECK_PATH}"
+        # Заголовок отключает страницу-предупреждение бесплатного ngrok
+        async with session.get(url, headers={'ngrok-skip-browser-warning': '1'}) as resp:
+            return resp.status == 200
+
+    async def refresh(self):
+        timeout = aiohttp.ClientTimeout(total=10)
+        async with aiohttp.ClientSession(timeout=timeout) as session:
+            try:
+                base_url = PUBLIC_BASE_URL.rstrip('/') if PUBLIC_BASE_URL else await self._tunnel_url(session)
+            except Exception as e:
+                logger.warning("Error resolving ngrok url: %s", e)
+                base_url = None
+
+            healthy = False
+            if base_url:
+                try:
+                    healthy = await self._check(session, base_url)
+                except Exception as e:
+                    logger.warning("Public URL health check failed for %s: %s", base_url, e)
+
+        if base_url and base_url != self.base_url:
+            logger.info("Public base URL changed: %s -> %s", self.base_url, base_url)
+            metrics.inc('bot_public_url_changes_total')
+        if base_url:
+            self.base_url = base_url
+        self.healthy = healthy
+        metrics.inc('bot_public_url_checks_total', result='ok' if healthy else 'fail')
+        metrics.set('bot_public_url_healthy', 1 if healthy else 0)
+        return healthy
+
+
+public_url_resolver = PublicUrlResolver()
+
+
+async def public_url_watcher():
+    """Фоновое обновление публичного адреса и проверка туннеля (первое - в warmup)."""
+    while True:
+        await asyncio.sleep(PUBLIC_URL_REFRESH)
+        try:
+            await public_url_resolver.refresh()
+        except Exception as e:
+            logger.error("Error refreshing public URL: %s", e)
+
+
+def build_public_media_url(path: str):
+    """URL файла из server/static или None, если публичный адрес сейчас недоступен."""
+    if not public_url_resolver.healthy:
+        return None
+    return f"{public_url_resolver.base_url}/{path.lstrip('/')}"
+
+class Metrics:
+    """Счетчики и gauge-метрики бота в памяти (формат Prometheus при выводе)."""
+
+    def __init__(self):
+        self.values = defaultdict(float)
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        self.values[self._key(name, labels)] += value
+
+    def set(self, name, value, **labels):
+        self.values[self._key(name, labels)] = value
+
+    def get(self, name, **labels):
+        return self.values.get(self._key(name, labels), 0)
+
+    def render(self):
+        lines = []
+        for (name, labels), value in sorted(self.values.items()):
+            label_text = ','.join(f'{k}="{v}"' for k, v in labels)
+            lines.append(f"{name}{{{label_text}}} {value:g}" if label_text else f"{name} {value:g}")
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+class StartupReport:
+    """Этапы запуска бота и готовность принимать трафик (/readyz).
+
+    imports - импорт и инициализация модуля, build - логирование, Application
+    и обработчики, initialize - инициализация бота в Telegram, warmup - прогрев
+    кэшей и соединений, first_poll - до первого запроса getUpdates.
+    Длительности пишутся в лог и в метрику bot_startup_phase_seconds{phase}.
+    """
+
+    def __init__(self, started):
+        self.started = started
+        self.last = started
+        self.phases = OrderedDict()
+        self.warmup = OrderedDict()
+        self.ready = False
+
+    def mark(self, phase):
+        now = time.perf_counter()
+        self.phases[phase] = now - self.last
+        self.last = now
+        metrics.set('bot_startup_phase_seconds', self.phases[phase], phase=phase)
+
+    def polling_started(self):
+        if self.ready:
+            return
+        self.mark('first_poll')
+        self.ready = True
+        total = self.last - self.started
+        metrics.set('bot_startup_seconds', total)
+        logger.info(
+            "Startup finished in %.2fs: %s; warmup: %s", total,
+            ', '.join(f"{phase}={seconds:.2f}s" for phase, seconds in self.phases.items()),
+            ', '.join(f"{step}={seconds:.2f}s ({status})" for step, (seconds, status) in self.warmup.items())
+        )
+
+
+startup = StartupReport(STARTUP_STARTED)
+
+
+class AdmissionControl:
+    """Допуск апдейтов к обработчикам.
+
+    - token bucket на пользователя: не больше ADMISSION_RATE действий в секунду
+      с запасом ADMISSION_BURST;
+    - повторное нажатие той же кнопки, пока первое еще обрабатывается,
+      отбрасывается (ключ - пользователь и callback_data);
+    - разные кнопки одного пользователя выполняются по очереди (serialized),
+      чтобы две покупки не списывали один и тот же баланс параллельно;
+    - при доле ошибок Node API выше ADMISSION_SHED_ERROR_RATE за последние
+      ADMISSION_ERROR_WINDOW секунд отбрасывается такая же доля новых действий.
+    Отброшенные апдейты считаются в bot_admission_dropped_total{reason}.
+    """
+
+    MAX_BUCKETS = 10000
+    MIN_UPSTREAM_SAMPLES = 10
+
+    def __init__(self, rate=ADMISSION_RATE, burst=ADMISSION_BURST):
+        self.rate = rate
+        self.burst = burst
+        self.buckets = {}
+        self.in_flight = set()
+        self.user_locks = {}
+        self.upstream = deque()
+
+    def _take_token(self, user_id, now):
+        tokens, updated = self.buckets.get(user_id, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        if tokens < 1:
+            self.buckets[user_id] = (tokens, now)
+            return False
+        self.buckets[user_id] = (tokens - 1, now)
+        if len(self.buckets) > self.MAX_BUCKETS:
+            # Корзины, которые успели наполниться, ничем не отличаются от новых
+            full_after = self.burst / self.rate
+            self.buckets = {
+                uid: bucket for uid, bucket in self.buckets.items() if now - bucket[1] < full_after
+            }
+        return True
+
+    def record_upstream(self, ok):
+        """Учесть результат запроса к Node API."""
+        self.upstream.append((time.monotonic(), ok))
+
+    def upstream_error_rate(self):
+        deadline = time.monotonic() - ADMISSION_ERROR_WINDOW
+        while self.upstream and self.upstream[0][0] < deadline:
+            self.upstream.popleft()
+        if len(self.upstream) < self.MIN_UPSTREAM_SAMPLES:
+            return 0.0
+        return sum(1 for _, ok in self.upstream if not ok) / len(self.upstream)
+
+    def admit(self, user_id, key=None):
+        """None - апдейт допущен (для key вызвать release после обработки), иначе причина отказа."""
+        if key is not None and (user_id, key) in self.in_flight:
+            reason = 'duplicate'
+        elif not self._take_token(user_id, time.monotonic()):
+            reason = 'rate'
+        else:
+            error_rate = self.upstream_error_rate()
+            reason = 'shed' if error_rate >= ADMISSION_SHED_ERROR_RATE and random.random() < error_rate else None
+        if reason:
+            metrics.inc('bot_admission_dropped_total', reason=reason)
+            return reason
+        metrics.inc('bot_admission_admitted_total')
+        if key is not None:
+            self.in_flight.add((user_id, key))
+        return None
+
+    def release(self, user_id, key):
+        self.in_flight.discard((user_id, key))
+
+    @contextlib.asynccontextmanager
+    async def serialized(self, user_id):
+        """Очередь обработки допущенных апдейтов пользователя; замок удаляется, когда очередь пуста."""
+        entry = self.user_locks.get(user_id)
+        if entry is None:
+            entry = self.user_locks[user_id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self.user_locks[user_id]
+
+
+admission = AdmissionControl()
+
+current_trace = contextvars.ContextVar('current_trace', default=None)
+current_span_id = contextvars.ContextVar('current_span_id', default=None)
+
+
+class Span:
+    """Участок трассы (with tracer.span(...)): время, родитель, атрибуты, ошибка."""
+
+    __slots__ = ('trace', 'name', 'span_id', 'parent_id', 'attrs', 'start', 'end', 'error', '_token')
+
+    def __init__(self, trace, name, attrs):
+        self.trace = trace
+        self.name = name
+        self.attrs = attrs
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = current_span_id.get()
+        self.start = time.time()
+        self.end = None
+        self.error = None
+        self._token = None
+
+    def __enter__(self):
+        self._token = current_span_id.set(self.span_id)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.end = time.time()
+        if exc is not None:
+            self.error = repr(exc)
+        current_span_id.reset(self._token)
+        self.trace.spans.append(self)
+        return False
+
+    def to_dict(self):
+        return {
+            'trace_id': self.trace.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'start': self.start,
+            'duration_ms': round((self.end - self.start) * 1000, 2),
+            'attrs': self.attrs,
+            'error': self.error
+        }
+
+
+class Trace:
+    __slots__ = ('trace_id', 'root', 'spans')
+
+    def __init__(self):
+        self.trace_id = os.urandom(16).hex()
+        self.root = None
+        self.spans = []
+
+
+class Tracer:
+    """Трассы апдейтов: trace id в contextvar, спаны вызовов Node API, Crypto Pay и Telegram.
+
+    Решение о сохранении принимается по завершении апдейта (tail sampling),
+    запись в файл и отправка в коллектор - фоновой задачей trace_exporter.
+    """
+
+    MAX_PENDING_SPANS = 10000
+
+    def __init__(self):
+        self.pending = []
+        self._file = None
+
+    def start_trace(self, name, **attrs):
+        trace = Trace()
+        trace.root = Span(trace, name, attrs)
+        current_trace.set(trace)
+        current_span_id.set(trace.root.span_id)
+        return trace
+
+    def finish_trace(self):
+        trace = current_trace.get()
+        if trace is None:
+            return
+        current_trace.set(None)
+        current_span_id.set(None)
+        root = trace.root
+        root.end = time.time()
+        trace.spans.append(root)
+        duration_ms = (root.end - root.start) * 1000
+        keep = (
+            duration_ms >= TRACE_SLOW_MS
+            or any(span.error for span in trace.spans)
+            or random.random() < TRACE_SAMPLE_RATE
+        )
+        metrics.inc('bot_traces_total', sampled=keep)
+        if keep and len(self.pending) < self.MAX_PENDING_SPANS:
+            self.pending.extend(trace.spans)
+
+    def span(self, name, **attrs):
+        trace = current_trace.get()
+        if trace is None:
+            return contextlib.nullcontext()
+        return Span(trace, name, attrs)
+
+    def fail(self, error):
+        """Отметить корневой спан текущего апдейта ошибкой обработчика."""
+        trace = current_trace.get()
+        if trace is not None:
+            trace.root.error = repr(error)
+
+    def headers(self):
+        """W3C traceparent для исходящего запроса в рамках текущего спана."""
+        trace = current_trace.get()
+        if trace is None:
+            return {}
+        return {'traceparent': f"00-{trace.trace_id}-{current_span_id.get() or trace.root.span_id}-01"}
+
+    def _write_file(self, spans):
+        if self._file is None:
+            self._file = RotatingFileHandler(
+                TRACE_EXPORT_PATH, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding='utf-8', delay=True
+            )
+        for span in spans:
+            self._file.handle(logging.makeLogRecord({
+                'msg': json.dumps(span.to_dict(), ensure_ascii=False, default=str)
+            }))
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    @staticmethod
+    def otlp_payload(spans):
+        """Спаны в формате OTLP/HTTP JSON (ExportTraceServiceRequest)."""
+        def attributes(attrs):
+            return [{'key': k, 'value': {'stringValue': str(v)}} for k, v in attrs.items()]
+
+        return {'resourceSpans': [{
+            'resource': {'attributes': attributes({'service.name': 'marketplace-bot'})},
+            'scopeSpans': [{'scope': {'name': __name__}, 'spans': [{
+                'traceId': span.trace.trace_id,
+                'spanId': span.span_id,
+                'parentSpanId': span.parent_id or '',
+                'name': span.name,
+                'kind': 3,
+                'startTimeUnixNano': str(int(span.start * 1e9)),
+                'endTimeUnixNano': str(int(span.end * 1e9)),
+                'attributes': attributes(span.attrs),
+                'status': {'code': 2, 'message': span.error} if span.error else {'code': 1}
+            } for span in spans]}]
+        }]}
+
+    async def export(self):
+        spans, self.pending = self.pending, []
+        if not spans:
+            return
+        if TRACE_EXPORT_PATH:
+            await asyncio.to_thread(self._write_file, spans)
+        if TRACE_EXPORT_URL:
+            try:
+                async with aiohttp.request('POST', TRACE_EXPORT_URL, json=self.otlp_payload(spans)) as resp:
+                    if resp.status >= 300:
+                        logger.warning("Trace export failed with status %s", resp.status)
+            except Exception as e:
+                logger.warning("Trace export failed: %s", e)
+
+
+tracer = Tracer()
+
+
+async def trace_exporter():
+    """Фоновая выгрузка отобранных трасс."""
+    while True:
+        await asyncio.sleep(TRACE_EXPORT_INTERVAL)
+        try:
+            await tracer.export()
+        except Exception as e:
+            logger.error("Error exporting traces: %s", e)
+
+
+class TracingRequest(HTTPXRequest):
+    """HTTPXRequest со спаном на каждый вызов Telegram Bot API."""
+
+    async def do_request(self, url, method, *args, **kwargs):
+        api_method = url.rsplit('/', 1)[-1]
+        if api_method == 'getUpdates':
+            startup.polling_started()
+        with tracer.span('telegram', method=api_method) as span:
+            code, payload = await super().do_request(url, method, *args, **kwargs)
+            if span:
+                span.attrs['status'] = code
+            return code, payload
+
+
+ADMISSION_MESSAGES = {
+    'duplicate': "⏳ Уже выполняется...",
+    'rate': "Слишком много действий, подождите секунду.",
+    'shed': "Сервис сейчас перегружен, попробуйте чуть позже."
+}
+
+
+def get_json_decoder():
+    """Выбрать JSON декодер: orjson если установлен (JSON_DECODER=auto|orjson|json)."""
+    if JSON_DECODER in ('auto', 'orjson') and orjson is not None:
+        return orjson.loads
+    if JSON_DECODER == 'orjson':
+        logger.warning("JSON_DECODER=orjson, but orjson is not installed: using json")
+    return json.loads
+
+
+def parse_api_url(api_url):
+    """Разобрать адрес Node API: (путь к unix сокету или None, базовый HTTP URL).
+
+    unix:///run/marketplace/server.sock/api -> ('/run/marketplace/server.sock', 'http://localhost/api')
+    """
+    if not api_url.startswith('unix://'):
+        return None, api_url
+    socket_path, sock_ext, http_path = api_url[len('unix://'):].partition('.sock')
+    return socket_path + sock_ext, f"http://localhost{http_path}"
+
+
+def create_api_connector(socket_path=None):
+    """Пул соединений к Node серверу: unix сокет (сервер на том же хосте) или TCP."""
+    if socket_path:
+        return aiohttp.UnixConnector(path=socket_path, limit=API_POOL_SIZE)
+    return aiohttp.TCPConnector(limit=API_POOL_SIZE, keepalive_timeout=30)
+
+
+class BotAPI:
+    # Сколько ответов хранить для условных GET (ETag / Last-Modified)
+    VALIDATOR_CACHE_SIZE = 1000
+
+    def __init__(self, base_url):
+        self.socket_path, self.base_url = parse_api_url(base_url)
+        self.transport = 'unix' if self.socket_path else 'tcp'
+        self.session = None
+        self.validators = OrderedDict()
+        self.json_loads = get_json_decoder()
+
+    async def get_session(self):
+        """Общая сессия с пулом соединений к Node серверу"""
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(
+                connector=create_api_connector(self.socket_path),
+                timeout=aiohttp.ClientTimeout(total=API_TIMEOUT)
+            )
+        return self.session
+
+    async def close(self):
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+
+    def cache_ttl(self):
+        """Срок кэша ответов: долгий, пока изменения приходят по ленте сервера."""
+        return CHANGE_FEED_CACHE_TTL if change_feed.connected else API_CACHE_TTL
+
+    def invalidate(self, *prefixes):
+        """Устарить кэшированные ответы по префиксам пути ('' - все).
+
+        Валидаторы сохраняются: следующий запрос будет условным и при
+        неизменных данных получит 304.
+        """
+        urls = tuple(f'{self.base_url}{prefix}' for prefix in prefixes)
+        expired = 0
+        for cache_key, cached in self.validators.items():
+            if cache_key.startswith(urls):
+                cached['fetched_at'] = float('-inf')
+                expired += 1
+        return expired
+
+    async def _request(self, method, path, endpoint=None, params=None, json_body=None, max_age=None):
+        """Запрос к Node API (см. _fetch) со спаном трассы и учетом ошибок upstream для admission."""
+        with tracer.span('node_api', method=method, endpoint=endpoint or path) as span:
+            try:
+                status, data = await self._fetch(method, path, endpoint, params, json_body, max_age)
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                admission.record_upstream(False)
+                raise
+            admission.record_upstream(status < 500)
+            if span:
+                span.attrs['status'] = status
+            return status, data
+
+    async def _fetch(self, method, path, endpoint=None, params=None, json_body=None, max_age=None):
+        """Выполнить запрос к Node API и вернуть (status, data).
+
+        max_age включает кэш ответа по URL: пока ответ моложе max_age секунд,
+        он отдается без запроса, дальше сервер перепроверяется через
+        If-None-Match / If-Modified-Since и при 304 тело не скачивается и не
+        парсится заново. Возвращаемые из кэша данные изменять нельзя.
+        """
+        endpoint = endpoint or path
+        url = f'{self.base_url}{path}'
+        cache_key = url + ('?' + '&'.join(f'{k}={v}' for k, v in sorted(params.items())) if params else '')
+        cached = self.validators.get(cache_key) if max_age is not None else None
+
+        if cached and time.monotonic() - cached['fetched_at'] < max_age:
+            self.validators.move_to_end(cache_key)
+            metrics.inc('api_cache_hits_total', endpoint=endpoint)
+            return 200, cached['body']
+
+        headers = tracer.headers()
+        if cached:
+            if cached.get('etag'):
+                headers['If-None-Match'] = cached['etag']
+            if cached.get('last_modified'):
+                headers['If-Modified-Since'] = cached['last_modified']
+
+        session = await self.get_session()
+        started = time.perf_counter()
+        async with session.request(method, url, params=params, json=json_body, headers=headers) as resp:
+            metrics.inc('api_requests_total', endpoint=endpoint, status=resp.status, transport=self.transport)
+
+            if resp.status == 304 and cached:
+                cached['fetched_at'] = time.monotonic()
+                self.validators.move_to_end(cache_key)
+                metrics.inc('api_not_modified_total', endpoint=endpoint)
+                metrics.inc('api_bytes_saved_total', cached['size'], endpoint=endpoint)
+                metrics.inc('api_parse_seconds_saved_total', cached['parse_time'], endpoint=endpoint)
+                metrics.inc('api_request_seconds_total', time.perf_counter() - started, endpoint=endpoint)
+                return 200, cached['body']
+
+            raw = await resp.read()
+            parse_started = time.perf_counter()
+            try:
+                data = self.json_loads(raw) if raw else None
+            except ValueError:
+                if resp.status == 200:
+                    raise
+                data = None
+            parse_time = time.perf_counter() - parse_started
+
+            metrics.inc('api_bytes_received_total', len(raw), endpoint=endpoint)
+            metrics.inc('api_parse_seconds_total', parse_time, endpoint=endpoint)
+            metrics.inc('api_request_seconds_total', time.perf_counter() - started, endpoint=endpoint)
+            if resp.headers.get('Content-Encoding'):
+                metrics.inc('api_compressed_responses_total', endpoint=endpoint)
+
+            if max_age is not None and resp.status == 200:
+                self.validators[cache_key] = {
+                    'etag': resp.headers.get('ETag'),
+                    'last_modified': resp.headers.get('Last-Modified'),
+                    'body': data,
+                    'size': len(raw),
+                    'parse_time': parse_time,
+                    'fetched_at': time.monotonic()
+                }
+                self.validators.move_to_end(cache_key)
+                while len(self.validators) > self.VALIDATOR_CACHE_SIZE:
+                    self.validators.popitem(last=False)
+
+            return resp.status, data
+
+    async def get_bot_content(self, content_key):
+        """Получить контент для бота"""
+        try:
+            status, data = await self._request(
+                'GET', f'/bot/content/{content_key}', '/bot/content/{key}', max_age=self.cache_ttl()
+            )
+            return data if status == 200 else None
+        except Exception as e:
+            logger.error("Error getting content %s: %s", content_key, e)
+            return None
+    
+    async def get_catalog_categories(self):
+        """Получить категории товаров"""
+        try:
+            status, data = await self._request('GET', '/catalog/categories', max_age=self.cache_ttl())
+            return data if status == 200 else []
+        except Exception as e:
+            logger.error("Error getting categories: %s", e)
+            return []
+    
+    async def get_products_by_category(self, category_id, city_id=None, district_id=None, page=1, limit=7):
+        """Получить товары по категории с пагинацией"""
+        try:
+            params = {'page': page, 'limit': limit}
+            if city_id: params['cityId'] = city_id
+            if district_id: params['districtId'] = district_id
+            
+            status, products = await self._request(
+                'GET', f'/catalog/categories/{category_id}/products', '/catalog/categories/{id}/products', params
+            )
+            if status == 200:
+                if isinstance(products, dict) and 'rows' in products:
+                    return products['rows'], products.get('count', 0)
+                return products, len(products)
+            return [], 0
+        except Exception as e:
+            logger.error("Error getting products for category %s: %s", category_id, e)
+            return [], 0
+    
+    async def get_positions_by_product(self, product_id, city_id=None, district_id=None):
+        """Получить позиции по продукту"""
+        try:
+            params = {}
+            if city_id: params['cityId'] = city_id
+            if district_id: params['districtId'] = district_id
+            
+            status, data = await self._request(
+                'GET', f'/catalog/products/{product_id}/positions', '/catalog/products/{id}/positions', params
+            )
+            if status == 200:
+                return data.get('rows', data) if isinstance(data, dict) else data
+            return []
+        except Exception as e:
+            logger.error("Error getting positions for product %s: %s", product_id, e)
+            return []
+    
+    async def get_categories_with_products(self):
+        """Получить дерево каталога: категории с продуктами и позициями"""
+        try:
+            status, data = await self._request('GET', '/bot/categories-with-products', max_age=0)
+            return data if status == 200 else None
+        except Exception as e:
+            logger.error("Error getting catalog tree: %s", e)
+            return None
+
+    async def get_cities_with_districts(self):
+        """Получить города с районами"""
+        try:
+            status, data = await self._request('GET', '/bot/cities-with-districts', max_age=self.cache_ttl())
+            return data if status == 200 else []
+        except Exception as e:
+            logger.error("Error getting cities: %s", e)
+            return []
+
+    async def get_available_districts(self, category_id, city_id):
+        """Получить доступные районы для категории"""
+        try:
+            params = {'cityId': city_id}
+            status, data = await self._request(
+                'GET', f'/categories/{category_id}/districts', '/categories/{id}/districts', params
+            )
+            return data if status == 200 else []
+        except Exception as e:
+            logger.error("Error getting available districts: %s", e)
+            return []
+    
+    async def get_product_by_id(self, product_id):
+        """Получить информацию о продукте по ID"""
+        try:
+            status, data = await self._request(
+                'GET', f'/product/{product_id}', '/product/{id}', max_age=self.cache_ttl()
+            )
+            return data if status == 200 else None
+        except Exception as e:
+            logger.error("Error getting product %s: %s", product_id, e)
+            return None
+    
+    async def get_position_by_id(self, position_id):
+        """Получить информацию о позиции по ID"""
+        try:
+            status, data = await self._request('GET', f'/position/{position_id}', '/position/{id}')
+            return data if status == 200 else None
+        except Exception as e:
+            logger.error("Error getting position %s: %s", position_id, e)
+            return None
+        
+    async def reserve_position(self, position_id, telegram_id, ttl=RESERVATION_TTL):
+        """Зарезервировать позицию за клиентом.
+
+        True - позиция удерживается этим клиентом, False - ее держит другой
+        покупатель, None - сервер недоступен (окончательную проверку тогда
+        сделает сервер при покупке).
+        """
+        try:
+            status, _ = await self._request(
+                'POST', f'/bot/positions/{position_id}/reservation', '/bot/positions/{id}/reservation',
+                json_body={'telegramId': telegram_id, 'ttl': ttl}
+            )
+            metrics.inc('bot_reservations_total', result=status)
+            if status == 409:
+                return False
+            return True if status == 200 else None
+        except Exception as e:
+            logger.error("Error reserving position %s: %s", position_id, e)
+            return None
+
+    async def release_position(self, position_id, telegram_id):
+        """Снять резерв клиента с позиции"""
+        try:
+            status, _ = await self._request(
+                'DELETE', f'/bot/positions/{position_id}/reservation', '/bot/positions/{id}/reservation',
+                json_body={'telegramId': telegram_id}
+            )
+            return status == 200
+        except Exception as e:
+            logger.error("Error releasing position %s: %s", position_id, e)
+            return False
+
+    async def get_or_create_client(self, telegram_id, username=None, first_name=None, last_name=None):
+        """Получить или создать клиента"""
+        try:
+            data = {
+                'username': username,
+                'firstName': first_name,
+                'lastName': last_name
+            }
+            status, client = await self._request(
+                'POST', f'/bot/clients/{telegram_id}', '/bot/clients/{id}', json_body=data
+            )
+            return client if status == 200 else None
+        except Exception as e:
+            logger.error("Error getting/creating client: %s", e)
+            return None
+    
+    async def bulk_upsert_clients(self, clients):
+        """Зарегистрировать/обновить пачку клиентов одним запросом"""
+        try:
+            status, data = await self._request('POST', '/bot/clients/bulk', json_body={'clients': clients})
+            if status == 200:
+                return data
+            logger.error("Bulk client upsert failed with status %s", status)
+            return None
+        except Exception as e:
+            logger.error("Error upserting clients: %s", e)
+            return None
+    
+    async def send_analytics(self, events):
+        """Отправить пачку событий воронки"""
+        try:
+            status, data = await self._request('POST', '/bot/analytics/events', json_body={'events': events})
+            if status == 200:
+                return data
+            logger.error("Analytics upload failed with status %s", status)
+            return None
+        except Exception as e:
+            logger.error("Error uploading analytics: %s", e)
+            return None
+
+    async def add_purchase(self, telegram_id, position_id, position_name=None, price=None, product_name=None):
+        """Добавить покупку клиенту.
+
+        None - сервер недоступен или ответил 5xx (исход неизвестен), при отказе
+        (4xx) - {'success': False, 'status': код, ...тело ответа}.
+        """
+        try:
+            data = {
+                'positionId': position_id,
+                'positionName': position_name,
+                'price': price,
+                'productName': product_name
+            }
+            status, result = await self._request(
+                'POST', f'/bot/clients/{telegram_id}/purchase', '/bot/clients/{id}/purchase', json_body=data
+            )
+            if status == 200:
+                return result
+            if status < 500:
+                return {**(result if isinstance(result, dict) else {}), 'success': False, 'status': status}
+            return None
+        except Exception as e:
+            logger.error("Error adding purchase: %s", e)
+            return None
+    
+    async def settle_payment(self, telegram_id, invoice_id, amount, position_id=None):
+        """Зачислить оплаченный инвойс и оформить заказ (идемпотентно по invoice_id)"""
+        try:
+            payload = {'invoiceId': invoice_id, 'amount': amount, 'positionId': position_id}
+            status, data = await self._request(
+                'POST', f'/bot/clients/{telegram_id}/payments', '/bot/clients/{id}/payments',
+                json_body=payload
+            )
+            if status == 200:
+                return data
+            logger.error("Settle payment %s failed with status %s", invoice_id, status)
+            return None
+        except Exception as e:
+            logger.error("Error settling payment %s: %s", invoice_id, e)
+            return None
+
+    async def get_client_purchases(self, telegram_id):
+        """Получить покупки клиента"""
+        try:
+            status, data = await self._request(
+                'GET', f'/bot/clients/{telegram_id}/purchases', '/bot/clients/{id}/purchases'
+            )
+            return data if status == 200 else None
+        except Exception as e:
+            logger.error("Error getting client purchases: %s", e)
+            return None
+
+    async def get_client_balance(self, telegram_id):
+        """Получить баланс клиента"""
+        try:
+            status, data = await self._request(
+                'GET', f'/bot/clients/{telegram_id}/balance', '/bot/clients/{id}/balance'
+            )
+            return data if status == 200 else None
+        except Exception as e:
+            logger.error("Error getting client balance: %s", e)
+            return None
+
+    async def get_reviews_stats(self):
+        """Получить статистику отзывов"""
+        try:
+            status, data = await self._request('GET', '/review/stats')
+            return data if status == 200 else None
+        except Exception as e:
+            logger.error("Error getting review stats: %s", e)
+            return None
+
+    async def get_reviews(self, since_id=None, before_id=None, limit=None):
+        """Получить отзывы: новые после since_id или страницу более ранних перед before_id"""
+        try:
+            params = {}
+            if since_id is not None: params['sinceId'] = since_id
+            if before_id is not None: params['beforeId'] = before_id
+            if limit: params['limit'] = limit
+
+            status, data = await self._request('GET', '/review', params=params or None)
+            return data if status == 200 else []
+        except Exception as e:
+            logger.error("Error getting reviews: %s", e)
+            return []
+
+api = BotAPI(NODE_API_URL)
+
+
+class CryptoBotAPI:
+    def __init__(self, token):
+        self.base_url = 'https://pay.crypt.bot/api'
+        self.token = token
+        self.session = None
+
+    async def get_session(self):
+        """Общая сессия: соединение с pay.crypt.bot переиспользуется (прогревается при запуске)"""
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=API_TIMEOUT))
+        return self.session
+
+    async def close(self):
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+
+    async def _post(self, endpoint, payload=None):
+        if not self.token:
+            logger.warning("Crypto Bot token is not configured")
+            return None
+
+        headers = {
+            'Content-Type': 'application/json',
+            'Crypto-Pay-API-Token': self.token
+        }
+
+        try:
+            with tracer.span('crypto_pay', method=endpoint):
+                session = await self.get_session()
+                async with session.post(f"{self.base_url}/{endpoint}", json=payload or {}, headers=headers) as resp:
+                    data = await resp.json()
+                    if data.get('ok'):
+                        return data.get('result')
+                    logger.error("Crypto Bot API error (%s): %s", endpoint, data)
+        except Exception as e:
+            logger.error("Error calling Crypto Bot API %s: %s", endpoint, e)
+        return None
+
+    async def get_me(self):
+        return await self._post('getMe')
+
+    async def get_balance(self):
+        return await self._post('getBalance')
+
+    async def get_exchange_rates(self):
+        return await self._post('getExchangeRates')
+
+    async def get_currencies(self):
+        return await self._post('getCurrencies')
+
+    async def create_invoice(self, asset, amount, description=None, payload=None, expires_in=INVOICE_TTL):
+        body = {
+            'asset': asset,
+            'amount': amount,
+        }
+        if expires_in:
+            body['expires_in'] = expires_in
+        if description:
+            body['description'] = description
+        if payload:
+            body['payload'] = payload
+        return await self._post('createInvoice', body)
+
+    async def get_invoice(self, invoice_id):
+        items = await self.get_invoices([invoice_id])
+        return items[0] if items else None
+
+    async def get_invoices(self, invoice_ids):
+        """Получить несколько инвойсов одним запросом"""
+        result = await self._post('getInvoices', {
+            'invoice_ids': ','.join(str(invoice_id) for invoice_id in invoice_ids),
+            'count': len(invoice_ids)
+        })
+        return result.get('items', []) if result else None
+
+
+crypto_bot = CryptoBotAPI(CRYPTO_BOT_TOKEN)
+
+
+class ExchangeRates:
+    """Снимок курсов и валют Crypto Pay, обновляемый в фоне.
+
+    Конвертация сумм выполняется локально, поэтому экраны с ценами не
+    обращаются к pay.crypt.bot и не упираются в его лимиты запросов.
+    """
+
+    DEFAULT_DECIMALS = 8
+
+    def __init__(self):
+        self.rates = {}
+        self.decimals = {}
+        self.updated_at = 0.0
+
+    async def refresh(self):
+        rates = await crypto_bot.get_exchange_rates()
+        if rates is None:
+            return False
+        if not self.decimals:
+            currencies = await crypto_bot.get_currencies()
+            self.decimals = {c['code']: int(c.get('decimals', self.DEFAULT_DECIMALS)) for c in currencies or []}
+        self.rates = {
+            item['source']: float(item['rate'])
+            for item in rates
+            if item.get('is_valid') and item.get('target') == RATES_FIAT and float(item.get('rate') or 0) > 0
+        }
+        self.updated_at = time.time()
+        return True
+
+    def convert(self, amount, asset, base=CRYPTO_PAYMENT_ASSET):
+        """Сумму в base перевести в asset. None, если курса нет или он устарел."""
+        if asset == base:
+            return float(amount)
+        if asset not in self.rates or base not in self.rates:
+            return None
+        if time.time() - self.updated_at > RATES_MAX_AGE:
+            return None
+        # Округляем вверх до точности актива, чтобы оплата покрывала сумму
+        decimals = min(self.decimals.get(asset, self.DEFAULT_DECIMALS), self.DEFAULT_DECIMALS)
+        scale = 10 ** decimals
+        value = float(amount) * self.rates[base] / self.rates[asset]
+        return int(value * scale + 0.999999) / scale
+
+
+exchange_rates = ExchangeRates()
+
+
+async def exchange_rates_refresher():
+    """Фоновое обновление курсов (только если пополнение возможно не только в базовом активе).
+
+    Первое обновление выполняется в warmup.
+    """
+    while True:
+        await asyncio.sleep(RATES_REFRESH)
+        try:
+            await exchange_rates.refresh()
+        except Exception as e:
+            logger.error("Error refreshing exchange rates: %s", e)
+
+
+SEARCH_TOKEN_RE = re.compile(r'[0-9a-zа-я]+')
+# Раскладка клавиатуры: запрос, набранный латиницей вместо кириллицы ("ghjlern" -> "продукт")
+LAYOUT_LAT = "qwertyuiop[]asdfghjkl;'zxcvbnm,.`"
+LAYOUT_CYR = "йцукенгшщзхъфывапролджэячсмитьбюё"
+LAYOUT_TO_CYR = str.maketrans(LAYOUT_LAT, LAYOUT_CYR)
+
+
+def normalize_search_text(text):
+    """Разбить текст на токены для поиска: нижний регистр, ё → е, без пунктуации."""
+    text = (text or '').lower().replace('ё', 'е')
+    return SEARCH_TOKEN_RE.findall(text)
+
+
+class CatalogSearchIndex:
+    """Инвертированный индекс по названиям и описаниям продуктов и позиций.
+
+    Строится целиком из /bot/categories-with-products, поэтому поиск по каждому
+    нажатию клавиши в inline-режиме не обращается к Node серверу.
+    """
+
+    NAME_WEIGHT = 3.0
+    DESCRIPTION_WEIGHT = 1.0
+    PREFIX_FACTOR = 0.6
+    MAX_PREFIX_EXPANSION = 64
+
+    def __init__(self):
+        self.docs = []
+        self.postings = {}
+        self.tokens = []
+        self.built_at = 0.0
+        self.source = None
+
+    def build(self, categories, cities=None):
+        """Перестроить индекс по дереву каталога."""
+        city_names = {}
+        district_names = {}
+        for city in cities or []:
+            city_names[city['id']] = city['name']
+            for district in city.get('districts', []):
+                district_names[district['id']] = district['name']
+
+        docs = []
+        postings = defaultdict(dict)
+
+        def add_doc(doc, name, description):
+            doc_id = len(docs)
+            docs.append(doc)
+            for token in normalize_search_text(name):
+                postings[token][doc_id] = postings[token].get(doc_id, 0) + self.NAME_WEIGHT
+            for token in normalize_search_text(description):
+                postings[token][doc_id] = postings[token].get(doc_id, 0) + self.DESCRIPTION_WEIGHT
+
+        for category in categories or []:
+            for product in category.get('products', []):
+                positions = product.get('positions', [])
+                add_doc({
+                    'kind': 'product',
+                    'id': product['id'],
+                    'title': product['name'],
+                    'description': product.get('description') or '',
+                    'category_id': category['id'],
+                    'img': product.get('img'),
+                    'city_ids': {p.get('cityId') for p in positions},
+                    'district_ids': {p.get('districtId') for p in positions},
+                    'positions_count': len(positions),
+                }, product['name'], product.get('description'))
+
+                for position in positions:
+                    location = city_names.get(position.get('cityId'), '')
+                    if district_names.get(position.get('districtId')):
+                        location += f", {district_names[position['districtId']]}"
+                    add_doc({
+                        'kind': 'position',
+                        'id': position['id'],
+                        'title': f"{position['name']} ({product['name']})",
+                        'description': location,
+                        'product_id': product['id'],
+                        'category_id': category['id'],
+                        'img': product.get('img'),
+                        'price': position.get('price'),
+                        'city_ids': {position.get('cityId')},
+                        'district_ids': {position.get('districtId')},
+                    }, f"{position['name']} {product['name']}", position.get('type'))
+
+        self.docs = docs
+        self.postings = dict(postings)
+        self.tokens = sorted(self.postings)
+        self.built_at = time.monotonic()
+        self.source = categories
+
+    def _match_token(self, token):
+        """Найти документы по токену: точное совпадение и совпадение по префиксу."""
+        scores = dict(self.postings.get(token, {}))
+        start = bisect.bisect_left(self.tokens, token)
+        expanded = 0
+        for candidate in self.tokens[start:]:
+            if not candidate.startswith(token) or expanded >= self.MAX_PREFIX_EXPANSION:
+                break
+            expanded += 1
+            if candidate == token:
+                continue
+            for doc_id, weight in self.postings[candidate].items():
+                prefix_score = weight * self.PREFIX_FACTOR
+                if prefix_score > scores.get(doc_id, 0):
+                    scores[doc_id] = prefix_score
+        return scores
+
+    def _search_tokens(self, tokens, city_id, district_id):
+        scores = None
+        for token in tokens:
+            matched = self._match_token(token)
+            if scores is None:
+                scores = matched
+            else:
+                scores = {doc_id: score + matched[doc_id] for doc_id, score in scores.items() if doc_id in matched}
+            if not scores:
+                return []
+
+        results = []
+        for doc_id, score in scores.items():
+            doc = self.docs[doc_id]
+            if city_id and int(city_id) not in doc['city_ids']:
+                continue
+            if district_id and int(district_id) not in doc['district_ids']:
+                continue
+            results.append((score, doc))
+
+        results.sort(key=lambda item: (-item[0], item[1]['kind'] != 'product', item[1]['title']))
+        return [doc for _, doc in results]
+
+    def search(self, query, city_id=None, district_id=None):
+        """Найти продукты и позиции, отсортированные по релевантности."""
+        tokens = normalize_search_text(query)
+        if not tokens:
+            return []
+        results = self._search_tokens(tokens, city_id, district_id)
+        if not results:
+            # Запрос набран в английской раскладке
+            swapped = normalize_search_text(query.lower().translate(LAYOUT_TO_CYR))
+            if swapped != tokens:
+                results = self._search_tokens(swapped, city_id, district_id)
+        return results
+
+
+search_index = CatalogSearchIndex()
+
+
+class ReviewsFeed:
+    """Последние отзывы в кольцевом буфере и инкрементально считаемая статистика.
+
+    Обновляется запросами "новые после last_id", поэтому стоимость открытия
+    отзывов не растет вместе с таблицей. Полная сверка со /review/stats
+    выполняется раз в REVIEWS_RESYNC секунд (учитывает удаленные отзывы).
+    """
+
+    FETCH_BATCH = 50
+
+    def __init__(self, size=REVIEWS_FEED_SIZE):
+        self.latest = deque(maxlen=size)
+        self.count = 0
+        self.rating_sum = 0
+        self.last_id = 0
+        self.loaded = False
+        self.refreshed_at = 0.0
+        self.resynced_at = 0.0
+        self._lock = asyncio.Lock()
+
+    @property
+    def average(self):
+        return round(self.rating_sum / self.count, 1) if self.count else 0
+
+    def _is_fresh(self):
+        return self.loaded and time.monotonic() - self.refreshed_at < REVIEWS_REFRESH
+
+    async def refresh(self, force=False):
+        """Подтянуть новые отзывы, если данные устарели."""
+        if not force and self._is_fresh():
+            return
+        async with self._lock:
+            if not force and self._is_fresh():
+                return
+            if not self.loaded or time.monotonic() - self.resynced_at > REVIEWS_RESYNC:
+                await self._resync()
+            else:
+                await self._fetch_new()
+
+    async def _resync(self):
+        stats = await api.get_reviews_stats()
+        reviews = await api.get_reviews(limit=self.latest.maxlen)
+        if stats is None:
+            return
+
+        self.latest.clear()
+        self.latest.extend(reversed(reviews))
+        self.count = int(stats.get('count', 0))
+        self.rating_sum = float(stats.get('sum') or float(stats.get('average') or 0) * self.count)
+        self.last_id = max([stats.get('lastId') or 0] + [r['id'] for r in reviews])
+        self.loaded = True
+        self.refreshed_at = self.resynced_at = time.monotonic()
+
+    async def _fetch_new(self):
+        while True:
+            batch = await api.get_reviews(since_id=self.last_id, limit=self.FETCH_BATCH)
+            for review in batch:
+                if review['id'] <= self.last_id:
+                    continue
+                self.latest.append(review)
+                self.count += 1
+                self.rating_sum += review.get('rating', 5)
+                self.last_id = review['id']
+            if len(batch) < self.FETCH_BATCH:
+                break
+        self.refreshed_at = time.monotonic()
+
+    async def get_page(self, before_id=None):
+        """Страница отзывов (от старых к новым) и признак, что есть более ранние."""
+        buffered = [r for r in self.latest if before_id is None or r['id'] < before_id]
+        if len(buffered) > REVIEWS_PAGE_SIZE:
+            return buffered[-REVIEWS_PAGE_SIZE:], True
+
+        # Буфер хранит самые новые отзывы подряд: все, что старше него, считаем по count
+        newer_count = sum(1 for r in self.latest if before_id is not None and r['id'] >= before_id)
+        if buffered and len(buffered) + newer_count >= self.count:
+            return buffered, False
+
+        # Листаем глубже буфера: страница с сервера, +1 отзыв чтобы узнать, есть ли еще
+        older = await api.get_reviews(
+            before_id=before_id if before_id is not None else self.last_id + 1,
+            limit=REVIEWS_PAGE_SIZE + 1
+        )
+        has_older = len(older) > REVIEWS_PAGE_SIZE
+        return list(reversed(older[:REVIEWS_PAGE_SIZE])), has_older
+
+
+reviews_feed = ReviewsFeed()
+
+
+async def refresh_search_index():
+    """Перестроить поисковый индекс по актуальным данным каталога."""
+    categories = await api.get_categories_with_products()
+    if categories is None:
+        return False
+    if categories is search_index.source:
+        # 304 Not Modified: каталог не менялся, перестраивать нечего
+        return True
+    cities = await api.get_cities_with_districts()
+    search_index.build(categories, cities)
+    logger.info("Search index rebuilt: %s docs, %s tokens", len(search_index.docs), len(search_index.tokens))
+    restock_alerts.on_catalog(search_index.docs)
+    return True
+
+
+async def search_index_refresher():
+    """Фоновое обновление поискового индекса (первое построение - в warmup)."""
+    while True:
+        await asyncio.sleep(SEARCH_INDEX_REFRESH)
+        try:
+            await refresh_search_index()
+        except Exception as e:
+            logger.error("Error refreshing search index: %s", e)
+
+
+class ChangeFeedSubscriber:
+    """Подписка на ленту изменений сервера (SSE GET /bot/changes).
+
+    Событие об изменении сущности устаривает только связанные ответы в кэше
+    BotAPI, поисковый индекс и ленту отзывов; клавиатуры собираются из этих
+    данных при следующей отрисовке. После обрыва подключение возобновляется
+    с последнего обработанного события (Last-Event-ID). Если сервер
+    перезапущен или пропущено больше событий, чем он хранит, приходит reset
+    и сбрасывается весь кэш.
+    """
+
+    INDEX_REFRESH_DELAY = 1.0
+
+    def __init__(self):
+        self.last_event_id = None
+        self.connected = False
+        self._index_refresh = None
+
+    def _refresh_search_index_soon(self):
+        """Перестроить индекс один раз на пачку событий (правки в админке идут сериями)."""
+        if self._index_refresh is not None and not self._index_refresh.done():
+            return
+
+        async def refresh():
+            await asyncio.sleep(self.INDEX_REFRESH_DELAY)
+            try:
+                await refresh_search_index()
+            except Exception as e:
+                logger.error("Error refreshing search index: %s", e)
+
+        self._index_refresh = asyncio.create_task(refresh())
+
+    def reset(self):
+        api.invalidate('')
+        reviews_feed.refreshed_at = reviews_feed.resynced_at = 0.0
+        self._refresh_search_index_soon()
+
+    def apply(self, event):
+        entity = event.get('entity')
+        metrics.inc('bot_change_feed_events_total', entity=entity)
+        if entity == 'content':
+            api.invalidate(*(f"/bot/content/{key}" for key in event.get('keys') or []))
+        elif entity in ('category', 'product', 'position'):
+            api.invalidate('/catalog/categories', '/bot/categories-with-products')
+            if entity == 'position' and event.get('action') == 'create':
+                restock_alerts.match(event.get('productId'), event.get('cityId'), event.get('districtId'))
+            if entity == 'product':
+                api.invalidate(f"/product/{event.get('id')}")
+            self._refresh_search_index_soon()
+        elif entity in ('city', 'district'):
+            api.invalidate('/bot/cities-with-districts')
+            self._refresh_search_index_soon()
+        elif entity == 'review':
+            reviews_feed.refreshed_at = 0.0
+            if event.get('action') == 'delete':
+                # Удаление не видно по "новым после last_id": нужна полная сверка
+                reviews_feed.resynced_at = 0.0
+
+    def dispatch(self, event_type, data, event_id):
+        if event_type == 'reset':
+            logger.info("Change feed reset: invalidating all cached catalog data")
+            self.reset()
+        elif event_type == 'change':
+            self.apply(json.loads(data))
+        if event_id:
+            self.last_event_id = event_id
+
+    async def _consume(self):
+        headers = {'Accept': 'text/event-stream'}
+        if self.last_event_id:
+            headers['Last-Event-ID'] = self.last_event_id
+        session = await api.get_session()
+        timeout = aiohttp.ClientTimeout(total=None, sock_read=CHANGE_FEED_READ_TIMEOUT)
+        async with session.get(f"{api.base_url}/bot/changes", headers=headers, timeout=timeout) as resp:
+            if resp.status != 200:
+                raise aiohttp.ClientResponseError(resp.request_info, resp.history, status=resp.status)
+            self.connected = True
+            metrics.set('bot_change_feed_connected', 1)
+            event_type, data, event_id = 'message', [], None
+            async for raw in resp.content:
+                line = raw.decode('utf-8').rstrip('\r\n')
+                if not line:
+                    if data or event_id:
+                        self.dispatch(event_type, '\n'.join(data), event_id)
+                    event_type, data, event_id = 'message', [], None
+                    continue
+                if line.startswith(':'):
+                    continue
+                field, _, value = line.partition(':')
+                value = value[1:] if value.startswith(' ') else value
+                if field == 'event':
+                    event_type = value
+                elif field == 'data':
+                    data.append(value)
+                elif field == 'id':
+                    event_id = value
+
+    async def run(self):
+        delay = 1.0
+        while True:
+            try:
+                await self._consume()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("Change feed disconnected: %s", e)
+            if self.connected:
+                self.connected = False
+                metrics.set('bot_change_feed_connected', 0)
+                delay = 1.0
+            metrics.inc('bot_change_feed_reconnects_total')
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, CHANGE_FEED_RECONNECT_MAX)
+
+
+change_feed = ChangeFeedSubscriber()
+
+
+class RestockAlerts:
+    """Подписки "сообщить о поступлении" на (продукт, город, район).
+
+    Индекс - dict по кортежу ключа, район 0 означает любой район города, так
+    что новая позиция сверяется только с двумя ключами, а не со всеми
+    подписками. Источники: события создания позиций из ленты изменений и
+    разница наличия между перестроениями поискового индекса (если событие
+    пропущено). Подписка одноразовая: сработав, удаляется. Уведомления уходят
+    через очередь с ограничением скорости, повтор по тому же продукту для
+    пользователя, пока уведомление в очереди, отбрасывается.
+    """
+
+    def __init__(self):
+        self.index = defaultdict(set)
+        self.available = None
+        self.queue = asyncio.Queue()
+        self.queued = set()
+
+    def load(self):
+        rows = get_storage().execute(
+            'SELECT user_id, product_id, city_id, district_id FROM restock_subscriptions'
+        ).fetchall()
+        for user_id, product_id, city_id, district_id in rows:
+            self.index[(product_id, city_id, district_id)].add(user_id)
+        return len(rows)
+
+    def is_subscribed(self, user_id, product_id, city_id, district_id=None):
+        return user_id in self.index.get((product_id, city_id, district_id or 0), ())
+
+    def subscribe(self, user_id, product_id, city_id, district_id=None):
+        key = (product_id, city_id, district_id or 0)
+        self.index[key].add(user_id)
+        storage = get_storage()
+        storage.execute(
+            'INSERT OR IGNORE INTO restock_subscriptions (user_id, product_id, city_id, district_id, created_at) '
+            'VALUES (?, ?, ?, ?, ?)', (user_id, *key, time.time())
+        )
+        storage.commit()
+        metrics.set('bot_restock_subscriptions', sum(len(users) for users in self.index.values()))
+
+    def unsubscribe(self, user_id, product_id, city_id, district_id=None):
+        key = (product_id, city_id, district_id or 0)
+        users = self.index.get(key)
+        if users:
+            users.discard(user_id)
+            if not users:
+                del self.index[key]
+        storage = get_storage()
+        storage.execute(
+            'DELETE FROM restock_subscriptions WHERE user_id = ? AND product_id = ? AND city_id = ? AND district_id = ?',
+            (user_id, *key)
+        )
+        storage.commit()
+
+    def drop_user(self, user_id):
+        """Пользователь заблокировал бота: удалить все его подписки."""
+        for key in [key for key, users in self.index.items() if user_id in users]:
+            self.unsubscribe(user_id, *key)
+
+    def match(self, product_id, city_id, district_id=None):
+        """Поставить в очередь уведомления подписчикам на появившуюся позицию."""
+        if not product_id or not city_id:
+            return 0
+        keys = [(product_id, city_id, 0)]
+        if district_id:
+            keys.append((product_id, city_id, district_id))
+        notified = 0
+        for key in keys:
+            for user_id in list(self.index.get(key, ())):
+                self.unsubscribe(user_id, *key)
+                if (user_id, product_id) in self.queued:
+                    continue
+                self.queued.add((user_id, product_id))
+                self.queue.put_nowait((user_id, product_id))
+                notified += 1
+        metrics.inc('bot_restock_matched_total', notified)
+        return notified
+
+    def on_catalog(self, docs):
+        """Сверить наличие после перестроения индекса: новые (продукт, город, район) - к подписчикам.
+
+        При первом вызове (после запуска) с наличием сверяются все загруженные
+        подписки: позиции, добавленные пока бот был остановлен, лента изменений
+        не повторяет. Позиция без района учитывается как район 0 (весь город).
+        """
+        available = {
+            (doc['product_id'], city_id, district_id or 0)
+            for doc in docs if doc['kind'] == 'position'
+            for city_id in doc['city_ids'] for district_id in doc['district_ids'] or (0,)
+        }
+        appeared = available if self.available is None else available - self.available
+        for product_id, city_id, district_id in appeared:
+            self.match(product_id, city_id, district_id)
+        self.available = available
+
+
+restock_alerts = RestockAlerts()
+
+
+async def restock_sender(bot):
+    """Рассылка уведомлений о поступлении не быстрее RESTOCK_SEND_RATE сообщений в секунду."""
+    interval = 1 / RESTOCK_SEND_RATE
+    while True:
+        user_id, product_id = await restock_alerts.queue.get()
+        try:
+            product = await api.get_product_by_id(product_id)
+            name = html.escape(product['name']) if product else "Товар"
+            await bot.send_message(
+                user_id,
+                f"🔔 <b>{name}</b> появился в наличии!",
+                parse_mode='HTML',
+                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("📦 Открыть", callback_data=f"prod_{product_id}")]])
+            )
+            metrics.inc('bot_restock_sent_total')
+        except RetryAfter as e:
+            # Превысили лимит Telegram: вернуть в очередь и подождать
+            restock_alerts.queue.put_nowait((user_id, product_id))
+            await asyncio.sleep(e.retry_after)
+            continue
+        except Forbidden:
+            restock_alerts.drop_user(user_id)
+        except Exception as e:
+            logger.error("Error sending restock alert to %s: %s", user_id, e)
+        restock_alerts.queued.discard((user_id, product_id))
+        await asyncio.sleep(interval)
+
+# Шаги воронки в порядке прохождения
+FUNNEL_STEPS = ('categories', 'products', 'product', 'position', 'checkout', 'purchase')
+
+
+class AnalyticsEvent:
+    """Событие воронки: шаг, пользователь и срез (город, категория, продукт, позиция)."""
+
+    __slots__ = ('name', 'user_id', 'ts', 'city_id', 'category_id', 'product_id', 'position_id', 'amount')
+
+    def __init__(self, name, user_id, ts, city_id=None, category_id=None, product_id=None,
+                 position_id=None, amount=None):
+        self.name = name
+        self.user_id = user_id
+        self.ts = ts
+        self.city_id = city_id
+        self.category_id = category_id
+        self.product_id = product_id
+        self.position_id = position_id
+        self.amount = amount
+
+    def as_dict(self):
+        return {
+            'event': self.name, 'telegramId': self.user_id, 'ts': self.ts, 'cityId': self.city_id,
+            'categoryId': self.category_id, 'productId': self.product_id,
+            'positionId': self.position_id, 'amount': self.amount
+        }
+
+
+class FunnelRollup:
+    """Дневная воронка, считаемая инкрементально по пачкам событий.
+
+    Для каждого шага хранятся множества дошедших пользователей: всего, по
+    городу и по категории. Конверсия шага - доля пользователей первого шага.
+    """
+
+    def __init__(self):
+        self.day = None
+        self.users = defaultdict(set)
+
+    def add(self, events):
+        for event in events:
+            day = time.strftime('%Y%m%d', time.gmtime(event.ts))
+            if day != self.day:
+                if self.day is not None and day < self.day:
+                    continue
+                self.day = day
+                self.users.clear()
+            self.users[(event.name, None)].add(event.user_id)
+            if event.city_id:
+                self.users[(event.name, ('city', event.city_id))].add(event.user_id)
+            if event.category_id:
+                self.users[(event.name, ('category', event.category_id))].add(event.user_id)
+
+    def funnel(self, dimension=None):
+        """[(шаг, пользователей, % от первого шага)]"""
+        first = len(self.users.get((FUNNEL_STEPS[0], dimension), ())) or None
+        rows = []
+        for step in FUNNEL_STEPS:
+            users = len(self.users.get((step, dimension), ()))
+            rows.append((step, users, users * 100 / first if first else 0.0))
+        return rows
+
+    def conversion_by(self, kind, top=5):
+        """Конверсия просмотров товаров в покупки по городам или категориям: [(id, просмотры, покупки)]"""
+        rows = [
+            (dimension[1], len(users), len(self.users.get(('purchase', dimension), ())))
+            for (step, dimension), users in self.users.items()
+            if step == 'products' and dimension and dimension[0] == kind
+        ]
+        return sorted(rows, key=lambda row: -row[1])[:top]
+
+
+class Analytics:
+    """Буфер событий воронки.
+
+    Обработчик платит только за append в список: запись на диск, отправка на
+    сервер и пересчет воронки выполняются при сбросе пачки (по размеру или
+    по таймеру), буфер при этом подменяется целиком. Файлы - JSONL по дням
+    в ANALYTICS_DIR.
+    """
+
+    def __init__(self):
+        self.buffer = []
+        self.rollup = FunnelRollup()
+        self._flush_scheduled = False
+
+    def track(self, name, user_id, **fields):
+        if not ANALYTICS_ENABLED:
+            return
+        if fields.get('city_id') is None:
+            session = user_states.get(user_id)
+            fields['city_id'] = session.city_id if session else None
+        self.buffer.append(AnalyticsEvent(name, user_id, time.time(), **fields))
+        if len(self.buffer) >= ANALYTICS_BATCH_SIZE and not self._flush_scheduled:
+            self._flush_scheduled = True
+            asyncio.ensure_future(self.flush())
+
+    @staticmethod
+    def _path(day):
+        return os.path.join(ANALYTICS_DIR, f"events-{day}.jsonl")
+
+    @classmethod
+    def _write(cls, rows):
+        os.makedirs(ANALYTICS_DIR, exist_ok=True)
+        by_day = defaultdict(list)
+        for row in rows:
+            by_day[time.strftime('%Y%m%d', time.gmtime(row['ts']))].append(json.dumps(row) + '\n')
+        for day, lines in by_day.items():
+            with open(cls._path(day), 'a', encoding='utf-8') as f:
+                f.writelines(lines)
+
+    async def flush(self):
+        self._flush_scheduled = False
+        batch, self.buffer = self.buffer, []
+        if not batch:
+            return 0
+        self.rollup.add(batch)
+        for event in batch:
+            metrics.inc('bot_analytics_events_total', event=event.name)
+        rows = [event.as_dict() for event in batch]
+        try:
+            await asyncio.to_thread(self._write, rows)
+        except OSError as e:
+            logger.error("Error writing analytics batch: %s", e)
+        if ANALYTICS_UPLOAD:
+            await api.send_analytics(rows)
+        return len(batch)
+
+    def load(self):
+        """Восстановить воронку текущего дня из JSONL (после перезапуска)."""
+        path = self._path(time.strftime('%Y%m%d', time.gmtime()))
+        if not os.path.exists(path):
+            return 0
+        events = []
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    row = json.loads(line)
+                except ValueError:
+                    continue
+                events.append(AnalyticsEvent(
+                    row['event'], row['telegramId'], row['ts'], row.get('cityId'), row.get('categoryId'),
+                    row.get('productId'), row.get('positionId'), row.get('amount')
+                ))
+        self.rollup.add(events)
+        return len(events)
+
+
+analytics = Analytics()
+
+
+async def analytics_flusher():
+    """Сброс событий воронки не реже раза в ANALYTICS_FLUSH_INTERVAL секунд."""
+    while True:
+        await asyncio.sleep(ANALYTICS_FLUSH_INTERVAL)
+        try:
+            await analytics.flush()
+        except Exception as e:
+            logger.error("Error flushing analytics: %s", e)
+
+
+MAIN_MENU = ReplyKeyboardMarkup([
+    [KeyboardButton("👤 Профиль"), KeyboardButton("🛒 Каталог")],
+    [KeyboardButton("📦 Заказы"), KeyboardButton("ℹ️ О нас"), KeyboardButton("❓ Помощь")],
+    [KeyboardButton("⭐ Отзывы")]
+], resize_keyboard=True)
+
+class UserSession:
+    """Состояние пользователя: компактный объект со __slots__ вместо dict."""
+
+    __slots__ = (
+        'user_id', 'city_id', 'district_id', 'current_category',
+        'current_product', 'current_page', 'awaiting_topup', 'payment_asset', 'last_seen'
+    )
+
+    # Поля, которые сохраняются в SQLite при вытеснении сессии и при остановке бота
+    PERSISTED_FIELDS = (
+        'city_id', 'district_id', 'current_category', 'current_product', 'current_page',
+        'awaiting_topup', 'payment_asset'
+    )
+
+    def __init__(self, user_id, city_id=None, district_id=None, current_category=None,
+                 current_product=None, current_page=1, awaiting_topup=None, payment_asset=None):
+        self.user_id = user_id
+        self.city_id = city_id
+        self.district_id = district_id
+        self.current_category = current_category
+        self.current_product = current_product
+        self.current_page = current_page
+        self.awaiting_topup = awaiting_topup
+        self.payment_asset = payment_asset or CRYPTO_PAYMENT_ASSET
+        self.last_seen = time.monotonic()
+
+    def as_row(self):
+        return (self.user_id,) + tuple(getattr(self, field) for field in self.PERSISTED_FIELDS)
+
+
+# Состояния активных пользователей; неактивные вытесняются в SQLite (sweep_idle_sessions)
+user_states = {}
+
+
+def get_user_state(user_id):
+    """Получить состояние пользователя: из памяти, из SQLite или новое."""
+    session = user_states.get(user_id)
+    if session is None:
+        row = get_storage().execute(
+            f"SELECT {', '.join(UserSession.PERSISTED_FIELDS)} FROM sessions WHERE user_id = ?", (user_id,)
+        ).fetchone()
+        session = UserSession(user_id, *row) if row else UserSession(user_id)
+        user_states[user_id] = session
+    session.last_seen = time.monotonic()
+    return session
+
+
+def persist_sessions(sessions):
+    """Сохранить сессии в SQLite."""
+    if not sessions:
+        return
+    storage = get_storage()
+    storage.executemany(
+        f"INSERT OR REPLACE INTO sessions (user_id, {', '.join(UserSession.PERSISTED_FIELDS)}) "
+        f"VALUES ({', '.join('?' * (len(UserSession.PERSISTED_FIELDS) + 1))})",
+        [session.as_row() for session in sessions]
+    )
+    storage.commit()
+
+
+def sweep_idle_sessions(idle_ttl=SESSION_IDLE_TTL):
+    """Вытеснить в SQLite сессии, неактивные дольше idle_ttl секунд."""
+    deadline = time.monotonic() - idle_ttl
+    idle = [s for s in user_states.values() if s.last_seen < deadline and s.awaiting_topup is None]
+    persist_sessions(idle)
+    for session in idle:
+        del user_states[session.user_id]
+    return len(idle)
+
+
+def session_memory_report():
+    """Байт на сессию: объект со __slots__ против прежнего dict-состояния."""
+    probe = UserSession(0, 1, 2, 3, 4, 5)
+    slots_size = sys.getsizeof(probe)
+    dict_size = sys.getsizeof({
+        'city_id': 1, 'district_id': 2, 'current_category': '3',
+        'current_product': '4', 'current_page': 5, 'awaiting_topup': None
+    }) + sys.getsizeof('3') + sys.getsizeof('4')
+    return {
+        'sessions': len(user_states),
+        'bytes_per_session': slots_size,
+        'bytes_per_session_dict': dict_size,
+        'total_bytes': slots_size * len(user_states),
+    }
+
+
+async def session_sweeper():
+    """Фоновое вытеснение неактивных сессий и отчет о памяти."""
+    while True:
+        await asyncio.sleep(SESSION_SWEEP_INTERVAL)
+        try:
+            evicted = sweep_idle_sessions()
+            balance_ledger.evict_idle()
+            report = session_memory_report()
+            metrics.set('bot_sessions_in_memory', report['sessions'])
+            metrics.inc('bot_sessions_evicted_total', evicted)
+            if evicted:
+                logger.info(
+                    "Evicted %s idle sessions; in memory: %s, %s bytes/session (dict state was %s)",
+                    evicted, report['sessions'], report['bytes_per_session'], report['bytes_per_session_dict']
+                )
+        except Exception as e:
+            logger.error("Error sweeping sessions: %s", e)
+
+
+def parse_invoice_expiration(invoice):
+    """Время истечения инвойса Crypto Pay (unix time) или None."""
+    expiration_date = invoice.get('expiration_date')
+    if not expiration_date:
+        return None
+    try:
+        return datetime.fromisoformat(expiration_date.replace('Z', '+00:00')).timestamp()
+    except ValueError:
+        return None
+
+
+class PendingInvoices:
+    """Неоплаченные инвойсы: индекс по invoice_id и вторичный индекс по пользователю.
+
+    Хранятся только ожидающие оплаты инвойсы (не более per_user_limit на
+    пользователя) с временем истечения из Crypto Pay. Оплаченные удаляются
+    после зачисления, истекшие - фоновой очисткой (purge_expired). Индекс
+    дублируется в SQLite, чтобы оплата после перезапуска бота не терялась.
+    """
+
+    def __init__(self, per_user_limit=MAX_OPEN_INVOICES):
+        self.per_user_limit = per_user_limit
+        self.by_id = {}
+        self.by_user = defaultdict(list)
+        self.expiry_heap = []
+
+    def load(self):
+        """Восстановить индекс из SQLite."""
+        rows = get_storage().execute(
+            'SELECT invoice_id, user_id, amount, asset, expires_at, position_id '
+            'FROM pending_invoices ORDER BY invoice_id'
+        ).fetchall()
+        for row in rows:
+            self._index(*row)
+        return len(rows)
+
+    def can_add(self, user_id):
+        return len(self.by_user.get(user_id, [])) < self.per_user_limit
+
+    def _index(self, invoice_id, user_id, amount, asset, expires_at, position_id=None):
+        self.by_id[invoice_id] = {
+            'invoice_id': invoice_id,
+            'user_id': user_id,
+            'amount': amount,
+            'asset': asset,
+            'expires_at': expires_at,
+            'position_id': position_id
+        }
+        self.by_user[user_id].append(invoice_id)
+        if expires_at:
+            heapq.heappush(self.expiry_heap, (expires_at, invoice_id))
+        return self.by_id[invoice_id]
+
+    def add(self, user_id, invoice, credit_amount=None, position_id=None):
+        """Добавить инвойс Crypto Pay. None, если у пользователя уже максимум открытых.
+
+        credit_amount - сколько зачислить на баланс (в CRYPTO_PAYMENT_ASSET) после
+        оплаты; по умолчанию сумма инвойса. position_id - заказ, который
+        оформляется сразу после оплаты.
+        """
+        if not self.can_add(user_id):
+            return None
+        expires_at = parse_invoice_expiration(invoice) or (time.time() + INVOICE_TTL)
+        amount = float(invoice['amount']) if credit_amount is None else float(credit_amount)
+        record = self._index(
+            int(invoice['invoice_id']), user_id, amount, invoice['asset'], expires_at, position_id
+        )
+        money_journal.record(
+            'invoice', user_id=user_id, invoice_id=record['invoice_id'], amount=record['amount'],
+            asset=record['asset'], position_id=position_id
+        )
+        storage = get_storage()
+        storage.execute(
+            'INSERT OR REPLACE INTO pending_invoices (invoice_id, user_id, amount, asset, expires_at, position_id) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            (record['invoice_id'], user_id, record['amount'], record['asset'], expires_at, position_id)
+        )
+        storage.commit()
+        return record
+
+    def get(self, invoice_id, user_id=None):
+        """Инвойс по id (только если принадлежит user_id, когда он указан)."""
+        invoice = self.by_id.get(invoice_id)
+        if invoice and (user_id is None or invoice['user_id'] == user_id):
+            return invoice
+        return None
+
+    def for_user(self, user_id):
+        return [self.by_id[invoice_id] for invoice_id in self.by_user.get(user_id, [])]
+
+    def remove(self, invoice_id):
+        invoice = self.by_id.pop(invoice_id, None)
+        if invoice:
+            user_invoices = self.by_user.get(invoice['user_id'], [])
+            if invoice_id in user_invoices:
+                user_invoices.remove(invoice_id)
+            if not user_invoices:
+                self.by_user.pop(invoice['user_id'], None)
+            storage = get_storage()
+            storage.execute('DELETE FROM pending_invoices WHERE invoice_id = ?', (invoice_id,))
+            storage.commit()
+        return invoice
+
+    def pop_expired(self, now=None):
+        """id инвойсов, срок которых истек; стоимость зависит только от их числа.
+
+        Удалять их нужно после сверки статуса с Crypto Pay: инвойс мог быть
+        оплачен перед самым истечением и еще не зачислен.
+        """
+        now = now or time.time()
+        expired = []
+        while self.expiry_heap and self.expiry_heap[0][0] <= now:
+            expires_at, invoice_id = heapq.heappop(self.expiry_heap)
+            invoice = self.by_id.get(invoice_id)
+            if invoice and invoice['expires_at'] == expires_at:
+                expired.append(invoice_id)
+        return expired
+
+
+pending_invoices = PendingInvoices()
+
+
+async def invoice_sweeper():
+    """Фоновая очистка индекса от истекших инвойсов (после сверки статуса с Crypto Pay)."""
+    while True:
+        await asyncio.sleep(INVOICE_SWEEP_INTERVAL)
+        try:
+            purged = 0
+            expired_ids = pending_invoices.pop_expired()
+            for i in range(0, len(expired_ids), 100):
+                batch = expired_ids[i:i + 100]
+                items = await crypto_bot.get_invoices(batch)
+                if items is None:
+                    # Crypto Pay недоступен: проверим в следующий раз
+                    for invoice_id in batch:
+                        invoice = pending_invoices.get(invoice_id)
+                        if invoice is None:
+                            # Зачислен, пока ждали ответа Crypto Pay
+                            continue
+                        heapq.heappush(pending_invoices.expiry_heap, (invoice['expires_at'], invoice_id))
+                    continue
+                statuses = {int(item['invoice_id']): item.get('status') for item in items}
+                for invoice_id in batch:
+                    # Оплаченные остаются в индексе до зачисления
+                    if statuses.get(invoice_id) != 'paid':
+                        invoice = pending_invoices.remove(invoice_id)
+                        if invoice and invoice.get('position_id'):
+                            await api.release_position(invoice['position_id'], invoice['user_id'])
+                        purged += 1
+            metrics.set('bot_pending_invoices', len(pending_invoices.by_id))
+            if purged:
+                logger.info("Purged %s expired invoices, pending: %s", purged, len(pending_invoices.by_id))
+        except Exception as e:
+            logger.error("Error sweeping invoices: %s", e)
+
+
+def read_journal(paths):
+    """Записи журнала из файлов по порядку; оборванная при сбое последняя строка пропускается."""
+    for path in paths:
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue
+
+
+def journal_files(journal_dir=JOURNAL_DIR):
+    """Архивы журнала (money-<время>-<seq>.jsonl) и текущий файл money.jsonl - от старых к новым."""
+    if not os.path.isdir(journal_dir):
+        return []
+    archives = sorted(name for name in os.listdir(journal_dir) if name.startswith('money-') and name.endswith('.jsonl'))
+    current = ['money.jsonl'] if os.path.exists(os.path.join(journal_dir, 'money.jsonl')) else []
+    return [os.path.join(journal_dir, name) for name in archives + current]
+
+
+class MoneyJournal:
+    """Журнал денежных операций (write-ahead, JSONL только на дозапись).
+
+    Перед зачислением инвойса (credit) и покупкой с баланса (purchase) запись
+    попадает на диск, ответ сервера подтверждается записью ack. Записи,
+    пришедшие за JOURNAL_COMMIT_DELAY и пока идет fsync, пишутся одним
+    fsync (group commit). Неподтвержденные записи повторяются при запуске и
+    периодически: зачисление - через идемпотентный settle_payment, покупка
+    только проверяется по списку покупок клиента (повтор списал бы деньги
+    дважды). Сверка с балансами сервера - reconcile.py.
+
+    Когда файл превышает JOURNAL_ROTATE_BYTES, он уходит в архив, а новый
+    начинается с отметки rotate (номер последней записи) и копий
+    неподтвержденных записей. Поэтому при запуске читается только текущий
+    файл, архивы нужны лишь для сверки и хранятся последние JOURNAL_ARCHIVES.
+    """
+
+    ACKED_TYPES = ('credit', 'purchase')
+    # Допуск на расхождение часов бота и сервера при сверке покупок по дате
+    CLOCK_SKEW = 5
+
+    def __init__(self, journal_dir=JOURNAL_DIR):
+        self.journal_dir = journal_dir
+        self.path = os.path.join(journal_dir, 'money.jsonl')
+        self.seq = 0
+        self.unacked = OrderedDict()
+        self.credit_seq = {}
+        self._pending = []
+        self._committer = None
+        self._file = None
+        # Размер нового файла сразу после ротации (отметка и перенесенные записи)
+        self._base_size = 0
+
+    def load(self):
+        """Восстановить номер последней записи и неподтвержденные записи из текущего файла."""
+        tmp = self.path + '.tmp'
+        if os.path.exists(tmp) and not os.path.exists(self.path):
+            # Сбой между переименованиями при ротации: новый файл уже записан целиком
+            os.replace(tmp, self.path)
+        if not os.path.exists(self.path):
+            return 0
+        for entry in read_journal([self.path]):
+            self.seq = max(self.seq, entry.get('seq', 0))
+            if entry['type'] in self.ACKED_TYPES:
+                self._track(entry)
+            elif entry['type'] == 'ack':
+                self._untrack(entry['ref'])
+        if os.path.getsize(self.path) > JOURNAL_ROTATE_BYTES:
+            self._rotate(list(self.unacked.values()), self.seq)
+        metrics.set('bot_journal_unacked', len(self.unacked))
+        return len(self.unacked)
+
+    def _rotate(self, carried, seq):
+        """Текущий файл - в архив; новый начинается с отметки seq и неподтвержденных записей carried."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            f.write(json.dumps({'seq': seq, 'ts': time.time(), 'type': 'rotate'}) + '\n')
+            f.writelines(json.dumps(entry) + '\n' for entry in carried)
+            f.flush()
+            os.fsync(f.fileno())
+            self._base_size = f.tell()
+        os.replace(self.path, os.path.join(self.journal_dir, f"money-{time.strftime('%Y%m%d%H%M%S')}-{seq:012d}.jsonl"))
+        os.replace(tmp, self.path)
+        archives = journal_files(self.journal_dir)[:-1]
+        for path in archives[:max(len(archives) - JOURNAL_ARCHIVES, 0)]:
+            os.remove(path)
+
+    def _track(self, entry):
+        self.unacked[entry['seq']] = entry
+        if entry['type'] == 'credit':
+            self.credit_seq[entry['invoice_id']] = entry['seq']
+
+    def _untrack(self, seq):
+        entry = self.unacked.pop(seq, None)
+        if entry and entry['type'] == 'credit':
+            self.credit_seq.pop(entry['invoice_id'], None)
+        return entry
+
+    def _write(self, lines):
+        if self._file is None:
+            os.makedirs(self.journal_dir, exist_ok=True)
+            self._file = open(self.path, 'a', encoding='utf-8')
+        self._file.writelines(lines)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    async def _commit_loop(self):
+        await asyncio.sleep(JOURNAL_COMMIT_DELAY)
+        while self._pending:
+            batch, self._pending = self._pending, []
+            started = time.perf_counter()
+            error = None
+            try:
+                await asyncio.to_thread(self._write, [line for _, line, _ in batch])
+            except OSError as e:
+                logger.error("Error writing money journal: %s", e)
+                error = e
+            metrics.inc('bot_journal_commits_total')
+            metrics.inc('bot_journal_entries_total', len(batch))
+            metrics.inc('bot_journal_fsync_seconds_total', time.perf_counter() - started)
+            for _, _, future in batch:
+                if future.done():
+                    continue
+                if error:
+                    future.set_exception(error)
+                else:
+                    future.set_result(None)
+            if error is None and os.fstat(self._file.fileno()).st_size - self._base_size > JOURNAL_ROTATE_BYTES:
+                # Переносятся только уже записанные записи: остальные ждут в _pending
+                written = batch[-1][0]
+                carried = [entry for entry in self.unacked.values() if entry['seq'] <= written]
+                try:
+                    await asyncio.to_thread(self._rotate, carried, written)
+                    metrics.inc('bot_journal_rotations_total')
+                except OSError as e:
+                    logger.error("Error rotating money journal: %s", e)
+
+    def record(self, entry_type, **fields):
+        """Поставить запись в очередь на запись; future завершается после fsync."""
+        self.seq += 1
+        entry = {'seq': self.seq, 'ts': time.time(), 'type': entry_type, **fields}
+        if entry_type in self.ACKED_TYPES:
+            self._track(entry)
+        future = asyncio.get_running_loop().create_future()
+        # Подтверждение ack никто не ждет: исключение не должно попадать в лог как необработанное
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self._pending.append((entry['seq'], json.dumps(entry) + '\n', future))
+        if self._committer is None or self._committer.done():
+            self._committer = asyncio.ensure_future(self._commit_loop())
+        metrics.set('bot_journal_unacked', len(self.unacked))
+        return entry, future
+
+    async def append(self, entry_type, **fields):
+        """Записать и дождаться fsync. Возвращает номер записи.
+
+        Ошибка диска не останавливает платеж: она пишется в лог, а запись
+        остается в памяти до подтверждения.
+        """
+        entry, future = self.record(entry_type, **fields)
+        try:
+            await future
+        except OSError:
+            pass
+        return entry['seq']
+
+    async def credit(self, record):
+        """Намерение зачислить оплаченный инвойс (одна запись на инвойс до подтверждения)."""
+        seq = self.credit_seq.get(record['invoice_id'])
+        if seq is not None:
+            return seq
+        return await self.append(
+            'credit', user_id=record['user_id'], invoice_id=record['invoice_id'],
+            amount=record['amount'], asset=record['asset'], position_id=record.get('position_id')
+        )
+
+    def ack(self, seq, result, **fields):
+        if self._untrack(seq) is not None:
+            self.record('ack', ref=seq, result=result, **fields)
+
+    async def close(self):
+        if self._committer is not None:
+            await self._committer
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+money_journal = MoneyJournal()
+
+
+async def settle_invoice(record):
+    """Зачислить оплаченный инвойс и оформить привязанный к нему заказ.
+
+    Сервер обрабатывает invoice_id идемпотентно, поэтому одновременная проверка
+    кнопкой и payment_poller зачислят деньги один раз. None - сервер недоступен,
+    инвойс остается в индексе до следующей попытки.
+    """
+    user_id = record['user_id']
+    seq = await money_journal.credit(record)
+    version = balance_ledger.version(user_id)
+    result = await api.settle_payment(user_id, record['invoice_id'], record['amount'], record.get('position_id'))
+    if result is None:
+        return None
+    money_journal.ack(seq, result.get('status'), balance=result.get('balance'), duplicate=bool(result.get('duplicate')))
+    pending_invoices.remove(record['invoice_id'])
+    balance_ledger.commit(user_id, result.get('balance'), expected_version=version)
+    if result.get('status') == 'completed' and not result.get('duplicate'):
+        purchase = result.get('purchase') or {}
+        session = user_states.get(user_id)
+        analytics.track(
+            'purchase', user_id, category_id=session.current_category if session else None,
+            position_id=record.get('position_id'), amount=purchase.get('price')
+        )
+    return result
+
+
+def settlement_message(record, result):
+    """Текст и клавиатура для пользователя после зачисления инвойса."""
+    balance = f"Текущий баланс: <b>{format_amount(result.get('balance'))} {CRYPTO_PAYMENT_ASSET}</b>"
+    if result.get('status') == 'completed':
+        purchase = result.get('purchase') or {}
+        text = (
+            f"✅ <b>Оплата получена, заказ оформлен!</b>\n\n"
+            f"Продукт: {purchase.get('productName', 'Неизвестно')}\n"
+            f"Позиция: {purchase.get('positionName', 'Неизвестно')}\n"
+            f"Цена: {purchase.get('price')} $\n\n"
+            f"{balance}"
+        )
+        buttons = [[InlineKeyboardButton("Вернуться в каталог", callback_data="back_to_categories")]]
+    elif result.get('status') == 'order_failed':
+        text = (
+            f"✅ Оплата получена, <b>{format_amount(record['amount'])} {CRYPTO_PAYMENT_ASSET}</b> зачислено на баланс.\n"
+            f"❌ Заказ оформить не удалось: позиция больше недоступна или изменилась ее цена.\n\n"
+            f"{balance}"
+        )
+        buttons = [[InlineKeyboardButton("Вернуться в каталог", callback_data="back_to_categories")]]
+    else:
+        text = (
+            f"✅ Оплата подтверждена!\n"
+            f"Баланс пополнен на <b>{format_amount(record['amount'])} {CRYPTO_PAYMENT_ASSET}</b>.\n"
+            f"{balance}"
+        )
+        buttons = [[InlineKeyboardButton("Вернуться к балансу", callback_data="balance_menu")]]
+    return text, InlineKeyboardMarkup(buttons)
+
+
+async def payment_poller(bot):
+    """Фоновая проверка открытых инвойсов: оплаченные зачисляются без участия пользователя."""
+    while True:
+        await asyncio.sleep(PAYMENT_POLL_INTERVAL)
+        try:
+            invoice_ids = list(pending_invoices.by_id)
+            for i in range(0, len(invoice_ids), 100):
+                items = await crypto_bot.get_invoices(invoice_ids[i:i + 100])
+                if items is None:
+                    break
+                for item in items:
+                    record = pending_invoices.get(int(item['invoice_id']))
+                    if item.get('status') != 'paid' or not record:
+                        continue
+                    result = await settle_invoice(record)
+                    # duplicate: инвойс уже зачислен (например, по кнопке «Проверить оплату»)
+                    if result is None or result.get('duplicate'):
+                        continue
+                    await notify_settlement(bot, record, result)
+        except Exception as e:
+            logger.error("Error polling payments: %s", e)
+
+
+async def notify_settlement(bot, record, result):
+    text, markup = settlement_message(record, result)
+    try:
+        await bot.send_message(record['user_id'], text, parse_mode='HTML', reply_markup=markup)
+    except Exception as e:
+        logger.warning("Failed to notify %s about invoice %s: %s", record['user_id'], record['invoice_id'], e)
+
+
+async def replay_journal(bot, min_age=0):
+    """Повторить неподтвержденные записи журнала старше min_age секунд."""
+    replayed = 0
+    for entry in list(money_journal.unacked.values()):
+        if time.time() - entry['ts'] < min_age or entry['seq'] not in money_journal.unacked:
+            continue
+        if entry['type'] == 'credit':
+            record = pending_invoices.get(entry['invoice_id']) or {
+                'invoice_id': entry['invoice_id'], 'user_id': entry['user_id'], 'amount': entry['amount'],
+                'asset': entry['asset'], 'position_id': entry.get('position_id')
+            }
+            result = await settle_invoice(record)
+            if result is None:
+                continue
+            if not result.get('duplicate'):
+                await notify_settlement(bot, record, result)
+        else:
+            data = await api.get_client_purchases(entry['user_id'])
+            if data is None:
+                continue
+            # Позицию можно купить повторно: учитываются только покупки не раньше записи
+            since = entry['ts'] - MoneyJournal.CLOCK_SKEW
+            found = any(
+                p.get('positionId') == entry['position_id'] and purchase_timestamp(p) >= since
+                for p in data.get('purchases', [])
+            )
+            money_journal.ack(entry['seq'], 'completed' if found else 'not_found')
+        replayed += 1
+    metrics.inc('bot_journal_replayed_total', replayed)
+    return replayed
+
+
+def purchase_timestamp(purchase):
+    """purchaseDate покупки сервера (ISO) в unix time; 0, если даты нет."""
+    try:
+        return datetime.fromisoformat(purchase['purchaseDate'].replace('Z', '+00:00')).timestamp()
+    except (KeyError, AttributeError, ValueError):
+        return 0.0
+
+
+async def journal_replayer(bot):
+    """Периодический повтор записей, не подтвержденных сервером (сеть, 5xx, сбой между шагами)."""
+    while True:
+        await asyncio.sleep(JOURNAL_REPLAY_INTERVAL)
+        try:
+            await replay_journal(bot, min_age=JOURNAL_REPLAY_INTERVAL)
+        except Exception as e:
+            logger.error("Error replaying money journal: %s", e)
+
 
-# логи
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
-logger = logging.getLogger(__name__)
+def format_amount(value):
+    return f"{float(value):.2f}"
 
-user_wallets = defaultdict(lambda: {
-    'balance': 0.0,
-    'invoices': {},
-})
 
+class BalanceLedger:
+    """Локальный кэш балансов клиентов с версиями.
 
-async def get_public_base_url():
-    """Получить публичный URL (ngrok или указанный через переменные окружения)."""
-    global PUBLIC_BASE_URL
+    Балансы из ответов add_purchase и settle_payment записываются сразу
+    (write-through), сервер опрашивается только если запись старше
+    BALANCE_TTL секунд или была инвалидирована платежом. Каждая запись увеличивает версию: ответ,
+    полученный на основе устаревшей версии, не перетирает более новый баланс.
+    """
 
-    if PUBLIC_BASE_URL:
-        return PUBLIC_BASE_URL.rstrip('/')
+    def __init__(self, ttl=BALANCE_TTL):
+        self.ttl = ttl
+        self.entries = {}
+        self._inflight = {}
 
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(NGROK_API_URL) as resp:
-                if resp.status == 200:
-                    data = await resp.json()
-                    for tunnel in data.get('tunnels', []):
-                        public_url = tunnel.get('public_url')
-                        if public_url:
-                            PUBLIC_BASE_URL = public_url.rstrip('/')
-                            return PUBLIC_BASE_URL
-    except Exception as e:
-        logger.error(f"Error resolving ngrok url: {e}")
+    def _entry(self, user_id):
+        return self.entries.setdefault(user_id, {'balance': 0.0, 'version': 0, 'fetched_at': 0.0})
 
-    fallback_url = NODE_API_URL.split('/api')[0] if '/api' in NODE_API_URL else NODE_API_URL
-    PUBLIC_BASE_URL = fallback_url.rstrip('/')
-    return PUBLIC_BASE_URL
+    def peek(self, user_id):
+        """Последний известный баланс без обращения к серверу."""
+        return self._entry(user_id)['balance']
 
+    def version(self, user_id):
+        return self._entry(user_id)['version']
 
-async def build_public_media_url(path: str) -> str:
-    base_url = await get_public_base_url()
-    return f"{base_url}/{path.lstrip('/')}"
+    async def get(self, user_id, max_age=None):
+        """Баланс клиента; запрос к серверу только если запись устарела."""
+        entry = self._entry(user_id)
+        max_age = self.ttl if max_age is None else max_age
+        if time.monotonic() - entry['fetched_at'] < max_age:
+            return entry['balance']
 
-class BotAPI:
-    def __init__(self, base_url):
-        self.base_url = base_url
-    
-    async def get_bot_content(self, content_key):
-        """Получить контент для бота"""
-        try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(f'{self.base_url}/bot/content/{content_key}') as resp:
-                    if resp.status == 200:
-                        return await resp.json()
-                    return None
-        except Exception as e:
-            logger.error(f"Error getting content {content_key}: {e}")
-            return None
-    
-    async def get_catalog_categories(self):
-        """Получить категории товаров"""
-        try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(f'{self.base_url}/catalog/categories') as resp:
-                    if resp.status == 200:
-                        return await resp.json()
-                    return []
-        except Exception as e:
-            logger.error(f"Error getting categories: {e}")
-            return []
-    
-    async def get_products_by_category(self, category_id, city_id=None, district_id=None, page=1, limit=7):
-        """Получить товары по категории с пагинацией"""
-        try:
-            params = {'page': page, 'limit': limit}
-            if city_id: params['cityId'] = city_id
-            if district_id: params['districtId'] = district_id
-            
-            async with aiohttp.ClientSession() as session:
-                async with session.get(f'{self.base_url}/catalog/categories/{category_id}/products', params=params) as resp:
-                    if resp.status == 200:
-                        products = await resp.json()
-                        if isinstance(products, dict) and 'rows' in products:
-                            return products['rows'], products.get('count', 0)
-                        return products, len(products)
-                    return [], 0
-        except Exception as e:
-            logger.error(f"Error getting products for category {category_id}: {e}")
-            return [], 0
-    
-    async def get_positions_by_product(self, product_id, city_id=None, district_id=None):
-        """Получить позиции по продукту"""
-        try:
-            params = {}
-            if city_id: params['cityId'] = city_id
-            if district_id: params['districtId'] = district_id
-            
-            async with aiohttp.ClientSession() as session:
-                async with session.get(f'{self.base_url}/catalog/products/{product_id}/positions', params=params) as resp:
-                    if resp.status == 200:
-                        data = await resp.json()
-                        return data.get('rows', data) if isinstance(data, dict) else data
-                    return []
-        except Exception as e:
-            logger.error(f"Error getting positions for product {product_id}: {e}")
-            return []
-    
-    async def get_cities_with_districts(self):
-        """Получить города с районами"""
-        try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(f'{self.base_url}/bot/cities-with-districts') as resp:
-                    if resp.status == 200:
-                        return await resp.json()
-                    return []
-        except Exception as e:
-            logger.error(f"Error getting cities: {e}")
-            return []
+        # Параллельные чтения одного пользователя ждут один запрос
+        task = self._inflight.get(user_id)
+        if task is None:
+            task = asyncio.ensure_future(self._fetch(user_id, entry['version']))
+            self._inflight[user_id] = task
+            task.add_done_callback(lambda _: self._inflight.pop(user_id, None))
+        await asyncio.shield(task)
+        return entry['balance']
 
-    async def get_available_districts(self, category_id, city_id):
-        """Получить доступные районы для категории"""
-        try:
-            params = {'cityId': city_id}
-            async with aiohttp.ClientSession() as session:
-                async with session.get(f'{self.base_url}/categories/{category_id}/districts', params=params) as resp:
-                    if resp.status == 200:
-                        return await resp.json()
-                    return []
-        except Exception as e:
-            logger.error(f"Error getting available districts: {e}")
-            return []
-    
-    async def get_product_by_id(self, product_id):
-        """Получить информацию о продукте по ID"""
+    async def _fetch(self, user_id, version):
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(f'{self.base_url}/product/{product_id}') as resp:
-                    if resp.status == 200:
-                        return await resp.json()
-                    return None
+            balance_data = await api.get_client_balance(user_id)
+            if balance_data and 'balance' in balance_data:
+                self.commit(user_id, balance_data['balance'], expected_version=version)
         except Exception as e:
-            logger.error(f"Error getting product {product_id}: {e}")
-            return None
-    
-    async def get_position_by_id(self, position_id):
-        """Получить информацию о позиции по ID"""
-        try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(f'{self.base_url}/position/{position_id}') as resp:
-                    if resp.status == 200:
-                        return await resp.json()
-                    return None
-        except Exception as e:
-            logger.error(f"Error getting position {position_id}: {e}")
-            return None
-        
-    async def get_or_create_client(self, telegram_id, username=None, first_name=None, last_name=None):
-        """Получить или создать клиента"""
-        try:
-            data = {
-                'username': username,
-                'firstName': first_name,
-                'lastName': last_name
-            }
-            async with aiohttp.ClientSession() as session:
-                async with session.post(f'{self.base_url}/bot/clients/{telegram_id}', json=data) as resp:
-                    if resp.status == 200:
-                        return await resp.json()
-                    return None
-        except Exception as e:
-            logger.error(f"Error getting/creating client: {e}")
-            return None
-    
-    async def add_purchase(self, telegram_id, position_id, position_name=None, price=None, product_name=None):
-        """Добавить покупку клиенту"""
-        try:
-            data = {
-                'positionId': position_id,
-                'positionName': position_name,
-                'price': price,
-                'productName': product_name
-            }
-            async with aiohttp.ClientSession() as session:
-                async with session.post(f'{self.base_url}/bot/clients/{telegram_id}/purchase', json=data) as resp:
-                    if resp.status == 200:
-                        return await resp.json()
-                    return None
-        except Exception as e:
-            logger.error(f"Error adding purchase: {e}")
-            return None
-    
-    async def get_client_purchases(self, telegram_id):
-        """Получить покупки клиента"""
-        try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(f'{self.base_url}/bot/clients/{telegram_id}/purchases') as resp:
-                    if resp.status == 200:
-                        return await resp.json()
-                    return None
-        except Exception as e:
-            logger.error(f"Error getting client purchases: {e}")
-            return None
+            logger.error("Failed to sync balance for %s: %s", user_id, e)
 
-    async def get_client_balance(self, telegram_id):
-        """Получить баланс клиента"""
-        try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(f'{self.base_url}/bot/clients/{telegram_id}/balance') as resp:
-                    if resp.status == 200:
-                        return await resp.json()
-                    return None
-        except Exception as e:
-            logger.error(f"Error getting client balance: {e}")
-            return None
+    def commit(self, user_id, balance, expected_version=None):
+        """Записать баланс, полученный от сервера.
 
-    async def adjust_balance(self, telegram_id, amount):
-        """Изменить баланс клиента"""
-        try:
-            payload = {'amount': amount}
-            async with aiohttp.ClientSession() as session:
-                async with session.post(f'{self.base_url}/bot/clients/{telegram_id}/balance/adjust', json=payload) as resp:
-                    if resp.status == 200:
-                        return await resp.json()
-                    logger.error(f"Adjust balance failed with status {resp.status}")
-                    return None
-        except Exception as e:
-            logger.error(f"Error adjusting client balance: {e}")
-            return None
+        Если expected_version задана и запись успела измениться, значение
+        отбрасывается, а запись помечается устаревшей (будет перечитана).
+        """
+        entry = self._entry(user_id)
+        if balance is None or (expected_version is not None and entry['version'] != expected_version):
+            self.invalidate(user_id)
+            return False
+        entry['balance'] = float(balance)
+        entry['version'] += 1
+        entry['fetched_at'] = time.monotonic()
+        return True
 
-    async def get_reviews_stats(self):
-        """Получить статистику отзывов"""
-        try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(f'{self.base_url}/review/stats') as resp:
-                    if resp.status == 200:
-                        return await resp.json()
-                    return None
-        except Exception as e:
-            logger.error(f"Error getting review stats: {e}")
-            return None
+    def invalidate(self, user_id):
+        """Пометить баланс устаревшим (например, после платежа)."""
+        entry = self._entry(user_id)
+        entry['version'] += 1
+        entry['fetched_at'] = 0.0
 
-    async def get_reviews(self):
-        """Получить список отзывов"""
-        try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(f'{self.base_url}/review') as resp:
-                    if resp.status == 200:
-                        return await resp.json()
-                    return []
-        except Exception as e:
-            logger.error(f"Error getting reviews: {e}")
-            return []
+    def evict_idle(self, idle_ttl=SESSION_IDLE_TTL):
+        """Удалить записи пользователей без активной сессии, не читавшиеся дольше idle_ttl."""
+        deadline = time.monotonic() - idle_ttl
+        idle = [
+            user_id for user_id, entry in self.entries.items()
+            if entry['fetched_at'] < deadline and user_id not in user_states and user_id not in self._inflight
+        ]
+        for user_id in idle:
+            del self.entries[user_id]
+        return len(idle)
 
-api = BotAPI(NODE_API_URL)
 
+balance_ledger = BalanceLedger()
 
-class CryptoBotAPI:
-    def __init__(self, token):
-        self.base_url = 'https://pay.crypt.bot/api'
-        self.token = token
 
-    async def _post(self, endpoint, payload=None):
-        if not self.token:
-            logger.warning("Crypto Bot token is not configured")
+_storage = None
+
+
+def get_storage():
+    """Локальная SQLite база бота (BOT_DATA_DIR/bot.db)"""
+    global _storage
+    if _storage is None:
+        os.makedirs(BOT_DATA_DIR, exist_ok=True)
+        _storage = sqlite3.connect(os.path.join(BOT_DATA_DIR, 'bot.db'))
+        _storage.execute('PRAGMA journal_mode=WAL')
+        _storage.execute(
+            'CREATE TABLE IF NOT EXISTS known_clients ('
+            'telegram_id INTEGER PRIMARY KEY, fingerprint INTEGER NOT NULL)'
+        )
+        _storage.execute(
+            'CREATE TABLE IF NOT EXISTS pending_invoices ('
+            'invoice_id INTEGER PRIMARY KEY, user_id INTEGER NOT NULL, '
+            'amount REAL NOT NULL, asset TEXT NOT NULL, expires_at REAL, position_id INTEGER)'
+        )
+        columns = {row[1] for row in _storage.execute('PRAGMA table_info(pending_invoices)')}
+        if 'position_id' not in columns:
+            _storage.execute('ALTER TABLE pending_invoices ADD COLUMN position_id INTEGER')
+        _storage.execute(
+            'CREATE TABLE IF NOT EXISTS sessions ('
+            'user_id INTEGER PRIMARY KEY, city_id INTEGER, district_id INTEGER, '
+            'current_category INTEGER, current_product INTEGER, current_page INTEGER, '
+            'awaiting_topup TEXT, payment_asset TEXT)'
+        )
+        columns = {row[1] for row in _storage.execute('PRAGMA table_info(sessions)')}
+        for column in ('awaiting_topup', 'payment_asset'):
+            if column not in columns:
+                _storage.execute(f'ALTER TABLE sessions ADD COLUMN {column} TEXT')
+        _storage.execute(
+            'CREATE TABLE IF NOT EXISTS restock_subscriptions ('
+            'user_id INTEGER NOT NULL, product_id INTEGER NOT NULL, city_id INTEGER NOT NULL, '
+            'district_id INTEGER NOT NULL, created_at REAL NOT NULL, '
+            'PRIMARY KEY (product_id, city_id, district_id, user_id))'
+        )
+        _storage.commit()
+    return _storage
+
+
+def client_fingerprint(user):
+    """Отпечаток полей профиля, которые сервер хранит у клиента."""
+    raw = '\x1f'.join([user.username or '', user.first_name or '', user.last_name or ''])
+    return zlib.crc32(raw.encode('utf-8'))
+
+
+class ClientRegistry:
+    """Реестр уже зарегистрированных на сервере клиентов.
+
+    POST /bot/clients/{id} отправляется только для новых пользователей или
+    если изменились username/имя. Все известные клиенты хранятся в SQLite,
+    в памяти - только LRU последних CLIENT_CACHE_SIZE отпечатков. Регистрации
+    новых пользователей копятся CLIENT_BATCH_DELAY секунд и уходят одним
+    запросом (наплыв после рекламы). SQLite читается и пишется в отдельном
+    потоке через собственное соединение, запись отпечатков и удаления
+    копятся до flush.
+    """
+
+    def __init__(self, cache_size=CLIENT_CACHE_SIZE):
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.pending = {}
+        # Регистрации, отправленные flush и еще не получившие ответа
+        self.inflight = {}
+        self.forgotten = set()
+        self._flush_handle = None
+        self._db = None
+        self._db_lock = threading.Lock()
+
+    def _connect(self):
+        if self._db is None:
+            get_storage()  # создает схему
+            self._db = sqlite3.connect(os.path.join(BOT_DATA_DIR, 'bot.db'), check_same_thread=False)
+        return self._db
+
+    def _load_fingerprint(self, telegram_id):
+        with self._db_lock:
+            row = self._connect().execute(
+                'SELECT fingerprint FROM known_clients WHERE telegram_id = ?', (telegram_id,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def _save(self, registered, forgotten):
+        with self._db_lock:
+            db = self._connect()
+            db.executemany('DELETE FROM known_clients WHERE telegram_id = ?', [(t,) for t in forgotten])
+            db.executemany('INSERT OR REPLACE INTO known_clients (telegram_id, fingerprint) VALUES (?, ?)', registered)
+            db.commit()
+
+    def close(self):
+        with self._db_lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    def _remember(self, telegram_id, fingerprint):
+        self.cache[telegram_id] = fingerprint
+        self.cache.move_to_end(telegram_id)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    async def _known_fingerprint(self, telegram_id):
+        if telegram_id in self.cache:
+            self.cache.move_to_end(telegram_id)
+            return self.cache[telegram_id]
+        if telegram_id in self.forgotten:
             return None
+        fingerprint = await asyncio.to_thread(self._load_fingerprint, telegram_id)
+        if fingerprint is not None and telegram_id not in self.forgotten:
+            self._remember(telegram_id, fingerprint)
+            return fingerprint
+        return None
 
-        headers = {
-            'Content-Type': 'application/json',
-            'Crypto-Pay-API-Token': self.token
-        }
+    def _schedule_flush(self):
+        if self._flush_handle is None:
+            self._flush_handle = asyncio.get_running_loop().call_later(
+                CLIENT_BATCH_DELAY, lambda: asyncio.ensure_future(self.flush())
+            )
+
+    async def ensure(self, user):
+        """Убедиться, что клиент существует на сервере. Возвращает True при успехе."""
+        fingerprint = client_fingerprint(user)
+        if await self._known_fingerprint(user.id) == fingerprint:
+            return True
+
+        sent = self.inflight.get(user.id)
+        if sent is not None and sent[1] == fingerprint:
+            # Тот же клиент уже в отправленной пачке: ждем ее ответа, а не ставим в следующую
+            return await asyncio.shield(sent[2])
+
+        if user.id not in self.pending:
+            future = asyncio.get_running_loop().create_future()
+            self.pending[user.id] = ({
+                'telegramId': user.id,
+                'username': user.username,
+                'firstName': user.first_name,
+                'lastName': user.last_name
+            }, fingerprint, future)
+            if len(self.pending) >= CLIENT_BATCH_SIZE:
+                asyncio.ensure_future(self.flush())
+            else:
+                self._schedule_flush()
+        return await asyncio.shield(self.pending[user.id][2])
+
+    async def flush(self):
+        """Отправить накопленные регистрации на сервер."""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        batch, self.pending = self.pending, {}
+        forgotten, self.forgotten = self.forgotten, set()
+        if not batch:
+            if forgotten:
+                await asyncio.to_thread(self._save, [], forgotten)
+            return
 
+        self.inflight.update(batch)
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.post(f"{self.base_url}/{endpoint}", json=payload or {}, headers=headers) as resp:
-                    data = await resp.json()
-                    if data.get('ok'):
-                        return data.get('result')
-                    logger.error(f"Crypto Bot API error ({endpoint}): {data}")
-        except Exception as e:
-            logger.error(f"Error calling Crypto Bot API {endpoint}: {e}")
-        return None
+            if len(batch) == 1:
+                payload, fingerprint, future = next(iter(batch.values()))
+                ok = await api.get_or_create_client(
+                    payload['telegramId'], payload['username'], payload['firstName'], payload['lastName']
+                ) is not None
+                results = {payload['telegramId']: ok}
+            else:
+                response = await api.bulk_upsert_clients([payload for payload, _, _ in batch.values()])
+                results = {telegram_id: response is not None for telegram_id in batch}
+        finally:
+            for telegram_id, item in batch.items():
+                if self.inflight.get(telegram_id) is item:
+                    del self.inflight[telegram_id]
 
-    async def get_balance(self):
-        return await self._post('getBalance')
+        registered = []
+        for telegram_id, (payload, fingerprint, future) in batch.items():
+            if results[telegram_id]:
+                self._remember(telegram_id, fingerprint)
+                registered.append((telegram_id, fingerprint))
+            if not future.done():
+                future.set_result(results[telegram_id])
 
-    async def create_invoice(self, asset, amount, description=None, payload=None):
-        body = {
-            'asset': asset,
-            'amount': amount,
-        }
-        if description:
-            body['description'] = description
-        if payload:
-            body['payload'] = payload
-        return await self._post('createInvoice', body)
+        if registered or forgotten:
+            await asyncio.to_thread(self._save, registered, forgotten)
 
-    async def get_invoice(self, invoice_id):
-        result = await self._post('getInvoices', {'invoice_ids': [invoice_id]})
-        if result and result.get('items'):
-            return result['items'][0]
-        return None
+    def forget(self, telegram_id):
+        """Забыть клиента (например, сервер ответил, что его нет); из SQLite удаляется при flush."""
+        self.cache.pop(telegram_id, None)
+        self.forgotten.add(telegram_id)
+        self._schedule_flush()
 
 
-crypto_bot = CryptoBotAPI(CRYPTO_BOT_TOKEN)
+client_registry = ClientRegistry()
 
-MAIN_MENU = ReplyKeyboardMarkup([
-    [KeyboardButton("👤 Профиль"), KeyboardButton("🛒 Каталог")],
-    [KeyboardButton("📦 Заказы"), KeyboardButton("ℹ️ О нас"), KeyboardButton("❓ Помощь")],
-    [KeyboardButton("⭐ Отзывы")]
-], resize_keyboard=True)
+CAPTION_LIMIT = 1024
 
-# Состояния пользователей
-user_states = {}
+# Последнее содержимое сообщения: (chat_id, message_id) -> (отпечаток, edit_date).
+# edit_date из callback показывает, не правилось ли сообщение в обход render_screen
+rendered_screens = OrderedDict()
 
 
-def get_user_wallet(user_id):
-    return user_wallets[user_id]
+def screen_fingerprint(text, reply_markup, photo):
+    return hash((text, photo, reply_markup.to_json() if reply_markup else None))
 
 
-def get_user_state(user_id):
-    """Получить состояние пользователя или инициализировать дефолтное."""
-    return user_states.setdefault(user_id, {
-        'city_id': None,
-        'district_id': None,
-        'current_category': None,
-        'current_product': None,
-        'current_page': 1,
-        'awaiting_topup': None
-    })
+def remember_screen(message, fingerprint):
+    if message is None or message is True:
+        return
+    key = (message.chat_id, message.message_id)
+    rendered_screens[key] = (fingerprint, message.edit_date)
+    rendered_screens.move_to_end(key)
+    while len(rendered_screens) > SCREEN_CACHE_SIZE:
+        rendered_screens.popitem(last=False)
 
 
-def format_amount(value):
-    return f"{float(value):.2f}"
+async def render_screen(update: Update, text, reply_markup=None, photo=None):
+    """Показать экран минимальным числом вызовов Telegram.
 
+    Для callback сообщение редактируется на месте: фото -> фото через
+    edit_message_media, текст -> текст через edit_message_text. Переходы
+    текст -> фото и фото -> текст (текстовое сообщение нельзя превратить в
+    медиа, а правка подписи оставила бы фото прежнего экрана) выполняются
+    удалением и повторной отправкой. Если сообщение уже показывает то же
+    самое, правка не отправляется вовсе.
+    """
+    query = update.callback_query
+    message = query.message if query else None
+    if photo and len(text) > CAPTION_LIMIT:
+        photo = None
+    fingerprint = screen_fingerprint(text, reply_markup, photo)
+
+    if message is not None and rendered_screens.get((message.chat_id, message.message_id)) == (fingerprint, message.edit_date):
+        rendered_screens.move_to_end((message.chat_id, message.message_id))
+        metrics.inc('bot_screen_edits_skipped_total')
+        return
 
-async def sync_wallet_balance(user_id):
-    """Синхронизировать локальный кошелек с сервером"""
-    wallet = get_user_wallet(user_id)
     try:
-        balance_data = await api.get_client_balance(user_id)
-        if balance_data and 'balance' in balance_data:
-            wallet['balance'] = float(balance_data['balance'])
-    except Exception as e:
-        logger.error(f"Failed to sync balance for {user_id}: {e}")
-    return wallet
+        if message is None:
+            op = 'send'
+            if photo:
+                sent = await update.effective_message.reply_photo(photo=photo, caption=text, parse_mode='HTML', reply_markup=reply_markup)
+            else:
+                sent = await update.effective_message.reply_text(text, parse_mode='HTML', reply_markup=reply_markup)
+        elif photo and message.photo:
+            op = 'edit_media'
+            sent = await query.edit_message_media(
+                InputMediaPhoto(photo, caption=text, parse_mode='HTML'), reply_markup=reply_markup
+            )
+        elif photo or message.photo:
+            op = 'resend'
+            if photo:
+                sent = await message.reply_photo(photo=photo, caption=text, parse_mode='HTML', reply_markup=reply_markup)
+            else:
+                sent = await message.reply_text(text, parse_mode='HTML', reply_markup=reply_markup)
+            await message.delete()
+            rendered_screens.pop((message.chat_id, message.message_id), None)
+        else:
+            op = 'edit_text'
+            sent = await query.edit_message_text(text, parse_mode='HTML', reply_markup=reply_markup)
+    except BadRequest as e:
+        if 'message is not modified' in str(e).lower():
+            # Содержимое совпало, но отпечатка еще не было (например, после перезапуска)
+            remember_screen(message, fingerprint)
+            metrics.inc('bot_screen_edits_not_modified_total')
+            return
+        if not photo:
+            raise
+        # Telegram не смог загрузить фото по URL: показываем экран без него
+        logger.warning("Failed to render photo %s: %s", photo, e)
+        await render_screen(update, text, reply_markup)
+        return
+
+    remember_screen(sent, fingerprint)
+    metrics.inc('bot_screen_renders_total', op=op)
+    # Раньше смена вида сообщения стоила удаления и новой отправки
+    if op == 'edit_media':
+        metrics.inc('bot_screen_api_calls_saved_total')
+
+
+# Поля deep link: k - категория, p - продукт, i - позиция, c - город, d - район
+DEEP_LINK_FIELDS = {'k': 'category', 'p': 'product', 'i': 'position', 'c': 'city', 'd': 'district'}
+DEEP_LINK_SIGNATURE_SIZE = 10
+# Telegram принимает в параметре start не больше 64 символов [A-Za-z0-9_-]
+DEEP_LINK_MAX_LENGTH = 64
+
+
+def deep_link_signature(body):
+    key = DEEP_LINK_SECRET.encode() if DEEP_LINK_SECRET else hashlib.sha256((BOT_TOKEN or '').encode()).digest()
+    digest = hmac.new(key, body.encode(), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest).decode()[:DEEP_LINK_SIGNATURE_SIZE]
+
+
+def encode_deep_link(**targets):
+    """Подписанный payload для /start: encode_deep_link(product=123, city=4) -> 'p_123_c_4_<подпись>'."""
+    codes = {name: code for code, name in DEEP_LINK_FIELDS.items()}
+    body = '_'.join(f"{codes[name]}_{int(value)}" for name, value in targets.items() if value is not None)
+    payload = f"{body}_{deep_link_signature(body)}"
+    if len(payload) > DEEP_LINK_MAX_LENGTH:
+        raise ValueError(f"deep link payload is longer than {DEEP_LINK_MAX_LENGTH} chars")
+    return payload
+
+
+def decode_deep_link(payload):
+    """Цели из payload ({'product': 123, 'city': 4}) или None, если подпись или формат неверны."""
+    if len(payload) > DEEP_LINK_MAX_LENGTH or len(payload) <= DEEP_LINK_SIGNATURE_SIZE + 1:
+        return None
+    body, signature = payload[:-DEEP_LINK_SIGNATURE_SIZE - 1], payload[-DEEP_LINK_SIGNATURE_SIZE:]
+    if payload[-DEEP_LINK_SIGNATURE_SIZE - 1] != '_':
+        return None
+    if not hmac.compare_digest(signature, deep_link_signature(body)):
+        return None
+    parts = body.split('_')
+    if len(parts) % 2:
+        return None
+    targets = {}
+    for code, value in zip(parts[::2], parts[1::2]):
+        if code not in DEEP_LINK_FIELDS or not value.isdigit():
+            return None
+        targets[DEEP_LINK_FIELDS[code]] = int(value)
+    return targets
+
+
+def build_deep_link(bot_username, **targets):
+    return f"https://t.me/{bot_username}?start={encode_deep_link(**targets)}"
+
+
+async def open_deep_link(update: Update, context: ContextTypes.DEFAULT_TYPE, targets):
+    """Сразу показать экран из deep link, выставив локацию из ссылки. False - цели нет."""
+    user_state = get_user_state(update.effective_user.id)
+    if 'city' in targets:
+        cities = await api.get_cities_with_districts()
+        city = next((c for c in cities if c['id'] == targets['city']), None)
+        if city:
+            user_state.city_id = city['id']
+            district_ids = {d['id'] for d in city.get('districts', [])}
+            user_state.district_id = targets.get('district') if targets.get('district') in district_ids else None
+
+    if 'position' in targets:
+        await show_position_details(update, context, targets['position'])
+    elif 'product' in targets and 'district' in targets:
+        await show_positions_for_product_and_district(update, context, targets['product'], targets['district'])
+    elif 'product' in targets:
+        await show_product_details(update, context, targets['product'])
+    elif 'category' in targets:
+        await show_products(update, context, targets['category'])
+    else:
+        return False
+    return True
+
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработчик команды /start"""
+    """Обработчик команды /start (по очереди с остальными апдейтами пользователя)"""
+    async with admission.serialized(update.effective_user.id):
+        await show_start(update, context)
+
+
+async def show_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Приветствие /start (с payload deep link - сразу нужный экран)"""
     user = update.effective_user
-    logger.info(f"User {user.id} started the bot")
+    logger.info("User %s started the bot", user.id)
+
+    if context.args:
+        targets = decode_deep_link(context.args[0])
+        metrics.inc('bot_deep_links_total', result='ok' if targets else 'invalid')
+        if targets and await open_deep_link(update, context, targets):
+            return
 
-    get_user_wallet(user.id)
-    await sync_wallet_balance(user.id)
-    
     user_state = get_user_state(user.id)
     
     # Check if city/district selected
-    city_id = user_state.get('city_id')
-    district_id = user_state.get('district_id')
+    city_id = user_state.city_id
+    district_id = user_state.district_id
     
     welcome_content = await api.get_bot_content('welcome')
-    review_stats = await api.get_reviews_stats()
+    await reviews_feed.refresh()
     
     stats_text = ""
-    if review_stats and review_stats.get('count', 0) > 0:
-        stats_text = f"\n\n⭐ <b>Рейтинг магазина: {review_stats.get('average')}</b> ({review_stats.get('count')} отзывов)"
+    if reviews_feed.count > 0:
+        stats_text = f"\n\n⭐ <b>Рейтинг магазина: {reviews_feed.average}</b> ({reviews_feed.count} отзывов)"
 
     text = welcome_content.get('text', 'welcome') if welcome_content else 'welcome'
     text += stats_text
     
+    image_url = None
+    if welcome_content and welcome_content.get('image'):
+        image_url = build_public_media_url(welcome_content['image'])
+
     # If location not selected, don't show main menu, show city selection immediately
     if not city_id:
-        if welcome_content and welcome_content.get('image'):
-            image_url = await build_public_media_url(welcome_content['image'])
+        if image_url:
             try:
                 await update.message.reply_photo(
                     photo=image_url,
@@ -406,7 +3007,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     parse_mode='HTML'
                 )
             except Exception as e:
-                logger.error(f"Error sending welcome photo: {e}")
+                logger.error("Error sending welcome photo: %s", e)
         else:
             await update.message.reply_text(
                 text,
@@ -416,8 +3017,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await show_city_selection(update, context, from_menu=True)
         return
 
-    if welcome_content and welcome_content.get('image'):
-        image_url = await build_public_media_url(welcome_content['image'])
+    if image_url:
         try:
             await update.message.reply_photo(
                 photo=image_url,
@@ -427,7 +3027,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             return
         except Exception as e:
-            logger.error(f"Error sending welcome photo: {e}")
+            logger.error("Error sending welcome photo: %s", e)
     
     await update.message.reply_text(
         text,
@@ -437,12 +3037,26 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def handle_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик нижнего меню"""
+    user_id = update.effective_user.id
+    rejected = admission.admit(user_id)
+    if rejected:
+        # Частые сообщения просто пропускаем, чтобы не отвечать на каждое
+        if rejected == 'shed':
+            await update.message.reply_text(ADMISSION_MESSAGES[rejected])
+        return
+    # Сообщения меню и ввод суммы меняют то же состояние, что и кнопки: обрабатываем по очереди
+    async with admission.serialized(user_id):
+        await route_main_menu(update, context)
+
+
+async def route_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработка текста нижнего меню и ввода суммы пополнения"""
     text = update.message.text
     user_id = update.effective_user.id
     user_state = get_user_state(user_id)
     
     # Enforce location selection check for main menu interaction
-    city_id = user_state.get('city_id')
+    city_id = user_state.city_id
     
     if not city_id:
         # Check if text is a valid location selection or other allowed command if any
@@ -451,11 +3065,11 @@ async def handle_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     # Ожидание ввода суммы для пополнения
-    awaiting_topup = user_state.get('awaiting_topup')
+    awaiting_topup = user_state.awaiting_topup
     if awaiting_topup:
         normalized_text = text.replace(",", ".").strip()
         if normalized_text.lower() in ("отмена", "cancel", "назад"):
-            user_state['awaiting_topup'] = None
+            user_state.awaiting_topup = None
             await update.message.reply_text(
                 "Пополнение отменено.",
                 reply_markup=MAIN_MENU
@@ -477,8 +3091,8 @@ async def handle_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             return
 
-        user_state['awaiting_topup'] = None
-        await create_topup_invoice(update, awaiting_topup.get('asset', CRYPTO_PAYMENT_ASSET), amount)
+        user_state.awaiting_topup = None
+        await create_topup_invoice(update, awaiting_topup, amount)
         return
     
     if text == "🛒 Каталог":
@@ -498,12 +3112,18 @@ async def handle_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await show_reviews_menu(update, context)
 
 
-async def show_reviews_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Показать меню отзывов"""
-    reviews = await api.get_reviews()
-    stats = await api.get_reviews_stats()
+async def show_reviews_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, before_id=None):
+    """Показать меню отзывов (before_id - листание к более ранним)"""
+    await reviews_feed.refresh()
+    reviews, has_older = await reviews_feed.get_page(before_id)
     
     if not reviews:
+        if update.callback_query:
+            await update.callback_query.edit_message_text(
+                "😔 <b>Более ранних отзывов нет</b>",
+                parse_mode='HTML'
+            )
+            return
         await update.message.reply_text(
             "😔 <b>Отзывов пока нет</b>",
             parse_mode='HTML',
@@ -512,19 +3132,32 @@ async def show_reviews_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     text = f"⭐ <b>Отзывы наших клиентов</b>\n"
-    if stats:
-        text += f"Рейтинг: <b>{stats.get('average')}</b> ({stats.get('count')} отзывов)\n\n"
+    if reviews_feed.count:
+        text += f"Рейтинг: <b>{reviews_feed.average}</b> ({reviews_feed.count} отзывов)\n\n"
     
-    # Show last 10 reviews
-    last_reviews = reviews[-10:]
-    for r in last_reviews:
+    for r in reviews:
         rating_stars = "⭐" * r.get('rating', 5)
         text += f"👤 <b>{r.get('author')}</b> {rating_stars}\n{r.get('text')}\n\n"
+
+    navigation = []
+    if has_older:
+        navigation.append(InlineKeyboardButton("◀️ Ранее", callback_data=f"reviews_before_{reviews[0]['id']}"))
+    if before_id is not None:
+        navigation.append(InlineKeyboardButton("⏭ Последние", callback_data="reviews_latest"))
+    reply_markup = InlineKeyboardMarkup([navigation]) if navigation else MAIN_MENU
+
+    if update.callback_query:
+        await update.callback_query.edit_message_text(
+            text,
+            parse_mode='HTML',
+            reply_markup=InlineKeyboardMarkup([navigation]) if navigation else None
+        )
+        return
         
     await update.message.reply_text(
         text,
         parse_mode='HTML',
-        reply_markup=MAIN_MENU
+        reply_markup=reply_markup
     )
 
 
@@ -533,15 +3166,10 @@ async def show_profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     user_id = user.id
 
+    await client_registry.ensure(user)
     client_data = await api.get_client_purchases(user_id)
     
     if not client_data:
-        client = await api.get_or_create_client(
-            user_id,
-            user.username,
-            user.first_name,
-            user.last_name
-        )
         purchases_count = 0
         username = user.username or user.first_name or "Не указан"
     else:
@@ -549,17 +3177,17 @@ async def show_profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
         client_info = client_data.get('client', {})
         username = client_info.get('username') or user.username or user.first_name or "Не указан"
     
-    user_state = user_states.get(user_id, {})
+    user_state = get_user_state(user_id)
     location_info = await get_location_button_text(user_state)
 
-    wallet = await sync_wallet_balance(user_id)
+    balance = await balance_ledger.get(user_id)
 
     profile_text = (
         f"👤 <b>Профиль</b>\n\n"
 
         f"📛 Ник: @{username}\n"
         f"Завершенных покупок: <b>{purchases_count}</b>\n\n"
-        f"Баланс: <b>{format_amount(wallet['balance'])} {CRYPTO_PAYMENT_ASSET}</b>\n"
+        f"Баланс: <b>{format_amount(balance)} {CRYPTO_PAYMENT_ASSET}</b>\n"
         f"Ваш город - {location_info}"
     )
     
@@ -575,34 +3203,54 @@ async def show_profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 
+def format_asset_amount(amount, asset):
+    """Сумма в CRYPTO_PAYMENT_ASSET и ее эквивалент в asset по кэшированному курсу."""
+    if asset == CRYPTO_PAYMENT_ASSET:
+        return f"{format_amount(amount)} {CRYPTO_PAYMENT_ASSET}"
+    converted = exchange_rates.convert(amount, asset)
+    if converted is None:
+        return f"{format_amount(amount)} {CRYPTO_PAYMENT_ASSET}"
+    return f"{format_amount(amount)} {CRYPTO_PAYMENT_ASSET} ≈ {converted:g} {asset}"
+
+
 async def show_balance_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Показать баланс и варианты пополнения."""
     user = update.effective_user if update.message else update.callback_query.from_user
-    wallet = await sync_wallet_balance(user.id)
+    balance = await balance_ledger.get(user.id)
+    asset = get_user_state(user.id).payment_asset
 
     text = (
         f"💳 <b>Ваш баланс</b>\n\n"
-        f"Доступно: <b>{format_amount(wallet['balance'])} {CRYPTO_PAYMENT_ASSET}</b>\n"
+        f"Доступно: <b>{format_amount(balance)} {CRYPTO_PAYMENT_ASSET}</b>\n"
         f"Выберите сумму пополнения, укажите свою или проверьте оплату активных инвойсов."
     )
+    if asset != CRYPTO_PAYMENT_ASSET:
+        text += f"\n\nОплата в <b>{asset}</b> по текущему курсу."
 
-    buttons = [
+    buttons = []
+    if len(CRYPTO_PAYMENT_ASSETS) > 1:
+        buttons.append([
+            InlineKeyboardButton(f"✅ {a}" if a == asset else a, callback_data=f"topup_asset_{a}")
+            for a in CRYPTO_PAYMENT_ASSETS
+        ])
+    buttons += [
+        [
+            InlineKeyboardButton(f"Пополнить {format_asset_amount(10, asset)}", callback_data=f"topup_{asset}_10"),
+        ],
         [
-            InlineKeyboardButton(f"Пополнить 10 {CRYPTO_PAYMENT_ASSET}", callback_data=f"topup_{CRYPTO_PAYMENT_ASSET}_10"),
-            InlineKeyboardButton(f"Пополнить 25 {CRYPTO_PAYMENT_ASSET}", callback_data=f"topup_{CRYPTO_PAYMENT_ASSET}_25"),
+            InlineKeyboardButton(f"Пополнить {format_asset_amount(25, asset)}", callback_data=f"topup_{asset}_25"),
         ],
         [
-            InlineKeyboardButton(f"Пополнить 50 {CRYPTO_PAYMENT_ASSET}", callback_data=f"topup_{CRYPTO_PAYMENT_ASSET}_50"),
-            InlineKeyboardButton("Другая сумма", callback_data=f"topup_custom_{CRYPTO_PAYMENT_ASSET}")
+            InlineKeyboardButton(f"Пополнить {format_asset_amount(50, asset)}", callback_data=f"topup_{asset}_50"),
+            InlineKeyboardButton("Другая сумма", callback_data=f"topup_custom_{asset}")
         ]
     ]
 
     pending_buttons = []
-    for invoice_id, data in wallet['invoices'].items():
-        if data.get('status') != 'paid':
-            pending_buttons.append(
-                [InlineKeyboardButton(f"Проверить оплату #{invoice_id}", callback_data=f"check_{invoice_id}")]
-            )
+    for invoice in pending_invoices.for_user(user.id):
+        pending_buttons.append(
+            [InlineKeyboardButton(f"Проверить оплату #{invoice['invoice_id']}", callback_data=f"check_{invoice['invoice_id']}")]
+        )
 
     reply_markup = InlineKeyboardMarkup(buttons + pending_buttons) if (pending_buttons or buttons) else MAIN_MENU
 
@@ -614,33 +3262,51 @@ async def show_balance_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def create_topup_invoice(update: Update, asset: str, amount: float):
     user = update.effective_user if update.message else update.callback_query.from_user
-    invoice = await crypto_bot.create_invoice(asset, amount, description="Пополнение баланса", payload=str(user.id))
 
-    if not invoice:
+    if not pending_invoices.can_add(user.id):
         message = (
-            "❌ <b>Не удалось создать инвойс</b>\n"
-            "Проверьте CRYPTO_BOT_TOKEN и повторите попытку."
+            f"⏳ <b>У вас уже {pending_invoices.per_user_limit} неоплаченных инвойсов</b>\n"
+            "Оплатите один из них или дождитесь истечения срока."
         )
         markup = InlineKeyboardMarkup([[InlineKeyboardButton("Вернуться к балансу", callback_data="balance_menu")]])
+        if update.message:
+            await update.message.reply_text(message, parse_mode='HTML', reply_markup=markup)
+        else:
+            await update.callback_query.edit_message_text(message, parse_mode='HTML', reply_markup=markup)
+        return
+
+    asset_amount = exchange_rates.convert(amount, asset)
+    invoice = None
+    if asset_amount is not None:
+        invoice = await crypto_bot.create_invoice(asset, asset_amount, description="Пополнение баланса", payload=str(user.id))
+
+    if not invoice:
+        if asset_amount is None:
+            # Курсы устарели или актива нет в снимке: настройки тут ни при чем
+            message = (
+                f"⏳ <b>Курс {asset} временно недоступен</b>\n"
+                f"Попробуйте позже или пополните баланс в {CRYPTO_PAYMENT_ASSET}."
+            )
+        else:
+            message = (
+                "❌ <b>Не удалось создать инвойс</b>\n"
+                "Проверьте CRYPTO_BOT_TOKEN и повторите попытку."
+            )
+        markup = InlineKeyboardMarkup([[InlineKeyboardButton("Вернуться к балансу", callback_data="balance_menu")]])
         if update.message:
             await update.message.reply_text(message, parse_mode='HTML', reply_markup=MAIN_MENU)
         else:
             await update.callback_query.edit_message_text(message, parse_mode='HTML', reply_markup=markup)
         return
 
-    wallet = await sync_wallet_balance(user.id)
-    wallet['invoices'][invoice['invoice_id']] = {
-        'amount': amount,
-        'asset': asset,
-        'status': invoice.get('status', 'active')
-    }
+    pending_invoices.add(user.id, invoice, credit_amount=amount)
 
     buttons = [[InlineKeyboardButton("Оплатить через Crypto Bot", url=invoice.get('pay_url'))]]
     buttons.append([InlineKeyboardButton("🔄 Проверить оплату", callback_data=f"check_{invoice['invoice_id']}")])
 
     text = (
         f"✅ Инвойс создан!\n"
-        f"Сумма: <b>{format_amount(amount)} {asset}</b>\n"
+        f"Сумма: <b>{format_asset_amount(amount, asset)}</b>\n"
         f"Invoice ID: <code>{invoice['invoice_id']}</code>"
     )
 
@@ -654,12 +3320,14 @@ async def prompt_custom_topup(update: Update, asset: str):
     """Запросить у пользователя произвольную сумму пополнения."""
     user = update.effective_user if update.message else update.callback_query.from_user
     user_state = get_user_state(user.id)
-    user_state['awaiting_topup'] = {'asset': asset}
+    user_state.awaiting_topup = asset
 
     message = (
-        f"Введите сумму пополнения в {asset}.\n"
+        f"Введите сумму пополнения в {CRYPTO_PAYMENT_ASSET}.\n"
         f"Пример: 12.5"
     )
+    if asset != CRYPTO_PAYMENT_ASSET:
+        message += f"\nОплата в {asset} по текущему курсу."
     
     keyboard = [[InlineKeyboardButton("❌ Отмена", callback_data="cancel_topup")]]
     reply_markup = InlineKeyboardMarkup(keyboard)
@@ -673,7 +3341,7 @@ async def prompt_custom_topup(update: Update, asset: str):
         await update.callback_query.message.reply_text(message, reply_markup=reply_markup)
 
 
-async def check_invoice_status(update: Update, invoice_id: str):
+async def check_invoice_status(update: Update, invoice_id: int):
     user = update.effective_user if update.message else update.callback_query.from_user
     invoice = await crypto_bot.get_invoice(invoice_id)
 
@@ -685,29 +3353,33 @@ async def check_invoice_status(update: Update, invoice_id: str):
             await update.callback_query.edit_message_text(message, reply_markup=MAIN_MENU)
         return
 
-    wallet = await sync_wallet_balance(user.id)
-    stored_invoice = wallet['invoices'].get(int(invoice_id))
+    stored_invoice = pending_invoices.get(invoice_id, user.id)
 
-    if invoice.get('status') == 'paid' and stored_invoice and stored_invoice.get('status') != 'paid':
-        wallet['balance'] += float(stored_invoice.get('amount', 0))
-        stored_invoice['status'] = 'paid'
+    if invoice.get('status') == 'expired' and stored_invoice:
+        pending_invoices.remove(invoice_id)
+        # Как и invoice_sweeper: после удаления из индекса резерв больше никто не снимет
+        if stored_invoice.get('position_id'):
+            await release_checkout(stored_invoice['position_id'], user.id)
 
-        balance_response = await api.adjust_balance(user.id, float(stored_invoice.get('amount', 0)))
-        if not balance_response:
-            logger.error(f"Failed to persist balance top-up for {user.id}")
+    if invoice.get('status') == 'paid' and stored_invoice:
+        result = await settle_invoice(stored_invoice)
+        if result is None:
+            message = "❌ Оплата получена, но зачислить ее пока не удалось. Попробуйте проверить еще раз позже."
+            buttons = [[InlineKeyboardButton("🔄 Проверить оплату", callback_data=f"check_{invoice_id}")]]
+            reply_markup = InlineKeyboardMarkup(buttons)
         else:
-            wallet['balance'] = float(balance_response.get('balance', wallet['balance']))
+            message, reply_markup = settlement_message(stored_invoice, result)
 
-        message = (
-            f"✅ Оплата подтверждена!\n"
-            f"Баланс пополнен на <b>{format_amount(stored_invoice.get('amount', 0))} {stored_invoice.get('asset')}</b>.\n"
-            f"Текущий баланс: <b>{format_amount(wallet['balance'])} {stored_invoice.get('asset')}</b>"
-        )
-    else:
-        message = (
-            f"Инвойс #{invoice_id} имеет статус: <b>{invoice.get('status')}</b>.\n"
-            "Нажмите «Проверить оплату» после завершения платежа."
-        )
+        if update.message:
+            await update.message.reply_text(message, parse_mode='HTML', reply_markup=reply_markup)
+        else:
+            await update.callback_query.edit_message_text(message, parse_mode='HTML', reply_markup=reply_markup)
+        return
+
+    message = (
+        f"Инвойс #{invoice_id} имеет статус: <b>{invoice.get('status')}</b>.\n"
+        "Нажмите «Проверить оплату» после завершения платежа."
+    )
 
     buttons = [[InlineKeyboardButton("Вернуться к балансу", callback_data="balance_menu")]]
 
@@ -721,17 +3393,10 @@ async def show_orders(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     user_id = user.id
     
+    await client_registry.ensure(user)
     purchases_data = await api.get_client_purchases(user_id)
     
     if not purchases_data or not purchases_data.get('purchases'):
-        if not purchases_data:
-            await api.get_or_create_client(
-                user_id,
-                user.username,
-                user.first_name,
-                user.last_name
-            )
-        
         await update.message.reply_text(
             "📦 <b>Ваши заказы</b>\n\n"
             "У вас пока нет завершенных заказов.\n\n",
@@ -823,6 +3488,7 @@ async def show_orders(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def show_categories(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Показать категории"""
+    analytics.track('categories', update.effective_user.id)
     categories = await api.get_catalog_categories()
     
     if not categories:
@@ -851,8 +3517,8 @@ async def show_categories(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def get_location_button_text(user_state):
     """Получить текст для кнопки локации в зависимости от выбранного фильтра"""
-    city_id = user_state.get('city_id')
-    district_id = user_state.get('district_id')
+    city_id = user_state.city_id
+    district_id = user_state.district_id
     
     if not city_id:
         return "🏙️ Город не выбран"
@@ -874,26 +3540,20 @@ async def get_location_button_text(user_state):
     
 async def show_products(update: Update, context: ContextTypes.DEFAULT_TYPE, category_id, page=1):
     """Показать товары категории с пагинацией"""
-    if hasattr(update, 'callback_query'):
-        query = update.callback_query
-        user_id = query.from_user.id
-        message_edit = True
-    else:
-        user_id = update.effective_user.id
-        message_edit = False
+    user_id = update.effective_user.id
     
-    user_state = user_states.get(user_id, {})
+    user_state = get_user_state(user_id)
     
     products, total_count = await api.get_products_by_category(
         category_id, 
-        user_state.get('city_id'), 
+        user_state.city_id, 
         None, # ignore district for product list
         page
     )
     
     if not products:
         # Smart suggestion for districts
-        city_id = user_state.get('city_id')
+        city_id = user_state.city_id
         suggested_districts = []
         if city_id:
              suggested_districts = await api.get_available_districts(category_id, city_id)
@@ -904,7 +3564,7 @@ async def show_products(update: Update, context: ContextTypes.DEFAULT_TYPE, cate
                 # Filter out current district if selected (though if it was selected and had empty products, it's valid to not show it, but current logic implies we are here because current view is empty)
                 # Actually, if we are here, current district selection yielded no results.
                 # So we show others.
-                if str(d['id']) != str(user_state.get('district_id')):
+                if d['id'] != user_state.district_id:
                     district_buttons.append([InlineKeyboardButton(
                         f"📍 {d['name']}",
                         callback_data=f"switch_district_{category_id}_{city_id}_{d['id']}"
@@ -913,24 +3573,16 @@ async def show_products(update: Update, context: ContextTypes.DEFAULT_TYPE, cate
             if district_buttons:
                 district_buttons.append([InlineKeyboardButton("🔙 К категориям", callback_data="back_to_categories")])
                 
-                if message_edit:
-                    await query.edit_message_text(
-                        f"😔 <b>В вашей локации нет товаров этой категории.</b>\n\n"
-                        f"Попробуйте выбрать другой район, где товары есть:",
-                        parse_mode='HTML',
-                        reply_markup=InlineKeyboardMarkup(district_buttons)
-                    )
-                else:
-                    await update.message.reply_text(
-                        f"😔 <b>В вашей локации нет товаров этой категории.</b>\n\n"
-                        f"Попробуйте выбрать другой район, где товары есть:",
-                        parse_mode='HTML',
-                        reply_markup=InlineKeyboardMarkup(district_buttons)
-                    )
+                await render_screen(
+                    update,
+                    f"😔 <b>В вашей локации нет товаров этой категории.</b>\n\n"
+                    f"Попробуйте выбрать другой район, где товары есть:",
+                    InlineKeyboardMarkup(district_buttons)
+                )
                 return
 
         location_info = ""
-        if user_state.get('city_id'):
+        if user_state.city_id:
             location_info = "\n\nℹ️ Попробуйте изменить фильтр локации."
         
         location_button_text = await get_location_button_text(user_state)
@@ -940,22 +3592,16 @@ async def show_products(update: Update, context: ContextTypes.DEFAULT_TYPE, cate
             [InlineKeyboardButton("🔙 К категориям", callback_data="back_to_categories")]
         ]
         
-        if message_edit:
-            await query.edit_message_text(
-                f"😔 <b>В этой категории пока нет товаров</b>{location_info}",
-                parse_mode='HTML',
-                reply_markup=InlineKeyboardMarkup(keyboard)
-            )
-        else:
-            await update.message.reply_text(
-                f"😔 <b>В этой категории пока нет товаров</b>{location_info}",
-                parse_mode='HTML',
-                reply_markup=InlineKeyboardMarkup(keyboard)
-            )
+        await render_screen(
+            update,
+            f"😔 <b>В этой категории пока нет товаров</b>{location_info}",
+            InlineKeyboardMarkup(keyboard)
+        )
         return
     
-    user_states[user_id]['current_category'] = category_id
-    user_states[user_id]['current_page'] = page
+    user_state.current_category = int(category_id)
+    user_state.current_page = page
+    analytics.track('products', user_id, category_id=user_state.current_category)
     
     keyboard = []
     for product in products:
@@ -985,54 +3631,58 @@ async def show_products(update: Update, context: ContextTypes.DEFAULT_TYPE, cate
     
     message_text = f"📦 <b>Выберите продукт (страница {page}):</b>"
     
-    if message_edit:
-        if query.message.photo:
-            await query.message.delete()
-            await query.message.reply_text(
-                message_text,
-                parse_mode='HTML',
-                reply_markup=reply_markup
-            )
-        else:
-            await query.edit_message_text(
-                message_text,
-                parse_mode='HTML',
-                reply_markup=reply_markup
-            )
+    await render_screen(update, message_text, reply_markup)
+
+def restock_button(user_id, product_id, city_id, district_id=None):
+    """Кнопка подписки на поступление (или отписки, если подписка уже есть)."""
+    key = f"{product_id}_{city_id}_{district_id or 0}"
+    if restock_alerts.is_subscribed(user_id, int(product_id), city_id, int(district_id or 0)):
+        return InlineKeyboardButton("🔕 Не сообщать о поступлении", callback_data=f"unnotify_{key}")
+    return InlineKeyboardButton("🔔 Сообщить о поступлении", callback_data=f"notify_{key}")
+
+
+async def toggle_restock_alert(update: Update, context: ContextTypes.DEFAULT_TYPE, subscribe, product_id, city_id, district_id):
+    """Подписка/отписка и перерисовка экрана, с которого нажата кнопка."""
+    user_id = update.effective_user.id
+    if subscribe:
+        restock_alerts.subscribe(user_id, product_id, city_id, district_id)
     else:
-        await update.message.reply_text(
-            message_text,
-            parse_mode='HTML',
-            reply_markup=reply_markup
-        )
+        restock_alerts.unsubscribe(user_id, product_id, city_id, district_id)
+    if district_id:
+        await show_positions_for_product_and_district(update, context, product_id, district_id)
+    else:
+        await show_product_details(update, context, product_id)
+
 
 async def show_product_details(update: Update, context: ContextTypes.DEFAULT_TYPE, product_id):
-    """Показать детали продукта и его позиции"""
+    """Показать детали продукта и его позиции (из callback или deep link)"""
     query = update.callback_query
-    await query.answer()
+    if query:
+        await query.answer()
     
-    user_id = query.from_user.id
-    user_state = user_states.get(user_id, {})
+    user_id = update.effective_user.id
+    user_state = get_user_state(user_id)
     
     product = await api.get_product_by_id(product_id)
     # Ensure we look for positions in the WHOLE city
     positions = await api.get_positions_by_product(
         product_id, 
-        user_state.get('city_id'), 
+        user_state.city_id, 
         None # Ignore district_id from state for now, we want to select it here
     )
     
     if not product:
-        await query.edit_message_text(
+        await render_screen(
+            update,
             "😔 <b>Товар не найден</b>",
-            parse_mode='HTML',
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("🔙 Назад", callback_data=f"cat_{user_state.get('current_category', '')}")]
+            InlineKeyboardMarkup([
+                [InlineKeyboardButton("🔙 Назад", callback_data=f"cat_{user_state.current_category or ''}")]
             ])
         )
         return
     
-    user_states[user_id]['current_product'] = product_id
+    user_state.current_product = int(product_id)
+    analytics.track('product', user_id, category_id=user_state.current_category, product_id=int(product_id))
     
     # Group positions by district
     districts_map = {}
@@ -1050,8 +3700,10 @@ async def show_product_details(update: Update, context: ContextTypes.DEFAULT_TYP
 
     if not positions:
          # No positions in city
-        keyboard = [[InlineKeyboardButton("🔙 К товарам", callback_data=f"cat_{user_state.get('current_category', '')}")]]
+        keyboard = [[InlineKeyboardButton("🔙 К товарам", callback_data=f"cat_{user_state.current_category or ''}")]]
         text = product_caption + "😔 <b>Нет в наличии в вашем городе.</b>"
+        if user_state.city_id:
+            keyboard.insert(0, [restock_button(user_id, product_id, user_state.city_id)])
     elif not districts_map:
         # Positions exist but no district info?? Maybe directly show positions?
         # Fallback to direct positions list if no district info
@@ -1062,7 +3714,7 @@ async def show_product_details(update: Update, context: ContextTypes.DEFAULT_TYP
                 f"💰 {position['price']} $ - {position['name']}", 
                 callback_data=f"pos_{position['id']}"
             )])
-         keyboard.append([InlineKeyboardButton("🔙 К товарам", callback_data=f"cat_{user_state.get('current_category', '')}")])
+         keyboard.append([InlineKeyboardButton("🔙 К товарам", callback_data=f"cat_{user_state.current_category or ''}")])
     else:
         # Show Districts
         text = product_caption + "📍 <b>Выберите район, где хотите забрать товар:</b>"
@@ -1072,48 +3724,16 @@ async def show_product_details(update: Update, context: ContextTypes.DEFAULT_TYP
                 f"📍 {d_name}", 
                 callback_data=f"prod_dist_{product_id}_{d_id}"
             )])
-        keyboard.append([InlineKeyboardButton("🔙 К товарам", callback_data=f"cat_{user_state.get('current_category', '')}")])
-
-    # Send/Edit Message
-    if product.get('img'):
-        image_url = await build_public_media_url(product['img'])
-        try:
-             # If reusing existing message, we can't easily turn text to photo without deleting. 
-             # But callback usually audits existing message.
-             # Simplest: Delete and Send New if photo? Or just reply_photo if it was text?
-             # `edit_message_media` is complex.
-             # Let's try sending new photo if we can, or just text if image fails.
-             # Actually keeping it simple: if there is an image, we try to send it as a fresh message?
-             # But user clicked "Product X".
-             await query.message.reply_photo(
-                photo=image_url,
-                caption=text,
-                parse_mode='HTML',
-                reply_markup=InlineKeyboardMarkup(keyboard)
-            )
-             return
-        except Exception as e:
-            logger.error(f"Error sending product photo: {e}")
+        keyboard.append([InlineKeyboardButton("🔙 К товарам", callback_data=f"cat_{user_state.current_category or ''}")])
 
-    # Fallback text
-    try:
-        await query.edit_message_text(
-            text,
-            parse_mode='HTML',
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
-    except Exception as e:
-        # If trying to edit photo caption with text only or vice versa
-        await query.message.reply_text(
-            text,
-            parse_mode='HTML',
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
+    image_url = build_public_media_url(product['img']) if product.get('img') else None
+    await render_screen(update, text, InlineKeyboardMarkup(keyboard), photo=image_url)
 
 async def show_positions_for_product_and_district(update: Update, context: ContextTypes.DEFAULT_TYPE, product_id, district_id):
     """Показать позиции товара в конкретном районе"""
     query = update.callback_query
-    await query.answer()
+    if query:
+        await query.answer()
     
     product = await api.get_product_by_id(product_id)
     # Fetch positions for specific district
@@ -1128,52 +3748,61 @@ async def show_positions_for_product_and_district(update: Update, context: Conte
     # Note: get_positions_by_product implementation:
     # if district_id: params['districtId'] = district_id
     
+    if not product:
+        await render_screen(update, "😔 <b>Товар не найден</b>")
+        return
+
     keyboard = []
     for position in positions:
+         # Позиция в резерве у покупателя, который сейчас ее оплачивает
+         reserved = "⏳ " if position.get('reservation') else ""
          keyboard.append([InlineKeyboardButton(
-            f"💰 {position['price']} $ - {position['name']}", 
+            f"{reserved}💰 {position['price']} $ - {position['name']}", 
             callback_data=f"pos_{position['id']}"
         )])
     
+    if not positions:
+        user_state = get_user_state(update.effective_user.id)
+        if user_state.city_id:
+            keyboard.append([restock_button(update.effective_user.id, product_id, user_state.city_id, district_id)])
     keyboard.append([InlineKeyboardButton("🔙 К выбору района", callback_data=f"prod_{product_id}")])
     
-    if query.message.photo:
-        await query.message.delete()
-        await query.message.reply_text(
-            f"<b>📦 {product['name']}</b>\n\n"
-            f"📍 <b>Район выбран.</b> Выберите позицию:",
-            parse_mode='HTML',
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
-    else:
-        await query.edit_message_text(
-            f"<b>📦 {product['name']}</b>\n\n"
-            f"📍 <b>Район выбран.</b> Выберите позицию:",
-            parse_mode='HTML',
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
+    await render_screen(
+        update,
+        f"<b>📦 {product['name']}</b>\n\n"
+        f"📍 <b>Район выбран.</b> Выберите позицию:",
+        InlineKeyboardMarkup(keyboard)
+    )
 
 async def show_position_details(update: Update, context: ContextTypes.DEFAULT_TYPE, position_id):
     """Показать детали позиции"""
     query = update.callback_query
-    await query.answer()
+    if query:
+        await query.answer()
     
     position = await api.get_position_by_id(position_id)
     
     if not position:
-        await query.edit_message_text(
-            "😔 <b>Позиция не найдена</b>",
-            parse_mode='HTML'
-        )
+        await render_screen(update, "😔 <b>Позиция не найдена</b>")
         return
     
     product = position.get('product', {})
     city = position.get('city', {})
     district = position.get('district', {})
+    analytics.track(
+        'position', update.effective_user.id, category_id=get_user_state(update.effective_user.id).current_category,
+        product_id=product.get('id'), position_id=position['id']
+    )
+
+    price_hint = ""
+    asset = get_user_state(update.effective_user.id).payment_asset
+    converted = exchange_rates.convert(position['price'], asset)
+    if asset != CRYPTO_PAYMENT_ASSET and converted is not None:
+        price_hint = f" (≈ {converted:g} {asset})"
     
     message_text = (
         f"<b>📍 {position['name']}</b>\n\n"
-        f"💰 <b>Цена: {position['price']} $</b>\n"
+        f"💰 <b>Цена: {position['price']} $</b>{price_hint}\n"
         f"📦 Упаковка: {position['type']}\n"
         f"🏙️ Город: {city.get('name', 'Не указан')}"   
     )
@@ -1181,6 +3810,8 @@ async def show_position_details(update: Update, context: ContextTypes.DEFAULT_TY
         message_text += f"\n📍 Район: {district.get('name')}"
     
     message_text += f"\n🏢 Место: {position['location']}\n"
+    if position.get('reservation'):
+        message_text += "\n⏳ Позиция сейчас зарезервирована покупателем и может скоро освободиться.\n"
     # message_text += f"\n\n🛍️ Товар: {product.get('name', 'Не указан')}"
     
     keyboard = [
@@ -1188,11 +3819,7 @@ async def show_position_details(update: Update, context: ContextTypes.DEFAULT_TY
         [InlineKeyboardButton("🔙 К позициям", callback_data=f"prod_{product.get('id', '')}")]
     ]
     
-    await query.edit_message_text(
-        message_text,
-        parse_mode='HTML',
-        reply_markup=InlineKeyboardMarkup(keyboard)
-    )
+    await render_screen(update, message_text, InlineKeyboardMarkup(keyboard))
 
 async def show_city_selection_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Показать выбор города из нижнего меню"""
@@ -1275,8 +3902,9 @@ async def handle_city_selected(update: Update, context: ContextTypes.DEFAULT_TYP
         return
     
     user_id = query.from_user.id
-    user_states[user_id]['city_id'] = int(city_id)
-    user_states[user_id]['district_id'] = None
+    user_state = get_user_state(user_id)
+    user_state.city_id = int(city_id)
+    user_state.district_id = None
     
     # Show confirmation
     await query.edit_message_text(
@@ -1300,8 +3928,9 @@ async def reset_location(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.answer()
     
     user_id = query.from_user.id
-    user_states[user_id]['city_id'] = None
-    user_states[user_id]['district_id'] = None
+    user_state = get_user_state(user_id)
+    user_state.city_id = None
+    user_state.district_id = None
     
     await query.edit_message_text(
         "✅ <b>Локация сброшена!</b>\n\n"
@@ -1319,8 +3948,9 @@ async def reset_district(update: Update, context: ContextTypes.DEFAULT_TYPE, cit
     await query.answer()
     
     user_id = query.from_user.id
-    user_states[user_id]['city_id'] = city_id
-    user_states[user_id]['district_id'] = None
+    user_state = get_user_state(user_id)
+    user_state.city_id = int(city_id)
+    user_state.district_id = None
     
     cities = await api.get_cities_with_districts()
     city = next((c for c in cities if c['id'] == int(city_id)), None)
@@ -1341,8 +3971,9 @@ async def save_location(update: Update, context: ContextTypes.DEFAULT_TYPE, city
     await query.answer()
     
     user_id = query.from_user.id
-    user_states[user_id]['city_id'] = city_id
-    user_states[user_id]['district_id'] = district_id
+    user_state = get_user_state(user_id)
+    user_state.city_id = int(city_id)
+    user_state.district_id = int(district_id) if district_id else None
     
     cities = await api.get_cities_with_districts()
     city = next((c for c in cities if c['id'] == int(city_id)), None)
@@ -1373,8 +4004,8 @@ async def show_about_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Показать 'О нас' из нижнего меню"""
     about_content = await api.get_bot_content('about')
     
-    if about_content and about_content.get('image'):
-        image_url = await build_public_media_url(about_content['image'])
+    image_url = build_public_media_url(about_content['image']) if about_content and about_content.get('image') else None
+    if image_url:
         try:
             await update.message.reply_photo(
                 photo=image_url,
@@ -1384,7 +4015,7 @@ async def show_about_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             return
         except Exception as e:
-            logger.error(f"Error sending about photo: {e}")
+            logger.error("Error sending about photo: %s", e)
     
     await update.message.reply_text(
         about_content.get('text', 'ℹ️ О нашей компании') if about_content 
@@ -1397,8 +4028,8 @@ async def show_help_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Показать help из нижнего меню"""
     help_content = await api.get_bot_content('help')
     
-    if help_content and help_content.get('image'):
-        image_url = await build_public_media_url(help_content['image'])
+    image_url = build_public_media_url(help_content['image']) if help_content and help_content.get('image') else None
+    if image_url:
         try:
             await update.message.reply_photo(
                 photo=image_url,
@@ -1408,7 +4039,7 @@ async def show_help_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             return
         except Exception as e:
-            logger.error(f"Error sending help photo: {e}")
+            logger.error("Error sending help photo: %s", e)
     
     await update.message.reply_text(
         help_content.get('text', '❓ help 2') if help_content 
@@ -1418,6 +4049,13 @@ async def show_help_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 
+async def release_checkout(position_id, user_id):
+    """Снять резерв покупки, если позицию не держит открытый инвойс пользователя на доплату."""
+    if any(str(invoice['position_id']) == str(position_id) for invoice in pending_invoices.for_user(user_id)):
+        return
+    await api.release_position(position_id, user_id)
+
+
 async def handle_purchase(update: Update, context: ContextTypes.DEFAULT_TYPE, position_id):
     """Обработчик покупки позиции"""
     query = update.callback_query
@@ -1433,12 +4071,7 @@ async def handle_purchase(update: Update, context: ContextTypes.DEFAULT_TYPE, po
         )
         return
 
-    client = await api.get_or_create_client(
-        user.id,
-        user.username,
-        user.first_name,
-        user.last_name
-    )
+    client = await client_registry.ensure(user)
 
     if not client:
         await query.edit_message_text(
@@ -1447,42 +4080,79 @@ async def handle_purchase(update: Update, context: ContextTypes.DEFAULT_TYPE, po
         )
         return
 
-    wallet = await sync_wallet_balance(user.id)
+    category_id = get_user_state(user.id).current_category
+    product_id = position.get('product', {}).get('id')
+    analytics.track('checkout', user.id, category_id=category_id, product_id=product_id, position_id=position['id'])
+
+    # Резервируем позицию сразу, чтобы конкурентный покупатель узнал о ней до оплаты
+    reserved = await api.reserve_position(position_id, user.id)
+    if reserved is False:
+        await query.edit_message_text(
+            "⏳ <b>Позиция зарезервирована другим покупателем</b>\n\n"
+            "Если он не завершит оплату, позиция освободится в течение нескольких минут.",
+            parse_mode='HTML',
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("🔙 Назад", callback_data=f"pos_{position_id}")]
+            ])
+        )
+        return
+
+    # Решение о доплате принимаем по свежему балансу, а не по кэшу
+    balance = await balance_ledger.get(user.id, max_age=0)
     price = float(position['price'])
 
-    if wallet['balance'] < price:
-        missing = price - wallet['balance']
+    if balance < price:
+        missing = price - balance
         
         # Auto-create invoice for the missing amount
-        invoice = await crypto_bot.create_invoice(
-            CRYPTO_PAYMENT_ASSET, 
-            missing, 
-            description="Оплата заказа", 
-            payload=str(user.id)
-        )
+        asset = get_user_state(user.id).payment_asset
+        asset_amount = exchange_rates.convert(missing, asset)
+        if asset_amount is None:
+            asset, asset_amount = CRYPTO_PAYMENT_ASSET, missing
+
+        invoice = None
+        if pending_invoices.can_add(user.id):
+            invoice = await crypto_bot.create_invoice(
+                asset, 
+                asset_amount, 
+                description="Оплата заказа", 
+                payload=str(user.id)
+            )
         
         buttons = []
         if invoice:
              # Save invoice to local state so check_invoice works
-            wallet['invoices'][invoice['invoice_id']] = {
-                'amount': missing,
-                'asset': CRYPTO_PAYMENT_ASSET,
-                'status': invoice.get('status', 'active')
-            }
-            buttons.append([InlineKeyboardButton(f"💳 Оплатить {format_amount(missing)} {CRYPTO_PAYMENT_ASSET}", url=invoice.get('pay_url'))])
+            record = pending_invoices.add(user.id, invoice, credit_amount=missing, position_id=position_id)
+            # Держим позицию, пока инвойс можно оплатить
+            ttl = max(int(record['expires_at'] - time.time()), 0) + INVOICE_RESERVATION_GRACE
+            await api.reserve_position(position_id, user.id, ttl=ttl)
+            buttons.append([InlineKeyboardButton(f"💳 Оплатить {asset_amount:g} {asset}", url=invoice.get('pay_url'))])
             buttons.append([InlineKeyboardButton("🔄 Проверить оплату", callback_data=f"check_{invoice['invoice_id']}")]) # Direct check for this invoice
         else:
+             # Инвойс не создан: позицию незачем держать до истечения резерва
+             await release_checkout(position_id, user.id)
              buttons.append([InlineKeyboardButton("💳 Пополнить баланс", callback_data="balance_menu")])
         
         buttons.append([InlineKeyboardButton("🔙 Отмена", callback_data=f"pos_{position_id}")])
 
+        if invoice:
+            payment_note = (
+                "Инвойс создан автоматически. <b>Вы можете оплатить его любой популярной криптовалютой (BTC, ETH, LTC, USDT, TON и др.)</b> — сумма будет сконвертирована по текущему курсу.\n\n"
+                "После оплаты заказ будет оформлен автоматически."
+            )
+        else:
+            payment_note = (
+                "Инвойс на доплату создать не удалось. Пополните баланс вручную "
+                "и повторите покупку."
+            )
+
         await query.edit_message_text(
             (
                 "❌ <b>Недостаточно средств</b>\n\n"
                 f"Стоимость: <b>{format_amount(price)} $</b>\n"
-                f"Ваш баланс: <b>{format_amount(wallet['balance'])} $</b>\n"
+                f"Ваш баланс: <b>{format_amount(balance)} $</b>\n"
                 f"К доплате: <b>{format_amount(missing)} $</b>\n\n"
-                f"Инвойс создан автоматически. <b>Вы можете оплатить его любой популярной криптовалютой (BTC, ETH, LTC, USDT, TON и др.)</b> — сумма будет сконвертирована по текущему курсу."
+                f"{payment_note}"
             ),
             parse_mode='HTML',
             reply_markup=InlineKeyboardMarkup(buttons)
@@ -1490,6 +4160,8 @@ async def handle_purchase(update: Update, context: ContextTypes.DEFAULT_TYPE, po
         return
 
     # Добавляем покупку
+    seq = await money_journal.append('purchase', user_id=user.id, position_id=position['id'], price=price)
+    version = balance_ledger.version(user.id)
     purchase_result = await api.add_purchase(
         user.id,
         position_id,
@@ -1499,7 +4171,12 @@ async def handle_purchase(update: Update, context: ContextTypes.DEFAULT_TYPE, po
     )
 
     if purchase_result and purchase_result.get('success'):
-        await sync_wallet_balance(user.id)
+        money_journal.ack(seq, 'completed', balance=purchase_result.get('balance'))
+        balance_ledger.commit(user.id, purchase_result.get('balance'), expected_version=version)
+        analytics.track(
+            'purchase', user.id, category_id=category_id, product_id=product_id,
+            position_id=position['id'], amount=float(position['price'])
+        )
         await query.edit_message_text(
             f"✅ <b>Заказ оформлен!</b>\n\n"
             f"Продукт: {position.get('product', {}).get('name', 'Неизвестно')}\n"
@@ -1511,6 +4188,15 @@ async def handle_purchase(update: Update, context: ContextTypes.DEFAULT_TYPE, po
             ])
         )
     else:
+        # Сервер мог отклонить покупку из-за баланса: перечитаем его при следующем обращении
+        balance_ledger.invalidate(user.id)
+        await release_checkout(position_id, user.id)
+        if purchase_result is not None:
+            # Окончательный отказ сервера; при неизвестном исходе запись проверит replay_journal
+            money_journal.ack(seq, 'rejected', status=purchase_result.get('status'))
+        if purchase_result is None or purchase_result.get('status') == 404:
+            # Возможно, клиента удалили на сервере: при следующей покупке зарегистрируем заново
+            client_registry.forget(user.id)
         await query.edit_message_text(
             "❌ <b>Ошибка при оформлении заказа</b>\n\n",
             parse_mode='HTML',
@@ -1520,7 +4206,22 @@ async def handle_purchase(update: Update, context: ContextTypes.DEFAULT_TYPE, po
         )
 
 async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработчик inline кнопок"""
+    """Обработчик inline кнопок (через admission control)"""
+    query = update.callback_query
+    user_id = query.from_user.id
+    rejected = admission.admit(user_id, query.data)
+    if rejected:
+        await query.answer(ADMISSION_MESSAGES[rejected])
+        return
+    try:
+        async with admission.serialized(user_id):
+            await route_callback(update, context)
+    finally:
+        admission.release(user_id, query.data)
+
+
+async def route_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Маршрутизация inline кнопок по callback_data"""
     query = update.callback_query
     await query.answer()
     
@@ -1544,6 +4245,17 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif data.startswith("pos_"):
         position_id = data.split("_")[1]
         await show_position_details(update, context, position_id)
+    elif data.startswith(("notify_", "unnotify_")):
+        # notify_{product_id}_{city_id}_{district_id}, район 0 - весь город
+        action, product_id, city_id, district_id = data.split("_")
+        await toggle_restock_alert(
+            update, context, action == "notify", int(product_id), int(city_id), int(district_id)
+        )
+    elif data.startswith("topup_asset_"):
+        asset = data.split("_")[2]
+        if asset in CRYPTO_PAYMENT_ASSETS:
+            get_user_state(query.from_user.id).payment_asset = asset
+        await show_balance_menu(update, context)
     elif data.startswith("topup_custom_"):
         asset = data.split("_")[2]
         await prompt_custom_topup(update, asset)
@@ -1554,7 +4266,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await show_balance_menu(update, context)
     elif data == "cancel_topup":
         user_id = query.from_user.id
-        user_states[user_id]['awaiting_topup'] = None
+        get_user_state(user_id).awaiting_topup = None
         await query.edit_message_text(
             "❌ <b>Пополнение отменено</b>",
             parse_mode='HTML'
@@ -1562,7 +4274,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # Optionally bring them back to balance or menu
         await show_balance_menu(update, context)
     elif data.startswith("check_"):
-        invoice_id = data.split("_")[1]
+        invoice_id = int(data.split("_")[1])
         await check_invoice_status(update, invoice_id)
     elif data.startswith("city_"):
         city_id = data.split("_")[1]
@@ -1597,19 +4309,25 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
     elif data == "balance_menu":
         await show_balance_menu(update, context)
+    elif data.startswith("reviews_before_"):
+        await show_reviews_menu(update, context, int(data.split("_")[2]))
+    elif data == "reviews_latest":
+        await show_reviews_menu(update, context)
     elif data.startswith("buy_"):
         position_id = data.split("_")[1]
         await handle_purchase(update, context, position_id)
     elif data.startswith("switch_district_"):
         _, _, category_id, city_id, district_id = data.split("_")
         user_id = query.from_user.id
-        user_states[user_id]['city_id'] = int(city_id)
-        user_states[user_id]['district_id'] = int(district_id)
+        user_state = get_user_state(user_id)
+        user_state.city_id = int(city_id)
+        user_state.district_id = int(district_id)
         await show_products(update, context, category_id)
 
 async def show_categories_from_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Показать категории из callback"""
     query = update.callback_query
+    analytics.track('categories', update.effective_user.id)
     categories = await api.get_catalog_categories()
     
     if not categories:
@@ -1628,24 +4346,525 @@ async def show_categories_from_callback(update: Update, context: ContextTypes.DE
             callback_data=f"cat_{category['id']}"
         )])
     
-    await query.edit_message_text(
-        "🏪 <b>Выберите категорию:</b>",
-        parse_mode='HTML',
-        reply_markup=InlineKeyboardMarkup(keyboard)
+    await render_screen(update, "🏪 <b>Выберите категорию:</b>", InlineKeyboardMarkup(keyboard))
+
+async def handle_inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Поиск по каталогу в inline-режиме (@bot запрос)"""
+    inline_query = update.inline_query
+    user_state = get_user_state(inline_query.from_user.id)
+
+    try:
+        offset = int(inline_query.offset or 0)
+    except ValueError:
+        offset = 0
+
+    matches = search_index.search(
+        inline_query.query,
+        user_state.city_id,
+        user_state.district_id
+    )
+    page = matches[offset:offset + INLINE_RESULTS_PER_PAGE]
+
+    results = []
+    for doc in page:
+        if doc['kind'] == 'product':
+            description = f"Позиций: {doc['positions_count']}"
+            text = (
+                f"<b>📦 {html.escape(doc['title'])}</b>\n\n"
+                f"📝 {html.escape(doc['description'] or 'Описание отсутствует')}"
+            )
+        else:
+            description = f"💰 {doc['price']} $ {doc['description']}".strip()
+            text = (
+                f"<b>📍 {html.escape(doc['title'])}</b>\n\n"
+                f"💰 <b>Цена: {doc['price']} $</b>\n"
+                f"🏙️ {html.escape(doc['description'] or 'Не указан')}"
+            )
+
+        thumbnail_url = build_public_media_url(doc['img']) if doc.get('img') else None
+
+        if doc['kind'] == 'product':
+            link = build_deep_link(context.bot.username, product=doc['id'])
+        else:
+            city_id = next(iter(doc['city_ids']), None)
+            district_id = next(iter(doc['district_ids']), None)
+            link = build_deep_link(context.bot.username, position=doc['id'], city=city_id, district=district_id)
+
+        results.append(InlineQueryResultArticle(
+            id=f"{doc['kind']}_{doc['id']}",
+            title=doc['title'],
+            description=description,
+            thumbnail_url=thumbnail_url,
+            input_message_content=InputTextMessageContent(text, parse_mode='HTML'),
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🛒 Открыть в боте", url=link)]])
+        ))
+
+    next_offset = str(offset + INLINE_RESULTS_PER_PAGE) if offset + INLINE_RESULTS_PER_PAGE < len(matches) else ''
+
+    await inline_query.answer(
+        results,
+        cache_time=30,
+        is_personal=True,
+        next_offset=next_offset
+    )
+
+async def metrics_reporter():
+    """Периодически писать в лог сводку по запросам к Node API."""
+    while True:
+        await asyncio.sleep(METRICS_LOG_INTERVAL)
+        endpoints = sorted({dict(labels).get('endpoint') for (name, labels) in metrics.values if name.startswith('api_')} - {None})
+        for endpoint in endpoints:
+            logger.info(
+                "API %s: requests=%g cache_hits=%g not_modified=%g bytes_saved=%g parse_ms_saved=%.1f",
+                endpoint,
+                metrics.get('api_requests_total', endpoint=endpoint, status=200, transport=api.transport),
+                metrics.get('api_cache_hits_total', endpoint=endpoint),
+                metrics.get('api_not_modified_total', endpoint=endpoint),
+                metrics.get('api_bytes_saved_total', endpoint=endpoint),
+                metrics.get('api_parse_seconds_saved_total', endpoint=endpoint) * 1000
+            )
+
+def is_admin(update: Update):
+    user = update.effective_user
+    return user is not None and user.id in ADMIN_TELEGRAM_IDS
+
+
+def sample_stacks(thread_id, seconds, interval=PROFILE_SAMPLE_INTERVAL):
+    """Семплировать стек потока thread_id; результат - свернутые стеки (формат flamegraph.pl / speedscope)."""
+    counts = Counter()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        frame = sys._current_frames().get(thread_id)
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+            frame = frame.f_back
+        if stack:
+            counts[';'.join(reversed(stack))] += 1
+        time.sleep(interval)
+    return ''.join(f"{stack} {count}\n" for stack, count in counts.most_common())
+
+
+profiler_lock = asyncio.Lock()
+memory_snapshots = []
+
+
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/profile [cprofile] [секунды] - профилирование работающего бота.
+
+    По умолчанию семплируется стек потока event loop (файл .collapsed для
+    flamegraph), с cprofile - cProfile за то же время (файлы .prof и .txt).
+    """
+    if not is_admin(update):
+        return
+    args = list(context.args or [])
+    mode = 'cprofile' if args and args[0] == 'cprofile' else 'sample'
+    if mode == 'cprofile':
+        args = args[1:]
+    seconds = int(args[0]) if args and args[0].isdigit() else PROFILE_DEFAULT_SECONDS
+    seconds = max(1, min(seconds, PROFILE_MAX_SECONDS))
+
+    if profiler_lock.locked():
+        await update.message.reply_text("Профилирование уже запущено.")
+        return
+
+    async with profiler_lock:
+        await update.message.reply_text(f"Профилирование ({mode}) на {seconds} с...")
+        stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+        if mode == 'cprofile':
+            profile = cProfile.Profile()
+            profile.enable()
+            try:
+                await asyncio.sleep(seconds)
+            finally:
+                profile.disable()
+            profile.create_stats()
+            summary = io.StringIO()
+            pstats.Stats(profile, stream=summary).sort_stats('cumulative').print_stats(40)
+            await update.message.reply_document(marshal.dumps(profile.stats), filename=f"profile-{stamp}.prof")
+            await update.message.reply_document(summary.getvalue().encode(), filename=f"profile-{stamp}.txt")
+        else:
+            collapsed = await asyncio.to_thread(sample_stacks, threading.get_ident(), seconds)
+            await update.message.reply_document(
+                (collapsed or "no samples\n").encode(), filename=f"profile-{stamp}.collapsed"
+            )
+
+
+async def tasks_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/tasks - стеки всех asyncio задач."""
+    if not is_admin(update):
+        return
+    report = io.StringIO()
+    tasks = sorted(asyncio.all_tasks(), key=lambda task: task.get_name())
+    report.write(f"{len(tasks)} tasks\n\n")
+    for task in tasks:
+        report.write(f"{task.get_name()}: {task.get_coro()!r}\n")
+        task.print_stack(file=report)
+        report.write("\n")
+    stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+    await update.message.reply_document(report.getvalue().encode(), filename=f"tasks-{stamp}.txt")
+
+
+async def link_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/link p=123 c=4 - подписанная ссылка на экран бота для рекламы и рассылок."""
+    if not is_admin(update):
+        return
+    targets = {}
+    for arg in context.args or []:
+        code, _, value = arg.partition('=')
+        if code not in DEEP_LINK_FIELDS or not value.isdigit():
+            targets = None
+            break
+        targets[DEEP_LINK_FIELDS[code]] = int(value)
+    if not targets:
+        await update.message.reply_text(
+            "Использование: /link [k=категория] [p=продукт] [i=позиция] [c=город] [d=район]\n"
+            "Например: /link p=123 c=4"
+        )
+        return
+    try:
+        await update.message.reply_text(build_deep_link(context.bot.username, **targets))
+    except ValueError as e:
+        await update.message.reply_text(f"Не получилось: {e}")
+
+
+async def funnel_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/funnel - воронка за текущий день (UTC) и конверсия по городам и категориям."""
+    if not is_admin(update):
+        return
+    await analytics.flush()
+    rollup = analytics.rollup
+    lines = [f"<b>Воронка за {rollup.day or 'сегодня'}</b>"]
+    for step, users, percent in rollup.funnel():
+        lines.append(f"{step}: {users} ({percent:.1f}%)")
+    for kind, title in (('city', 'Города'), ('category', 'Категории')):
+        rows = rollup.conversion_by(kind)
+        if rows:
+            lines.append(f"\n<b>{title}</b> (товары → покупка)")
+            for dimension_id, viewed, bought in rows:
+                lines.append(f"#{dimension_id}: {viewed} → {bought} ({bought * 100 / viewed:.1f}%)")
+    await update.message.reply_text('\n'.join(lines), parse_mode='HTML')
+
+
+async def memory_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/memory [stop] - tracemalloc: рост памяти по строкам кода с прошлого вызова."""
+    if not is_admin(update):
+        return
+    if context.args and context.args[0] == 'stop':
+        tracemalloc.stop()
+        memory_snapshots.clear()
+        await update.message.reply_text("tracemalloc остановлен.")
+        return
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+        memory_snapshots[:] = [tracemalloc.take_snapshot()]
+        await update.message.reply_text("tracemalloc запущен. Повторите /memory, чтобы получить разницу.")
+        return
+
+    snapshot = tracemalloc.take_snapshot().filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap>')
+    ])
+    stats = snapshot.compare_to(memory_snapshots[-1], 'lineno')[:MEMORY_TOP_N]
+    memory_snapshots[:] = [snapshot]
+
+    current, peak = tracemalloc.get_traced_memory()
+    sessions = session_memory_report()
+    report = io.StringIO()
+    report.write(f"traced: {current / 1024:.1f} KiB, peak: {peak / 1024:.1f} KiB\n")
+    report.write(f"user_states: {sessions['sessions']} sessions, ~{sessions['total_bytes'] / 1024:.1f} KiB\n\n")
+    report.write(f"top {MEMORY_TOP_N} by growth since previous snapshot:\n")
+    for stat in stats:
+        report.write(f"{stat}\n")
+    stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+    await update.message.reply_document(report.getvalue().encode(), filename=f"memory-{stamp}.txt")
+
+
+background_tasks = []
+
+
+class Lifecycle:
+    """Корректная остановка бота по SIGTERM/SIGINT (перезапуск контейнера, деплой).
+
+    Сигнал останавливает получение апдейтов (stop_running), Application.stop()
+    дожидается обрабатываемых апдейтов, а сторож через drain_timeout секунд
+    отменяет зависшие. Незавершенные оплаты не теряются: инвойсы лежат в
+    SQLite, а зачисление на сервере идемпотентно по invoice_id.
+    """
+
+    def __init__(self, drain_timeout=SHUTDOWN_DRAIN_TIMEOUT):
+        self.drain_timeout = drain_timeout
+        self.in_flight = set()
+        self.stopping = False
+        self._watchdog = None
+
+    def track(self):
+        """Учесть задачу текущего апдейта до ее завершения."""
+        task = asyncio.current_task()
+        if task is not None and task not in self.in_flight:
+            self.in_flight.add(task)
+            task.add_done_callback(self.in_flight.discard)
+
+    def install_signal_handlers(self, application):
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            try:
+                loop.add_signal_handler(sig, self.request_stop, application, sig)
+            except (NotImplementedError, RuntimeError):
+                # Windows: остается KeyboardInterrupt, который обрабатывает run_polling
+                pass
+
+    def request_stop(self, application, sig=None):
+        if self.stopping:
+            return
+        self.stopping = True
+        logger.info(
+            "Received %s, draining %s in-flight updates (deadline %ss)",
+            signal.Signals(sig).name if sig else 'stop', len(self.in_flight), self.drain_timeout
+        )
+        self._watchdog = asyncio.get_running_loop().call_later(self.drain_timeout, self._cancel_in_flight)
+        application.stop_running()
+
+    def _cancel_in_flight(self):
+        if self.in_flight:
+            logger.warning("Drain deadline exceeded, cancelling %s in-flight updates", len(self.in_flight))
+        for task in list(self.in_flight):
+            task.cancel()
+
+    def drained(self):
+        """Вызывается после Application.stop(): сторож больше не нужен."""
+        if self._watchdog is not None:
+            self._watchdog.cancel()
+            self._watchdog = None
+
+
+lifecycle = Lifecycle()
+
+
+async def warmup_step(name, coro):
+    """Шаг прогрева с пределом времени: ошибка не мешает запуску, только попадает в отчет."""
+    started = time.perf_counter()
+    try:
+        result = await asyncio.wait_for(coro, WARMUP_TIMEOUT)
+        status = 'ok' if result not in (None, False) else 'empty'
+    except asyncio.TimeoutError:
+        status = 'timeout'
+    except Exception as e:
+        logger.warning("Warmup step %s failed: %s", name, e)
+        status = 'error'
+    startup.warmup[name] = (time.perf_counter() - started, status)
+    metrics.set('bot_warmup_seconds', startup.warmup[name][0], step=name, status=status)
+
+
+async def warmup():
+    """Параллельно заполнить кэши, которые иначе прогревают первые пользователи.
+
+    Ответы Node API попадают в кэш BotAPI (max_age), заодно открываются
+    соединения пулов к Node серверу и pay.crypt.bot.
+    """
+    async def content():
+        pages = await asyncio.gather(*(api.get_bot_content(key) for key in ('welcome', 'about', 'help')))
+        return all(page is not None for page in pages)
+
+    steps = [
+        ('categories', api.get_catalog_categories()),
+        ('search_index', refresh_search_index()),
+        ('content', content()),
+        ('reviews', reviews_feed.refresh()),
+        ('public_url', public_url_resolver.refresh()),
+        ('crypto_pay', crypto_bot.get_me()),
+    ]
+    if len(CRYPTO_PAYMENT_ASSETS) > 1:
+        steps.append(('exchange_rates', exchange_rates.refresh()))
+    await asyncio.gather(*(warmup_step(name, coro) for name, coro in steps))
+
+
+async def healthz(request):
+    return web.Response(text='ok')
+
+
+async def readyz(request):
+    """Готов, когда кэши прогреты и идет polling; при остановке - снова не готов."""
+    ready = startup.ready and not lifecycle.stopping
+    return web.json_response({
+        'ready': ready,
+        'stopping': lifecycle.stopping,
+        'warmup': {step: status for step, (_, status) in startup.warmup.items()}
+    }, status=200 if ready else 503)
+
+
+async def metrics_endpoint(request):
+    return web.Response(text=metrics.render(), content_type='text/plain')
+
+
+async def start_health_server():
+    """HTTP сервер проверок для оркестратора. None, если HEALTH_PORT=0."""
+    if not HEALTH_PORT:
+        return None
+    app = web.Application()
+    app.router.add_get('/healthz', healthz)
+    app.router.add_get('/readyz', readyz)
+    app.router.add_get('/metrics', metrics_endpoint)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, HEALTH_HOST, HEALTH_PORT).start()
+    logger.info("Health server listening on %s:%s", HEALTH_HOST, HEALTH_PORT)
+    return runner
+
+
+health_server = None
+
+
+async def bind_log_context(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Контекст апдейта для логов (каждый апдейт обрабатывается в своей задаче)."""
+    handler = None
+    if update.callback_query:
+        handler = 'callback:' + (update.callback_query.data or '').split('_')[0]
+    elif update.inline_query:
+        handler = 'inline_query'
+    elif update.message and update.message.text:
+        text = update.message.text
+        handler = 'command:' + text.split()[0][1:] if text.startswith('/') else 'message'
+    lifecycle.track()
+    user = update.effective_user
+    trace = tracer.start_trace('update', handler=handler, update_id=update.update_id)
+    log_context.set({
+        'trace_id': trace.trace_id,
+        'user_id': user.id if user else None,
+        'update_id': update.update_id,
+        'handler': handler
+    })
+
+
+async def finish_update_trace(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Закрыть трассу апдейта после обработчиков группы 0."""
+    tracer.finish_trace()
+
+
+async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE):
+    """Исключение обработчика: в лог и ошибкой на корневой спан трассы (такая трасса всегда сохраняется)."""
+    tracer.fail(context.error)
+    logger.error("Exception while handling an update", exc_info=context.error)
+
+
+async def post_init(application: Application):
+    """Восстановление состояния, прогрев кэшей и запуск фоновых задач до начала polling"""
+    global health_server
+    startup.mark('initialize')
+    restored = pending_invoices.load()
+    if restored:
+        logger.info("Restored %s pending invoices", restored)
+    subscriptions = restock_alerts.load()
+    if subscriptions:
+        logger.info("Restored %s restock subscriptions", subscriptions)
+    if ANALYTICS_ENABLED:
+        logger.info("Restored funnel from %s analytics events", analytics.load())
+    unacked = money_journal.load()
+    if unacked:
+        logger.info("Replaying %s unacknowledged money journal entries", unacked)
+        try:
+            await asyncio.wait_for(replay_journal(application.bot), WARMUP_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning("Journal replay did not finish on startup, journal_replayer will retry")
+    lifecycle.install_signal_handlers(application)
+    try:
+        health_server = await start_health_server()
+    except OSError as e:
+        logger.error("Health server failed to start: %s", e)
+    await warmup()
+    startup.mark('warmup')
+    if CHANGE_FEED_ENABLED:
+        background_tasks.append(asyncio.create_task(change_feed.run()))
+    background_tasks.append(asyncio.create_task(search_index_refresher()))
+    background_tasks.append(asyncio.create_task(metrics_reporter()))
+    background_tasks.append(asyncio.create_task(trace_exporter()))
+    background_tasks.append(asyncio.create_task(public_url_watcher()))
+    background_tasks.append(asyncio.create_task(session_sweeper()))
+    background_tasks.append(asyncio.create_task(invoice_sweeper()))
+    background_tasks.append(asyncio.create_task(payment_poller(application.bot)))
+    background_tasks.append(asyncio.create_task(restock_sender(application.bot)))
+    background_tasks.append(asyncio.create_task(analytics_flusher()))
+    background_tasks.append(asyncio.create_task(journal_replayer(application.bot)))
+    if len(CRYPTO_PAYMENT_ASSETS) > 1:
+        background_tasks.append(asyncio.create_task(exchange_rates_refresher()))
+
+
+async def post_stop(application: Application):
+    """После остановки обработки апдейтов: остановка фоновых задач и сброс состояния на диск"""
+    lifecycle.drained()
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
+    await analytics.flush()
+    await money_journal.close()
+    try:
+        await client_registry.flush()
+    except Exception as e:
+        logger.error("Error flushing client registrations: %s", e)
+    persist_sessions(list(user_states.values()))
+    await tracer.export()
+    tracer.close()
+    logger.info(
+        "State flushed: %s sessions, %s pending invoices", len(user_states), len(pending_invoices.by_id)
     )
 
+
+async def post_shutdown(application: Application):
+    """Закрытие HTTP-пулов, сервера проверок и локальной базы"""
+    global health_server
+    if health_server is not None:
+        await health_server.cleanup()
+        health_server = None
+    await api.close()
+    await crypto_bot.close()
+    global _storage
+    if _storage is not None:
+        _storage.close()
+        _storage = None
+    client_registry.close()
+
 def main():
-    application = Application.builder().token(BOT_TOKEN).build()
+    startup.mark('imports')
+    log_listener = setup_logging()
+    application = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+        # Апдейты разных пользователей параллельно, кнопки одного - по очереди (admission.serialized)
+        .concurrent_updates(UPDATE_CONCURRENCY)
+        .request(TracingRequest(connection_pool_size=256))
+        # getUpdates идет через отдельный запрос: по нему отмечается начало polling (readiness)
+        .get_updates_request(TracingRequest())
+        .build()
+    )
 
+    application.add_handler(TypeHandler(Update, bind_log_context), group=-1)
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("balance", show_balance_menu))
+    application.add_handler(CommandHandler("profile", profile_command))
+    application.add_handler(CommandHandler("tasks", tasks_command))
+    application.add_handler(CommandHandler("memory", memory_command))
+    application.add_handler(CommandHandler("link", link_command))
+    application.add_handler(CommandHandler("funnel", funnel_command))
 
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_main_menu))
     
     application.add_handler(CallbackQueryHandler(button_handler))
-    
+    application.add_handler(InlineQueryHandler(handle_inline_query))
+    application.add_handler(TypeHandler(Update, finish_update_trace), group=1)
+    application.add_error_handler(error_handler)
+    startup.mark('build')
+
     logger.info("Bot is starting...")
-    application.run_polling()
+    try:
+        # Сигналы обрабатывает lifecycle (с дедлайном на завершение апдейтов)
+        application.run_polling(stop_signals=None)
+    finally:
+        log_listener.stop()
 
 if __name__ == '__main__':
     main()
@@ -1,8 +1,39 @@
-const { BotContent, Product, Position, City, District, Category, Client } = require('../models/models')
+const {
+    BotContent, Product, Position, City, District, Category, Client, Payment, Reservation, AnalyticsEvent
+} = require('../models/models')
 const ApiError = require('../error/ApiError')
+const changeFeed = require('../events/changeFeed')
+const sequelize = require('../db')
+const { Op, UniqueConstraintError } = require('sequelize')
 const uuid = require('uuid')
 const path = require('path')
 
+// Срок резерва позиции по умолчанию и максимальный (секунды). Максимум покрывает
+// резерв на время оплаты инвойса на доплату: срок инвойса бота плюс запас
+const RESERVATION_TTL = parseInt(process.env.RESERVATION_TTL || '300')
+const MAX_RESERVATION_TTL = parseInt(process.env.MAX_RESERVATION_TTL || '7200')
+
+// Максимум событий аналитики в одной пачке от бота
+const ANALYTICS_BATCH_LIMIT = 5000
+
+// Позиция удерживается активным резервом другого покупателя
+const isReservedByOther = async (positionId, telegramId, transaction) => {
+    const reservation = await Reservation.findOne({
+        where: { positionId, expiresAt: { [Op.gt]: new Date() } },
+        transaction
+    })
+    return !!reservation && String(reservation.telegramId) !== String(telegramId)
+}
+
+// объект покупки для client.purchasedPositions
+const buildPurchase = (position, { positionName, price, productName } = {}) => ({
+    positionId: position.id,
+    positionName: positionName || position.name,
+    price: parseFloat(price || position.price),
+    productName: productName || (position.product ? position.product.name : 'Unknown'),
+    purchaseDate: new Date().toISOString()
+})
+
 class BotController {
     async getContent(req, res, next) {
         try {
@@ -42,6 +73,7 @@ class BotController {
                 text,
                 image: imageName
             })
+            changeFeed.publish('content', content.id, 'create', { keys: [content.key] })
             return res.json(content)
         } catch (e) {
             next(ApiError.internal(e.message))
@@ -66,11 +98,13 @@ class BotController {
                 imageName = content.image
             }
 
+            const previousKey = content.key
             await content.update({
                 key,
                 text,
                 image: imageName
             })
+            changeFeed.publish('content', content.id, 'update', { keys: [...new Set([previousKey, content.key])] })
             return res.json(content)
         } catch (e) {
             next(ApiError.internal(e.message))
@@ -85,6 +119,7 @@ class BotController {
                 return next(ApiError.notFound('Content not found'))
             }
             await content.destroy()
+            changeFeed.publish('content', content.id, 'delete', { keys: [content.key] })
             return res.json({ message: 'Content deleted' })
         } catch (e) {
             next(ApiError.internal(e.message))
@@ -242,56 +277,134 @@ class BotController {
         }
     }
 
-    async addPurchase(req, res, next) {
+    async bulkUpsertClients(req, res, next) {
         try {
-            const { telegramId } = req.params
-            const { positionId, positionName, price, productName } = req.body
+            const { clients } = req.body // Expecting array of {telegramId, username, firstName, lastName}
+            if (!Array.isArray(clients)) {
+                return next(ApiError.badRequest('Clients must be an array'))
+            }
 
-            let client = await Client.findOne({ where: { telegramId } })
-            if (!client) {
-                return next(ApiError.notFound('Client not found'))
+            const rows = clients
+                .filter(c => c && c.telegramId)
+                .map(c => ({
+                    telegramId: c.telegramId,
+                    username: c.username,
+                    firstName: c.firstName,
+                    lastName: c.lastName,
+                    purchasedPositions: []
+                }))
+
+            // Как и в getOrCreateClient, пустое поле не затирает сохраненное значение:
+            // пачка делится по набору заполненных полей профиля, у существующих
+            // клиентов обновляются только они (не больше 8 вставок на пачку)
+            const groups = new Map()
+            for (const row of rows) {
+                const fields = ['username', 'firstName', 'lastName'].filter(field => row[field])
+                const key = fields.join(',')
+                if (!groups.has(key)) {
+                    groups.set(key, { fields, rows: [] })
+                }
+                groups.get(key).rows.push(row)
             }
 
-            const position = await Position.findByPk(positionId, {
-                include: [{ model: Product, as: 'product' }]
+            await sequelize.transaction(async (transaction) => {
+                for (const { fields, rows: group } of groups.values()) {
+                    await Client.bulkCreate(group, fields.length ? {
+                        conflictAttributes: ['telegramId'],
+                        updateOnDuplicate: fields,
+                        transaction
+                    } : { ignoreDuplicates: true, transaction })
+                }
             })
-            if (!position) {
-                return next(ApiError.notFound('Position not found'))
-            }
 
-            const purchasePrice = parseFloat(price || position.price)
-            const currentBalance = parseFloat(client.balance || 0)
+            return res.json({ count: rows.length })
+        } catch (e) {
+            next(ApiError.internal(e.message))
+        }
+    }
 
-            if (isNaN(purchasePrice) || purchasePrice <= 0) {
-                return next(ApiError.badRequest('Invalid position price'))
+    // POST /bot/analytics/events { events: [{event, telegramId, ts, cityId, categoryId, productId, positionId, amount}] }
+    async ingestAnalytics(req, res, next) {
+        try {
+            const { events } = req.body
+            if (!Array.isArray(events) || events.length > ANALYTICS_BATCH_LIMIT) {
+                return next(ApiError.badRequest(`Events must be an array of at most ${ANALYTICS_BATCH_LIMIT} items`))
             }
 
-            if (currentBalance < purchasePrice) {
-                return next(ApiError.badRequest('Insufficient balance'))
-            }
+            const rows = events
+                .filter(e => e && e.event && e.telegramId && e.ts)
+                .map(e => ({
+                    event: e.event,
+                    telegramId: e.telegramId,
+                    cityId: e.cityId,
+                    categoryId: e.categoryId,
+                    productId: e.productId,
+                    positionId: e.positionId,
+                    amount: e.amount,
+                    occurredAt: new Date(e.ts * 1000)
+                }))
+            await AnalyticsEvent.bulkCreate(rows)
+            return res.json({ count: rows.length })
+        } catch (e) {
+            next(ApiError.internal(e.message))
+        }
+    }
 
-            // объект покупки
-            const purchase = {
-                positionId: positionId,
-                positionName: positionName || position.name,
-                price: purchasePrice,
-                productName: productName || (position.product ? position.product.name : 'Unknown'),
-                purchaseDate: new Date().toISOString()
-            }
+    async addPurchase(req, res, next) {
+        try {
+            const { telegramId } = req.params
+            const { positionId, positionName, price, productName } = req.body
+
+            // Как и settlePayment, читаем и списываем баланс под блокировкой строки клиента:
+            // параллельная покупка или зачисление инвойса ждут окончания транзакции
+            const result = await sequelize.transaction(async (transaction) => {
+                const client = await Client.findOne({ where: { telegramId }, transaction, lock: transaction.LOCK.UPDATE })
+                if (!client) {
+                    return { error: ApiError.notFound('Client not found') }
+                }
+
+                const position = await Position.findByPk(positionId, {
+                    include: [{ model: Product, as: 'product' }],
+                    transaction
+                })
+                if (!position) {
+                    return { error: ApiError.notFound('Position not found') }
+                }
 
-            const currentPurchases = client.purchasedPositions || []
-            const updatedPurchases = [...currentPurchases, purchase]
+                const purchasePrice = parseFloat(price || position.price)
+                const currentBalance = parseFloat(client.balance || 0)
+
+                if (isNaN(purchasePrice) || purchasePrice <= 0) {
+                    return { error: ApiError.badRequest('Invalid position price') }
+                }
 
-            await client.update({
-                purchasedPositions: updatedPurchases,
-                balance: currentBalance - purchasePrice
+                if (currentBalance < purchasePrice) {
+                    return { error: ApiError.badRequest('Insufficient balance') }
+                }
+
+                if (await isReservedByOther(positionId, telegramId, transaction)) {
+                    return { error: ApiError.conflict('Position is reserved by another client') }
+                }
+
+                const purchase = buildPurchase(position, { positionName, price: purchasePrice, productName })
+                const updatedPurchases = [...(client.purchasedPositions || []), purchase]
+                const balance = currentBalance - purchasePrice
+
+                await client.update({ purchasedPositions: updatedPurchases, balance }, { transaction })
+                await Reservation.destroy({ where: { positionId, telegramId }, transaction })
+
+                return { purchase, totalPurchases: updatedPurchases.length, balance }
             })
 
+            if (result.error) {
+                return next(result.error)
+            }
+
             return res.json({
                 success: true,
-                purchase: purchase,
-                totalPurchases: updatedPurchases.length,
-                balance: currentBalance - purchasePrice
+                purchase: result.purchase,
+                totalPurchases: result.totalPurchases,
+                balance: result.balance
             })
         } catch (e) {
             next(ApiError.internal(e.message))
@@ -386,6 +499,154 @@ class BotController {
         }
     }
 
+    async settlePayment(req, res, next) {
+        const { telegramId } = req.params
+        const { invoiceId, amount, positionId } = req.body
+        const parsedAmount = parseFloat(amount)
+
+        if (!invoiceId || isNaN(parsedAmount) || parsedAmount <= 0) {
+            return next(ApiError.badRequest('invoiceId and a positive amount are required'))
+        }
+
+        try {
+            // Зачисление и заказ в одной транзакции: либо применяется все, либо ничего
+            const result = await sequelize.transaction(async (transaction) => {
+                const payment = await Payment.create({
+                    invoiceId, telegramId, amount: parsedAmount, positionId: positionId || null
+                }, { transaction })
+
+                let client = await Client.findOne({ where: { telegramId }, transaction, lock: transaction.LOCK.UPDATE })
+                if (!client) {
+                    client = await Client.create({ telegramId, balance: 0, purchasedPositions: [] }, { transaction })
+                }
+
+                let balance = parseFloat(client.balance || 0) + parsedAmount
+                let purchases = client.purchasedPositions || []
+                let purchase = null
+
+                if (positionId) {
+                    const position = await Position.findByPk(positionId, {
+                        include: [{ model: Product, as: 'product' }],
+                        transaction
+                    })
+                    const price = position ? parseFloat(position.price) : NaN
+                    // Позицию могли удалить, изменить цену или зарезервировать другому
+                    // покупателю: тогда деньги остаются на балансе
+                    if (position && price > 0 && balance >= price &&
+                        !(await isReservedByOther(positionId, telegramId, transaction))) {
+                        purchase = buildPurchase(position)
+                        purchases = [...purchases, purchase]
+                        balance -= price
+                        await Reservation.destroy({ where: { positionId, telegramId }, transaction })
+                    }
+                }
+
+                await client.update({ balance, purchasedPositions: purchases }, { transaction })
+                await payment.update({
+                    status: positionId ? (purchase ? 'completed' : 'order_failed') : 'credited',
+                    purchase
+                }, { transaction })
+
+                return { payment, balance }
+            })
+
+            return res.json({
+                invoiceId: result.payment.invoiceId,
+                status: result.payment.status,
+                purchase: result.payment.purchase,
+                balance: result.balance,
+                duplicate: false
+            })
+        } catch (e) {
+            if (!(e instanceof UniqueConstraintError)) {
+                return next(ApiError.internal(e.message))
+            }
+        }
+
+        // Инвойс уже обработан: возвращаем сохраненный результат
+        try {
+            const payment = await Payment.findOne({ where: { invoiceId } })
+            const client = await Client.findOne({ where: { telegramId } })
+            return res.json({
+                invoiceId: payment.invoiceId,
+                status: payment.status,
+                purchase: payment.purchase,
+                balance: parseFloat(client ? client.balance : 0),
+                duplicate: true
+            })
+        } catch (e) {
+            next(ApiError.internal(e.message))
+        }
+    }
+
+    async reservePosition(req, res, next) {
+        const { positionId } = req.params
+        const { telegramId } = req.body
+        const ttl = Math.min(parseInt(req.body.ttl) || RESERVATION_TTL, MAX_RESERVATION_TTL)
+
+        if (!telegramId) {
+            return next(ApiError.badRequest('telegramId is required'))
+        }
+
+        try {
+            const reservation = await sequelize.transaction(async (transaction) => {
+                const position = await Position.findByPk(positionId, { transaction })
+                if (!position) {
+                    return null
+                }
+
+                const expiresAt = new Date(Date.now() + ttl * 1000)
+                const current = await Reservation.findOne({
+                    where: { positionId },
+                    transaction,
+                    lock: transaction.LOCK.UPDATE
+                })
+                if (!current) {
+                    return Reservation.create({ positionId, telegramId, expiresAt }, { transaction })
+                }
+                // Активный резерв другого покупателя не трогаем
+                if (current.expiresAt > new Date() && String(current.telegramId) !== String(telegramId)) {
+                    return current
+                }
+                return current.update({ telegramId, expiresAt }, { transaction })
+            })
+
+            if (!reservation) {
+                return next(ApiError.notFound('Position not found'))
+            }
+            if (String(reservation.telegramId) !== String(telegramId)) {
+                return next(ApiError.conflict('Position is reserved by another client'))
+            }
+
+            return res.json({
+                positionId: reservation.positionId,
+                expiresAt: reservation.expiresAt
+            })
+        } catch (e) {
+            // Параллельный первый резерв той же позиции
+            if (e instanceof UniqueConstraintError) {
+                return next(ApiError.conflict('Position is reserved by another client'))
+            }
+            next(ApiError.internal(e.message))
+        }
+    }
+
+    async releasePosition(req, res, next) {
+        try {
+            const { positionId } = req.params
+            const { telegramId } = req.body
+
+            if (!telegramId) {
+                return next(ApiError.badRequest('telegramId is required'))
+            }
+
+            const released = await Reservation.destroy({ where: { positionId, telegramId } })
+            return res.json({ released: released > 0 })
+        } catch (e) {
+            next(ApiError.internal(e.message))
+        }
+    }
+
     async testTopUpBalance(req, res, next) {
         try {
             let { amount } = req.body
@@ -1,5 +1,6 @@
-const {Category, Product, Position, City, District} = require('../models/models')
+const {Category, Product, Position, City, District, Reservation} = require('../models/models')
 const ApiError = require('../error/ApiError')
+const {Op} = require('sequelize')
 
 // Сценарии использования:
 // Для бота:
@@ -86,7 +87,15 @@ class CatalogController {
                 include: [
                     {model: Product, as: 'product'},
                     {model: City, as: 'city'},
-                    {model: District, as: 'district'}
+                    {model: District, as: 'district'},
+                    // Активный резерв (если есть): позиция временно занята другим покупателем
+                    {
+                        model: Reservation,
+                        as: 'reservation',
+                        attributes: ['expiresAt'],
+                        required: false,
+                        where: {expiresAt: {[Op.gt]: new Date()}}
+                    }
                 ],
                 order: [['price', 'ASC']] // Сортировка по цене
             })
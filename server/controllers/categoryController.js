@@ -1,11 +1,13 @@
 const {Category, Product} = require('../models/models')
 const ApiError = require('../error/ApiError')
+const changeFeed = require('../events/changeFeed')
 
 class CategoryController {
     async create(req, res, next) {
         try {
             const {name} = req.body
             const category = await Category.create({name})
+            changeFeed.publish('category', category.id, 'create')
             return res.json(category)
         } catch (e) {
             next(ApiError.badRequest(e.message))
@@ -54,6 +56,7 @@ class CategoryController {
             }
             
             await category.destroy()
+            changeFeed.publish('category', category.id, 'delete')
             return res.json({message: 'Category deleted'})
         } catch (e) {
             next(ApiError.internal(e.message))
@@ -1,11 +1,13 @@
 const {City, District} = require('../models/models')
 const ApiError = require('../error/ApiError')
+const changeFeed = require('../events/changeFeed')
 
 class CityController {
     async create(req, res, next) {
         try {
             const {name} = req.body
             const city = await City.create({name})
+            changeFeed.publish('city', city.id, 'create')
             return res.json(city)
         } catch (e) {
             next(ApiError.badRequest(e.message))
@@ -31,6 +33,7 @@ class CityController {
                 return next(ApiError.notFound('City not found'))
             }
             await city.destroy()
+            changeFeed.publish('city', city.id, 'delete')
             return res.json({message: 'City deleted'})
         } catch (e) {
             next(ApiError.internal(e.message))
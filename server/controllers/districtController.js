@@ -1,11 +1,13 @@
 const {District} = require('../models/models')
 const ApiError = require('../error/ApiError')
+const changeFeed = require('../events/changeFeed')
 
 class DistrictController {
     async create(req, res, next) {
         try {
             const {name, cityId} = req.body // cityId!
             const district = await District.create({name, cityId})
+            changeFeed.publish('district', district.id, 'create', {cityId: district.cityId})
             return res.json(district)
         } catch (e) {
             next(ApiError.badRequest(e.message))
@@ -41,6 +43,7 @@ class DistrictController {
                 return next(ApiError.notFound('District not found'))
             }
             await district.destroy()
+            changeFeed.publish('district', district.id, 'delete', {cityId: district.cityId})
             return res.json({message: 'District deleted'})
         } catch (e) {
             next(ApiError.internal(e.message))
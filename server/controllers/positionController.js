@@ -1,5 +1,7 @@
-const {Position, Product, Category, City, District} = require('../models/models')
+const {Position, Product, Category, City, District, Reservation} = require('../models/models')
 const ApiError = require('../error/ApiError')
+const changeFeed = require('../events/changeFeed')
+const {Op} = require('sequelize')
 
 class PositionController {
     async create(req, res, next) {
@@ -12,6 +14,9 @@ class PositionController {
             }
 
             const position = await Position.create({name, price, location, type, productId, cityId, districtId})
+            changeFeed.publish('position', position.id, 'create', {
+                productId: position.productId, cityId: position.cityId, districtId: position.districtId
+            })
             
             return res.json(position)
         } catch (e) {
@@ -61,7 +66,14 @@ class PositionController {
                 include: [
                     {model: Product, as: 'product'},
                     {model: City, as: 'city'},
-                    {model: District, as: 'district'}
+                    {model: District, as: 'district'},
+                    {
+                        model: Reservation,
+                        as: 'reservation',
+                        attributes: ['expiresAt'],
+                        required: false,
+                        where: {expiresAt: {[Op.gt]: new Date()}}
+                    }
                 ]
             })
             if (!position) {
@@ -81,6 +93,7 @@ class PositionController {
                 return next(ApiError.notFound('Position not found'))
             }
             await position.destroy()
+            changeFeed.publish('position', position.id, 'delete', {productId: position.productId})
             return res.json({message: 'Position deleted'})
         } catch (e) {
             next(ApiError.internal(e.message))
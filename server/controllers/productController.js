@@ -2,6 +2,7 @@ const uuid = require('uuid')
 const path = require('path')
 const {Product, Category, Position} = require('../models/models')
 const ApiError = require('../error/ApiError')
+const changeFeed = require('../events/changeFeed')
 
 class ProductController {
     async create(req, res, next) {
@@ -18,6 +19,7 @@ class ProductController {
             await img.mv(path.resolve(__dirname, '..', 'static', filename))
 
             const product = await Product.create({name, description, img: filename, categoryId})
+            changeFeed.publish('product', product.id, 'create', {categoryId: product.categoryId})
             
             return res.json(product)
         } catch (e) {
@@ -125,6 +127,7 @@ class ProductController {
                 return next(ApiError.notFound('Product not found'))
             }
             await product.destroy()
+            changeFeed.publish('product', product.id, 'delete', {categoryId: product.categoryId})
             return res.json({message: 'Product deleted'})
         } catch (e) {
             next(ApiError.internal(e.message))
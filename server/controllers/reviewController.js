@@ -1,11 +1,14 @@
 const { Review } = require('../models/models')
+const { Op } = require('sequelize')
 const ApiError = require('../error/ApiError')
+const changeFeed = require('../events/changeFeed')
 
 class ReviewController {
     async create(req, res, next) {
         try {
             const { text, author, rating } = req.body
             const review = await Review.create({ text, author, rating })
+            changeFeed.publish('review', review.id, 'create')
             return res.json(review)
         } catch (e) {
             next(ApiError.badRequest(e.message))
@@ -19,23 +22,47 @@ class ReviewController {
                 return next(ApiError.badRequest("Reviews must be an array"))
             }
             const createdReviews = await Review.bulkCreate(reviews)
+            changeFeed.publish('review', null, 'create', { count: createdReviews.length })
             return res.json(createdReviews)
         } catch (e) {
             next(ApiError.badRequest(e.message))
         }
     }
 
-    async getAll(req, res) {
-        const reviews = await Review.findAll()
-        return res.json(reviews)
+    async getAll(req, res, next) {
+        try {
+            const { sinceId, beforeId, limit } = req.query
+
+            // Без параметров - полный список (админка)
+            if (!sinceId && !beforeId && !limit) {
+                const reviews = await Review.findAll()
+                return res.json(reviews)
+            }
+
+            // Для бота: новые отзывы после sinceId (по возрастанию)
+            // или страница более ранних перед beforeId (по убыванию)
+            const where = {}
+            if (sinceId) where.id = { [Op.gt]: parseInt(sinceId) }
+            if (beforeId) where.id = { ...where.id, [Op.lt]: parseInt(beforeId) }
+
+            const reviews = await Review.findAll({
+                where,
+                order: [['id', sinceId && !beforeId ? 'ASC' : 'DESC']],
+                limit: Math.min(parseInt(limit) || 50, 100)
+            })
+            return res.json(reviews)
+        } catch (e) {
+            next(ApiError.internal(e.message))
+        }
     }
 
     async getStats(req, res) {
         try {
             const count = await Review.count()
             const sum = await Review.sum('rating')
+            const lastId = await Review.max('id')
             const average = count > 0 ? (sum / count).toFixed(1) : 0
-            return res.json({ count, average })
+            return res.json({ count, average, sum: sum || 0, lastId: lastId || 0 })
         } catch (e) {
             return res.status(500).json(e)
         }
@@ -47,6 +74,7 @@ class ReviewController {
             const review = await Review.findOne({ where: { id } })
             if (review) {
                 await review.destroy()
+                changeFeed.publish('review', review.id, 'delete')
                 return res.json({ message: "Review deleted" })
             }
             return res.json({ message: "Review not found" })
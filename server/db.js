@@ -1,4 +1,5 @@
 const {Sequelize} = require('sequelize')
+const { traceStorage } = require('./middleware/traceMiddleware')
 
 module.exports = new Sequelize(
     process.env.DB_NAME,
@@ -7,7 +8,17 @@ module.exports = new Sequelize(
     {
         dialect: 'postgres',
         host: process.env.DB_HOST || 'localhost',
-        port: process.env.DB_PORT || 5432
+        port: process.env.DB_PORT || 5432,
+        benchmark: true,
+        // SQL запросы в рамках запроса бота пишутся с его traceId и длительностью
+        logging: (sql, durationMs) => {
+            const trace = traceStorage.getStore()
+            if (trace && trace.traced) {
+                console.log(JSON.stringify({ traceId: trace.traceId, sql, durationMs }))
+            } else {
+                console.log(sql)
+            }
+        }
     }
 
 )
\ No newline at end of file
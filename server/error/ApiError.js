@@ -13,6 +13,9 @@ class ApiError extends Error {
     static notFound(message) {
         return new ApiError(404, message)
     }
+    static conflict(message) {
+        return new ApiError(409, message)
+    }
     static internal(message) {
         return new ApiError(500, message)
     }
@@ -0,0 +1,69 @@
+const crypto = require('crypto')
+
+// Лента изменений каталога и контента для бота (Server-Sent Events).
+// Каждое событие получает возрастающую версию; id события - "<epoch>:<version>".
+// epoch меняется при перезапуске сервера: клиент с чужим epoch или слишком
+// старой версией получает событие reset и сбрасывает все кэши.
+const BUFFER_SIZE = Number(process.env.CHANGE_FEED_BUFFER || 1000)
+const HEARTBEAT_MS = Number(process.env.CHANGE_FEED_HEARTBEAT_MS || 25000)
+
+const epoch = crypto.randomBytes(4).toString('hex')
+const buffer = []
+const subscribers = new Set()
+let version = 0
+
+const formatEvent = (event) =>
+    `id: ${epoch}:${event.version}\nevent: change\ndata: ${JSON.stringify(event)}\n\n`
+
+const formatReset = () =>
+    `id: ${epoch}:${version}\nevent: reset\ndata: ${JSON.stringify({ version })}\n\n`
+
+// Опубликовать изменение сущности: entity - 'category', 'product', 'position',
+// 'city', 'district', 'content', 'review'; action - 'create', 'update', 'delete'
+const publish = (entity, id, action, extra = {}) => {
+    const event = { version: ++version, entity, id, action, ts: Date.now(), ...extra }
+    buffer.push(event)
+    if (buffer.length > BUFFER_SIZE) buffer.shift()
+    const chunk = formatEvent(event)
+    for (const res of subscribers) res.write(chunk)
+    return event
+}
+
+// События после версии из Last-Event-ID (или ?since=); null - нужен reset
+const eventsSince = (lastEventId) => {
+    if (!lastEventId) return null
+    const [lastEpoch, lastVersion] = String(lastEventId).split(':')
+    const since = Number(lastVersion)
+    if (lastEpoch !== epoch || !Number.isInteger(since) || since > version) return null
+    const oldest = buffer.length ? buffer[0].version : version + 1
+    if (since < oldest - 1) return null
+    return buffer.filter(event => event.version > since)
+}
+
+// GET /api/bot/changes
+const subscribe = (req, res) => {
+    res.writeHead(200, {
+        'Content-Type': 'text/event-stream',
+        // no-transform: compression() не буферизует поток
+        'Cache-Control': 'no-cache, no-transform',
+        'Connection': 'keep-alive',
+        'X-Accel-Buffering': 'no'
+    })
+    res.write(`retry: 1000\n\n`)
+
+    const missed = eventsSince(req.headers['last-event-id'] || req.query.since)
+    if (missed === null) {
+        res.write(formatReset())
+    } else {
+        for (const event of missed) res.write(formatEvent(event))
+    }
+
+    subscribers.add(res)
+    const heartbeat = setInterval(() => res.write(`: ping\n\n`), HEARTBEAT_MS)
+    req.on('close', () => {
+        clearInterval(heartbeat)
+        subscribers.delete(res)
+    })
+}
+
+module.exports = { publish, subscribe, eventsSince }
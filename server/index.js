@@ -4,15 +4,24 @@ const sequelize = require('./db')
 const models = require('./models/models')
 const { createDefaultAdmin } = require('./models/models')
 const cors = require('cors')
+const compression = require('compression')
 const fileUpload = require('express-fileupload')
 const router = require('./routes/index')
 const errorHandler = require('./middleware/ErrorHandleMiddleware')
+const traceMiddleware = require('./middleware/traceMiddleware')
 const path = require('path')
+const fs = require('fs')
 
 const PORT = process.env.PORT || 7000
+// Unix сокет для бота на том же хосте (NODE_API_URL=unix://<SOCKET_PATH>/api)
+const SOCKET_PATH = process.env.SOCKET_PATH
 
 const app = express()
+// Сильные ETag: бот делает условные GET (If-None-Match) и получает 304 без тела
+app.set('etag', 'strong')
+app.use(traceMiddleware)
 app.use(cors())
+app.use(compression())
 app.use(express.json())
 app.use(express.static(path.resolve(__dirname, 'static')))
 app.use(fileUpload({}))
@@ -26,6 +35,14 @@ const start = async () => {
         await sequelize.sync({ alter: true })
         await createDefaultAdmin()
         app.listen(PORT, () => console.log(`Server started on port ${PORT}`))
+        if (SOCKET_PATH) {
+            // Сокет от предыдущего запуска мешает listen
+            if (fs.existsSync(SOCKET_PATH)) fs.unlinkSync(SOCKET_PATH)
+            app.listen(SOCKET_PATH, () => {
+                fs.chmodSync(SOCKET_PATH, 0o666)
+                console.log(`Server listening on unix socket ${SOCKET_PATH}`)
+            })
+        }
     } catch (e) {
         console.log(e)
     }
@@ -0,0 +1,37 @@
+const { AsyncLocalStorage } = require('async_hooks')
+const crypto = require('crypto')
+
+// Контекст запроса (traceId) для логов, в том числе SQL запросов Sequelize
+const traceStorage = new AsyncLocalStorage()
+
+// traceparent: 00-<trace-id>-<parent-span-id>-<flags>
+const parseTraceparent = (header) => {
+    const match = /^00-([0-9a-f]{32})-([0-9a-f]{16})-[0-9a-f]{2}$/.exec(header || '')
+    return match ? { traceId: match[1], parentSpanId: match[2] } : null
+}
+
+// Запросы бота приходят с заголовком traceparent: пишем их длительность
+// с тем же traceId, что и в трассах бота, и возвращаем его в X-Trace-Id
+module.exports = function (req, res, next) {
+    const parent = parseTraceparent(req.headers.traceparent)
+    const traceId = parent ? parent.traceId : crypto.randomBytes(16).toString('hex')
+    const started = process.hrtime.bigint()
+
+    res.setHeader('X-Trace-Id', traceId)
+    if (parent) {
+        res.on('finish', () => {
+            console.log(JSON.stringify({
+                traceId,
+                parentSpanId: parent.parentSpanId,
+                method: req.method,
+                url: req.originalUrl,
+                status: res.statusCode,
+                durationMs: Number(process.hrtime.bigint() - started) / 1e6
+            }))
+        })
+    }
+
+    traceStorage.run({ traceId, traced: !!parent }, next)
+}
+
+module.exports.traceStorage = traceStorage
@@ -67,6 +67,43 @@ const Client = sequelize.define('client', {
     }
 })
 
+// Зачисление оплаченного инвойса Crypto Pay; invoiceId уникален, поэтому
+// повторная обработка одного инвойса ничего не меняет
+const Payment = sequelize.define('payment', {
+    id: { type: DataTypes.INTEGER, primaryKey: true, autoIncrement: true },
+    invoiceId: { type: DataTypes.BIGINT, unique: true, allowNull: false },
+    telegramId: { type: DataTypes.BIGINT, allowNull: false },
+    amount: { type: DataTypes.FLOAT, allowNull: false },
+    positionId: { type: DataTypes.INTEGER }, // заказ, который нужно оформить после оплаты
+    status: { type: DataTypes.STRING, allowNull: false, defaultValue: 'credited' }, // 'credited', 'completed', 'order_failed'
+    purchase: { type: DataTypes.JSON },
+})
+
+// Временное удержание позиции покупателем; одна запись на позицию,
+// истекшая запись считается свободной и перезаписывается при следующем резерве
+const Reservation = sequelize.define('reservation', {
+    id: { type: DataTypes.INTEGER, primaryKey: true, autoIncrement: true },
+    positionId: { type: DataTypes.INTEGER, unique: true, allowNull: false },
+    telegramId: { type: DataTypes.BIGINT, allowNull: false },
+    expiresAt: { type: DataTypes.DATE, allowNull: false },
+})
+
+// События воронки из бота (пачками через POST /api/bot/analytics/events)
+const AnalyticsEvent = sequelize.define('analytics_event', {
+    id: { type: DataTypes.BIGINT, primaryKey: true, autoIncrement: true },
+    event: { type: DataTypes.STRING, allowNull: false }, // categories, products, product, position, checkout, purchase
+    telegramId: { type: DataTypes.BIGINT, allowNull: false },
+    cityId: { type: DataTypes.INTEGER },
+    categoryId: { type: DataTypes.INTEGER },
+    productId: { type: DataTypes.INTEGER },
+    positionId: { type: DataTypes.INTEGER },
+    amount: { type: DataTypes.FLOAT },
+    occurredAt: { type: DataTypes.DATE, allowNull: false },
+}, {
+    timestamps: false,
+    indexes: [{ fields: ['event', 'occurredAt'] }]
+})
+
 const Review = sequelize.define('review', {
     id: { type: DataTypes.INTEGER, primaryKey: true, autoIncrement: true },
     text: { type: DataTypes.TEXT, allowNull: false },
@@ -95,6 +132,10 @@ Position.belongsTo(City, { foreignKey: 'cityId', as: 'city' })
 District.hasMany(Position, { foreignKey: 'districtId', as: 'positions' })
 Position.belongsTo(District, { foreignKey: 'districtId', as: 'district' })
 
+// Позиция может быть временно зарезервирована покупателем
+Position.hasOne(Reservation, { foreignKey: 'positionId', as: 'reservation' })
+Reservation.belongsTo(Position, { foreignKey: 'positionId', as: 'position' })
+
 const createDefaultAdmin = async () => {
     try {
         const adminLogin = process.env.ADMIN_LOGIN
@@ -124,6 +165,7 @@ const createDefaultAdmin = async () => {
 }
 
 module.exports = {
-    User, BotContent, Category, Product, Position, City, District, Client, Review,
+    User, BotContent, Category, Product, Position, City, District, Client, Review, Payment, Reservation,
+    AnalyticsEvent,
     createDefaultAdmin
 }
@@ -2,6 +2,7 @@ const { Router } = require('express')
 const router = Router()
 const botController = require('../controllers/botController')
 const checkRole = require('../middleware/checkRoleMiddleware')
+const changeFeed = require('../events/changeFeed')
 
 // Публичные routes (для бота)
 router.get('/content/:key', botController.getContent)
@@ -9,13 +10,24 @@ router.get('/cities-with-districts', botController.getCitiesWithDistricts)
 router.get('/categories-with-products', botController.getCategoriesWithProducts)
 router.get('/products-by-category/:categoryId', botController.getProductsByCategory)
 router.get('/categories/:categoryId/districts', botController.getAvailableDistrictsForCategory)
+// лента изменений для сброса кэшей бота (SSE, продолжение по Last-Event-ID)
+router.get('/changes', changeFeed.subscribe)
+
+// резерв позиции на время оформления заказа
+router.post('/positions/:positionId/reservation', botController.reservePosition)
+router.delete('/positions/:positionId/reservation', botController.releasePosition)
 
 // для клиентов и покупок
 router.post('/clients/:telegramId/purchase', botController.addPurchase)
 router.get('/clients/:telegramId/purchases', botController.getClientPurchases)
+router.post('/clients/bulk', botController.bulkUpsertClients)
 router.post('/clients/:telegramId', botController.getOrCreateClient)
 router.get('/clients/:telegramId/balance', botController.getClientBalance)
 router.post('/clients/:telegramId/balance/adjust', botController.adjustClientBalance)
+router.post('/clients/:telegramId/payments', botController.settlePayment)
+
+// события воронки пачками
+router.post('/analytics/events', botController.ingestAnalytics)
 router.post(
     '/clients/:telegramId/balance/test-topup',
     botController.testTopUpBalance.bind(botController)
@@ -34,6 +34,8 @@ module.exports = router
 // GET /api/bot/cities-with-districts
 // GET /api/bot/categories-with-products
 // GET /api/bot/products-by-category/:categoryId
+// GET /api/bot/changes (SSE: изменения каталога и контента)
+// POST /api/bot/analytics/events (события воронки пачками)
 // GET /api/bot/content (admin)
 // POST /api/bot/content (admin)
 // PUT /api/bot/content/:id (admin)